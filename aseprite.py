@@ -0,0 +1,539 @@
+import struct
+import zlib
+
+import numpy as np
+
+
+# Native reader for aseprite files, used instead of the aseprite executable when ASE_DECODER is 'native'.
+# https://github.com/aseprite/aseprite/blob/main/docs/ase-file-specs.md
+
+VERSION = 2  # Bump when rendering changes, it's a part of the export cache key
+
+HEADER_MAGIC = 0xA5E0
+FRAME_MAGIC = 0xF1FA
+
+HEADER_LAYER_OPACITY_VALID = 1
+HEADER_GROUP_OPACITY_VALID = 2  # Groups are composited separately and blended with their opacity and blend mode
+
+CHUNK_OLD_PALETTE = 0x0004
+CHUNK_OLD_PALETTE_2 = 0x0011
+CHUNK_LAYER = 0x2004
+CHUNK_CEL = 0x2005
+CHUNK_PALETTE = 0x2019
+
+LAYER_VISIBLE = 1
+LAYER_BACKGROUND = 8
+LAYER_REFERENCE = 64
+
+LAYER_TYPE_IMAGE = 0
+LAYER_TYPE_GROUP = 1
+LAYER_TYPE_TILEMAP = 2
+
+CEL_RAW = 0
+CEL_LINKED = 1
+CEL_COMPRESSED = 2
+CEL_COMPRESSED_TILEMAP = 3
+
+BLEND_NORMAL = 0
+BLEND_MULTIPLY = 1
+BLEND_SCREEN = 2
+BLEND_OVERLAY = 3
+BLEND_DARKEN = 4
+BLEND_LIGHTEN = 5
+BLEND_COLOR_DODGE = 6
+BLEND_COLOR_BURN = 7
+BLEND_HARD_LIGHT = 8
+BLEND_SOFT_LIGHT = 9
+BLEND_DIFFERENCE = 10
+BLEND_EXCLUSION = 11
+BLEND_HUE = 12
+BLEND_SATURATION = 13
+BLEND_COLOR = 14
+BLEND_LUMINOSITY = 15
+BLEND_ADDITION = 16
+BLEND_SUBTRACT = 17
+BLEND_DIVIDE = 18
+
+
+class AseLayer:
+    def __init__(self, index, name, flags, layer_type, child_level, blend_mode, opacity, parent):
+        self.index = index
+        self.name = name
+        self.flags = flags
+        self.type = layer_type
+        self.child_level = child_level
+        self.blend_mode = blend_mode
+        self.opacity = opacity
+        self.parent = parent
+        self.path = name if parent is None else f'{parent.path}/{name}'
+
+    def __repr__(self):
+        return f'AseLayer<{self.path}>'
+
+    @property
+    def is_visible(self):
+        return bool(self.flags & LAYER_VISIBLE)
+
+    @property
+    def is_background(self):
+        return bool(self.flags & LAYER_BACKGROUND)
+
+    @property
+    def is_group(self):
+        return self.type == LAYER_TYPE_GROUP
+
+    def ancestors(self):
+        layer = self.parent
+        while layer is not None:
+            yield layer
+            layer = layer.parent
+
+
+class AseCel:
+    def __init__(self, layer_index, x, y, opacity, z_index, width, height, data, compressed):
+        self.layer_index = layer_index
+        self.x = x
+        self.y = y
+        self.opacity = opacity
+        self.z_index = z_index
+        self.width = width
+        self.height = height
+        self._data = data
+        self._compressed = compressed
+        self._pixels = None
+
+    def get_pixels(self, ase):
+        # Returns cel image as (h, w, 4) RGBA uint8 array
+        if self._pixels is not None:
+            return self._pixels
+        data = zlib.decompress(self._data) if self._compressed else self._data
+        npix = self.width * self.height
+        if ase.depth == 32:
+            pixels = np.frombuffer(data, dtype=np.uint8, count=npix * 4).reshape(self.height, self.width, 4)
+        elif ase.depth == 16:
+            ga = np.frombuffer(data, dtype=np.uint8, count=npix * 2).reshape(self.height, self.width, 2)
+            pixels = np.empty((self.height, self.width, 4), dtype=np.uint8)
+            pixels[:, :, :3] = ga[:, :, :1]
+            pixels[:, :, 3] = ga[:, :, 1]
+        else:
+            assert ase.depth == 8
+            indexes = np.frombuffer(data, dtype=np.uint8, count=npix).reshape(self.height, self.width)
+            pixels = ase.palette[indexes]
+            if not ase.layers[self.layer_index].is_background:
+                pixels[indexes == ase.transparent_index] = 0
+        self._pixels = pixels
+        self._data = None
+        return pixels
+
+
+def _mul_un8(a, b):
+    t = a * b + 0x80
+    return ((t >> 8) + t) >> 8
+
+
+def _div_un8(a, b):
+    return (a * 0xff + b // 2) // b
+
+
+def _div_trunc(a, b):
+    # C-like integer division that rounds towards zero
+    return np.sign(a) * (np.abs(a) // b)
+
+
+def _lum(c):
+    return 0.3 * c[:, 0] + 0.59 * c[:, 1] + 0.11 * c[:, 2]
+
+
+def _sat(c):
+    return c.max(axis=1) - c.min(axis=1)
+
+
+def _clip_colour(c):
+    l = _lum(c)[:, np.newaxis]
+    n = c.min(axis=1)[:, np.newaxis]
+    x = c.max(axis=1)[:, np.newaxis]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        c = np.where(n < 0, l + (c - l) * l / (l - n), c)
+        c = np.where(x > 1, l + (c - l) * (1 - l) / (x - l), c)
+    return c
+
+
+def _set_lum(c, l):
+    return _clip_colour(c + (l - _lum(c))[:, np.newaxis])
+
+
+def _set_sat(c, s):
+    order = np.argsort(c, axis=1, kind='stable')
+    cs = np.take_along_axis(c, order, axis=1)
+    mn, mid, mx = cs[:, 0], cs[:, 1], cs[:, 2]
+    has_range = mx > mn
+    res = np.zeros_like(cs)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        res[:, 1] = np.where(has_range, (mid - mn) * s / (mx - mn), 0)
+    res[:, 2] = np.where(has_range, s, 0)
+    out = np.empty_like(c)
+    np.put_along_axis(out, order, res, axis=1)
+    return out
+
+
+def _blend_hard_light(b, s):
+    return np.where(s < 128, _mul_un8(b, s << 1), b + ((s << 1) - 255) - _mul_un8(b, (s << 1) - 255))
+
+
+def _blend_soft_light(b, s):
+    b = b / 255.
+    s = s / 255.
+    d = np.where(b <= 0.25, ((16 * b - 12) * b + 4) * b, np.sqrt(b))
+    r = np.where(s <= 0.5, b - (1. - 2. * s) * b * (1. - b), b + (2. * s - 1.) * (d - b))
+    return (r * 255 + 0.5).astype(np.int32)
+
+
+def _blend_color_dodge(b, s):
+    s = 255 - s
+    res = np.full_like(b, 255)
+    m = b < s
+    res[m] = _div_un8(b[m], s[m])
+    res[b == 0] = 0
+    return res
+
+
+def _blend_color_burn(b, s):
+    b = 255 - b
+    res = np.zeros_like(b)
+    m = b < s
+    res[m] = 255 - _div_un8(b[m], s[m])
+    res[b == 0] = 255
+    return res
+
+
+def _blend_divide(b, s):
+    res = np.full_like(b, 255)
+    m = b < s
+    res[m] = _div_un8(b[m], s[m])
+    res[b == 0] = 0
+    return res
+
+
+def _blend_non_separable(mode, b, s):
+    b = b / 255.
+    s = s / 255.
+    if mode == BLEND_HUE:
+        c = _set_lum(_set_sat(s, _sat(b)), _lum(b))
+    elif mode == BLEND_SATURATION:
+        c = _set_lum(_set_sat(b, _sat(s)), _lum(b))
+    elif mode == BLEND_COLOR:
+        c = _set_lum(s, _lum(b))
+    else:
+        assert mode == BLEND_LUMINOSITY
+        c = _set_lum(b, _lum(s))
+    return (255. * c).astype(np.int32)
+
+
+SEPARABLE_BLENDERS = {
+    BLEND_MULTIPLY: _mul_un8,
+    BLEND_SCREEN: lambda b, s: b + s - _mul_un8(b, s),
+    BLEND_OVERLAY: lambda b, s: _blend_hard_light(s, b),
+    BLEND_DARKEN: np.minimum,
+    BLEND_LIGHTEN: np.maximum,
+    BLEND_COLOR_DODGE: _blend_color_dodge,
+    BLEND_COLOR_BURN: _blend_color_burn,
+    BLEND_HARD_LIGHT: _blend_hard_light,
+    BLEND_SOFT_LIGHT: _blend_soft_light,
+    BLEND_DIFFERENCE: lambda b, s: np.abs(b - s),
+    BLEND_EXCLUSION: lambda b, s: b + s - 2 * _mul_un8(b, s),
+    BLEND_ADDITION: lambda b, s: np.minimum(b + s, 255),
+    BLEND_SUBTRACT: lambda b, s: np.maximum(b - s, 0),
+    BLEND_DIVIDE: _blend_divide,
+}
+
+
+def blend(dst, src, opacity, mode=BLEND_NORMAL):
+    # Composes src over dst in place using aseprite blender of the given mode.
+    # dst and src are (h, w, 4) RGBA uint8 arrays of the same shape.
+    sa = src[:, :, 3]
+    src_mask = sa > 0
+    if opacity == 0 or not src_mask.any():
+        return
+
+    # Only process pixels that have some alpha in the source
+    d = dst[src_mask].astype(np.int32)
+    s = src[src_mask].astype(np.int32)
+
+    if mode != BLEND_NORMAL:
+        if mode in SEPARABLE_BLENDERS:
+            s[:, :3] = SEPARABLE_BLENDERS[mode](d[:, :3], s[:, :3])
+        elif BLEND_HUE <= mode <= BLEND_LUMINOSITY:
+            s[:, :3] = _blend_non_separable(mode, d[:, :3], s[:, :3])
+        else:
+            raise ValueError(f'Unknown aseprite blend mode {mode}')
+
+    ba = d[:, 3]
+    sa = _mul_un8(s[:, 3], opacity)
+    res = d
+    empty = (ba == 0)
+    res[empty, :3] = s[empty, :3]
+    res[empty, 3] = sa[empty]
+
+    m = ~empty
+    ra = sa[m] + ba[m] - _mul_un8(ba[m], sa[m])
+    res[m, :3] = d[m, :3] + _div_trunc((s[m, :3] - d[m, :3]) * sa[m, np.newaxis], ra[:, np.newaxis])
+    res[m, 3] = ra
+
+    dst[src_mask] = res
+
+
+def match_layer_path(layer_filter, path, exclude):
+    # Same as match_path in aseprite cli_processor.cpp and ASE_EXPORT_SCRIPT in lib.py
+    if layer_filter == path:
+        return True
+    a, b = layer_filter.split('/'), path.split('/')
+    for fa, fb in zip(a, b):
+        if fa != fb and fa != '*':
+            return False
+    # Ignoring a layer hides its children, including it also shows its parents
+    if exclude:
+        return len(a) <= len(b)
+    return True
+
+
+# Returns (number of frames, width, height) reading only the file header
+def read_header(path):
+    with open(path, 'rb') as f:
+        data = f.read(12)
+    if len(data) < 12:
+        raise ValueError(f'{path} is not an aseprite file')
+    _size, magic, num_frames, width, height = struct.unpack('<IHHHH', data)
+    if magic != HEADER_MAGIC:
+        raise ValueError(f'{path} is not an aseprite file')
+    return num_frames, width, height
+
+
+# Sort key of the draw list items, cels are moved by their z-index
+def _draw_order(item):
+    layer, cel = item
+    if layer.is_group:
+        return (layer.index, 0)
+    return (layer.index + cel.z_index, cel.z_index)
+
+
+# Identifies what is drawn by a draw list item (linked cels in different frames are the same)
+def _draw_key(layer, cel):
+    if layer.is_group:
+        return (layer.index, tuple(_draw_key(*x) for x in cel))
+    return (layer.index, id(cel))
+
+
+# Ancestor of the layer at the given child level, None if the layer itself is at that level
+def _get_ancestor(layer, level):
+    if layer.child_level <= level:
+        return None
+    for a in layer.ancestors():
+        if a.child_level == level:
+            return a
+
+
+class AseFile:
+    def __init__(self, path):
+        self.path = path
+        self.layers = []
+        self.frames = []  # list of {layer index: AseCel}
+        self.palette = np.zeros((256, 4), dtype=np.uint8)
+        with open(path, 'rb') as f:
+            self._parse(f.read())
+
+    def _parse(self, data):
+        (_size, magic, num_frames, self.width, self.height, self.depth, self.flags,
+         ) = struct.unpack_from('<IHHHHHI', data, 0)
+        if magic != HEADER_MAGIC:
+            raise ValueError(f'{self.path} is not an aseprite file')
+        if self.depth not in (8, 16, 32):
+            raise ValueError(f'Unsupported colour depth {self.depth} in {self.path}')
+        self.transparent_index = data[28]
+        self._layer_opacity_valid = bool(self.flags & HEADER_LAYER_OPACITY_VALID)
+        # Files from older aseprite versions have no group opacity (it's stored as 0) so their layers
+        # are composited directly on the image regardless of groups
+        self.compose_groups = bool(self.flags & HEADER_GROUP_OPACITY_VALID)
+
+        parents = []
+        pos = 128
+        for frame in range(num_frames):
+            frame_size, magic, old_chunks, _duration, new_chunks = struct.unpack_from('<IHHH2xI', data, pos)
+            if magic != FRAME_MAGIC:
+                raise ValueError(f'Invalid frame {frame + 1} header in {self.path}')
+            cels = {}
+            chunk_pos = pos + 16
+            for _ in range(new_chunks or old_chunks):
+                chunk_size, chunk_type = struct.unpack_from('<IH', data, chunk_pos)
+                chunk = data[chunk_pos + 6: chunk_pos + chunk_size]
+                if chunk_type == CHUNK_LAYER:
+                    self._parse_layer(chunk, parents)
+                elif chunk_type == CHUNK_CEL:
+                    cel = self._parse_cel(chunk, cels)
+                    cels[cel.layer_index] = cel
+                elif chunk_type == CHUNK_PALETTE:
+                    self._parse_palette(chunk)
+                elif chunk_type in (CHUNK_OLD_PALETTE, CHUNK_OLD_PALETTE_2):
+                    self._parse_old_palette(chunk, chunk_type)
+                chunk_pos += chunk_size
+            self.frames.append(cels)
+            pos += frame_size
+
+    def _parse_layer(self, chunk, parents):
+        flags, layer_type, child_level, _w, _h, blend_mode, opacity, name_len = struct.unpack_from('<HHHHHHB3xH', chunk, 0)
+        name = chunk[18: 18 + name_len].decode('utf-8')
+        if not self._layer_opacity_valid:
+            opacity = 255
+        del parents[child_level:]
+        parent = parents[-1] if parents else None
+        layer = AseLayer(len(self.layers), name, flags, layer_type, child_level, blend_mode, opacity, parent)
+        self.layers.append(layer)
+        parents.append(layer)
+
+    def _parse_cel(self, chunk, cels):
+        layer_index, x, y, opacity, cel_type, z_index = struct.unpack_from('<HhhBHh5x', chunk, 0)
+        if cel_type == CEL_LINKED:
+            linked_frame, = struct.unpack_from('<H', chunk, 16)
+            return self.frames[linked_frame][layer_index]
+        if cel_type == CEL_COMPRESSED_TILEMAP:
+            raise ValueError(f'Tilemap cels are not supported ({self.path})')
+        width, height = struct.unpack_from('<HH', chunk, 16)
+        return AseCel(layer_index, x, y, opacity, z_index, width, height, chunk[20:], cel_type == CEL_COMPRESSED)
+
+    def _parse_palette(self, chunk):
+        _size, first, last = struct.unpack_from('<III', chunk, 0)
+        pos = 20
+        for i in range(first, last + 1):
+            flags, = struct.unpack_from('<H', chunk, pos)
+            self.palette[i] = tuple(chunk[pos + 2: pos + 6])
+            pos += 6
+            if flags & 1:
+                name_len, = struct.unpack_from('<H', chunk, pos)
+                pos += 2 + name_len
+
+    def _parse_old_palette(self, chunk, chunk_type):
+        num_packets, = struct.unpack_from('<H', chunk, 0)
+        pos = 2
+        index = 0
+        for _ in range(num_packets):
+            index += chunk[pos]
+            count = chunk[pos + 1] or 256
+            pos += 2
+            for i in range(count):
+                c = np.frombuffer(chunk, dtype=np.uint8, count=3, offset=pos + i * 3).astype(np.uint16)
+                if chunk_type == CHUNK_OLD_PALETTE_2:
+                    c = c * 255 // 63  # 0..63 colour range
+                self.palette[index + i, :3] = c
+                self.palette[index + i, 3] = 255
+            index += count
+            pos += count * 3
+
+    def select_layers(self, layers=(), ignore_layers=()):
+        # Returns image layers that are rendered for the given --layer/--ignore-layer filters
+        if layers:
+            shown = {l.index for l in self.layers if any(match_layer_path(f, l.path, False) for f in layers)}
+        else:
+            shown = {l.index for l in self.layers if l.is_visible}
+            if ignore_layers:
+                shown -= {l.index for l in self.layers if any(match_layer_path(f, l.path, True) for f in ignore_layers)}
+
+        res = []
+        for l in self.layers:
+            if l.is_group or l.flags & LAYER_REFERENCE:
+                continue
+            if l.index in shown and all(p.index in shown for p in l.ancestors()):
+                res.append(l)
+        return res
+
+    def _get_draw_list(self, frame, layers, ignore_layers):
+        # Returns list of (layer, cel) to draw in order, when groups are composited separately
+        # their layers are replaced with (group, draw list of the group)
+        cels = self.frames[frame - 1]
+        res = []
+        for l in self.select_layers(layers, ignore_layers):
+            cel = cels.get(l.index)
+            if cel is not None:
+                res.append((l, cel))
+        if self.compose_groups:
+            return self._nest_draw_list(res, 0)
+        res.sort(key=_draw_order)
+        return res
+
+    def _nest_draw_list(self, items, level):
+        # items are (layer, cel) in the layer order, all in the same group at child level `level`
+        res = []
+        i = 0
+        while i < len(items):
+            group = _get_ancestor(items[i][0], level)
+            if group is None:
+                res.append(items[i])
+                i += 1
+                continue
+            j = i + 1
+            while j < len(items) and _get_ancestor(items[j][0], level) is group:
+                j += 1
+            res.append((group, self._nest_draw_list(items[i:j], level + 1)))
+            i = j
+        res.sort(key=_draw_order)
+        return res
+
+    def _draw(self, img, layer, cel):
+        if layer.is_group:
+            group_img = np.zeros_like(img)
+            for item in cel:
+                self._draw(group_img, *item)
+            blend(img, group_img, layer.opacity, layer.blend_mode)
+            return
+
+        x0, y0 = max(cel.x, 0), max(cel.y, 0)
+        x1, y1 = min(cel.x + cel.width, self.width), min(cel.y + cel.height, self.height)
+        if x0 >= x1 or y0 >= y1:
+            return
+        pixels = cel.get_pixels(self)[y0 - cel.y: y1 - cel.y, x0 - cel.x: x1 - cel.x]
+        opacity = _mul_un8(cel.opacity, layer.opacity)
+        blend(img[y0: y1, x0: x1], pixels, opacity, layer.blend_mode)
+
+    def render(self, frame=1, layers=(), ignore_layers=()):
+        # Renders 1-based frame with the given layer filters into (h, w, 4) RGBA uint8 array
+        key = (frame, tuple(layers), tuple(ignore_layers))
+        return self.render_many((key,))[key]
+
+    def render_many(self, requests):
+        # Renders a list of (frame, layers, ignore_layers) requests. Requests are processed
+        # in the order of their layers so the result of compositing layers they have in common
+        # is reused instead of drawing it again (linked cels in different frames count as the same).
+        draw_lists = {r: self._get_draw_list(*r) for r in requests}
+        draw_keys = {r: tuple(_draw_key(*x) for x in dl) for r, dl in draw_lists.items()}
+        order = sorted(draw_lists.keys(), key=lambda r: draw_keys[r])
+
+        def common_prefix(a, b):
+            n = 0
+            for x, y in zip(a, b):
+                if x != y:
+                    break
+                n += 1
+            return n
+
+        # lcp[i] - how many layers requests i and i + 1 have in common
+        lcp = [common_prefix(draw_keys[a], draw_keys[b]) for a, b in zip(order, order[1:])]
+
+        res = {}
+        checkpoints = [(0, np.zeros((self.height, self.width, 4), dtype=np.uint8))]
+        prev_lcp = 0
+        for i, r in enumerate(order):
+            # Checkpoints deeper than the common part with the previous request don't match this one
+            while checkpoints[-1][0] > prev_lcp:
+                checkpoints.pop()
+            depth, img = checkpoints[-1]
+            img = img.copy()
+            needed = set(lcp[i:])
+            draw_list = draw_lists[r]
+            for d in range(depth, len(draw_list)):
+                if d > depth and d in needed:
+                    checkpoints.append((d, img.copy()))
+                self._draw(img, *draw_list[d])
+            if len(draw_list) > depth and len(draw_list) in needed:
+                checkpoints.append((len(draw_list), img))
+            res[r] = img
+            prev_lcp = lcp[i] if i < len(lcp) else 0
+
+        return res
@@ -1,5 +1,11 @@
+import time
+START_TIME = time.perf_counter()  # Before the imports as they take most of the start-up time
+
+import argparse
+import functools
 import itertools
 import pathlib
+import sys
 from collections import defaultdict
 from typing import Optional, Union
 
@@ -13,6 +19,181 @@ import lib
 cc = lib.MagentaToCC
 struct = lib.MagentaToStruct
 
+
+# ------------------------------ Command Line Interface ------------------------------
+
+# Prints how long it took to get to the command handler, to keep an eye on the start-up time
+def report_startup(handler):
+    @functools.wraps(handler)
+    def wrapper(g, grf_file, args):
+        print(f'Start-up time {time.perf_counter() - START_TIME:.02f} sec')
+        return handler(g, grf_file, args)
+    return wrapper
+
+
+def cmd_debugcc_add_args(parser):
+    parser.add_argument('ase_file', help='Aseprite image file')
+    parser.add_argument('--horizontal', action='store_true', help='Stack resulting images horizontally')
+    parser.add_argument('--layer', help='Name of the layer in aseprite file to export')
+    parser.add_argument('--frame', help='Frame number to export', type=int, default=1)
+
+
+@report_startup
+def cmd_debugcc_handler(g, grf_file, args):
+    ase = lib.AseImageFile(args.ase_file)
+    sprite = lib.FileSprite(ase, 0, 0, None, None, name=args.ase_file, layers=args.layer, frame=args.frame)
+    sprite = cc(sprite)
+    lib.debug_cc_recolour([sprite], horizontal=args.horizontal)
+
+
+def cmd_debugstruct_add_args(parser):
+    parser.add_argument('ase_file', help='Aseprite image file')
+    parser.add_argument('--horizontal', action='store_true', help='Stack resulting images horizontally')
+    parser.add_argument('--layer', help='Name of the layer in aseprite file to export')
+    parser.add_argument('--frame', help='Frame number to export', type=int, default=1)
+
+
+@report_startup
+def cmd_debugstruct_handler(g, grf_file, args):
+    ase = lib.AseImageFile(args.ase_file)
+    sprite = lib.FileSprite(ase, 0, 0, None, None, name=args.ase_file, layers=args.layer, frame=args.frame)
+    sprite = struct(sprite)
+    lib.debug_struct_recolour([sprite], horizontal=args.horizontal)
+
+
+def cmd_debuglight_add_args(parser):
+    parser.add_argument('ase_file', help='Aseprite image file')
+    parser.add_argument('--horizontal', action='store_true', help='Stack resulting images horizontally')
+    parser.add_argument('--fps', help='Frames per second of the animation', type=float, default=4)
+    parser.add_argument('--output', help='Animated image to save, .gif, .png or .apng (default: <ase_file name>_light.gif)')
+
+
+@report_startup
+def cmd_debuglight_handler(g, grf_file, args):
+    in_file = args.ase_file
+    ase = lib.AseImageFile(in_file)
+    aseo = lib.AseImageFile(in_file)
+    sprite = lib.FileSprite(ase, 0, 0, None, None, name=f'{in_file}_image', ignore_layers='Light order')
+    order = lib.FileSprite(aseo, 0, 0, None, None, name=f'{in_file}_order', layers='Light order')
+    output = args.output or f'{pathlib.Path(in_file).stem}_light.gif'
+    lib.debug_light_cycle([lib.MagentaToLight(sprite, order)], output, fps=args.fps, horizontal=args.horizontal)
+
+
+def cmd_debuganim_add_args(parser):
+    parser.add_argument('ase_file', help='Aseprite image file with the ANIMATED layer')
+    parser.add_argument('--frame', help='Frame number to export', type=int, default=1)
+    parser.add_argument('--fps', help='Frames per second of the animation (one frame per game tick)', type=float, default=30)
+    parser.add_argument('--toyland', help='Use toyland water colours', action='store_true')
+    parser.add_argument('--output', help='Animated image to save, .gif, .png or .apng (default: <ase_file name>_anim.gif)')
+
+
+@report_startup
+def cmd_debuganim_handler(g, grf_file, args):
+    in_file = args.ase_file
+    ase = lib.AseImageFile(in_file)
+    sprite = lib.FileSprite(ase, 0, 0, None, None, name=f'{in_file}_rgb', ignore_layers='ANIMATED', frame=args.frame)
+    anim = lib.FileSprite(ase, 0, 0, None, None, name=f'{in_file}_anim', layers='ANIMATED', frame=args.frame)
+    output = args.output or f'{pathlib.Path(in_file).stem}_anim.gif'
+    lib.debug_palette_animation([lib.MagentaAndMask(sprite, anim)], output, fps=args.fps, toyland=args.toyland)
+
+
+def cmd_checkase_add_args(parser):
+    parser.add_argument('ase_files', nargs='*', help='Aseprite files to check (default: all files used in the build)')
+
+
+@report_startup
+def cmd_checkase_handler(g, grf_file, args):
+    for s in lib.iter_registered_sprites():
+        s.prepare_files()
+    files = [f for f in lib.ASE_IDX.values() if f._kw_requested]
+    if args.ase_files:
+        paths = {pathlib.Path(p).resolve() for p in args.ase_files}
+        files = [f for f in files if pathlib.Path(f.path).resolve() in paths]
+    if not lib.compare_ase_decoders(files):
+        sys.exit(1)
+
+
+def parse_lib_args():
+    # Options that aren't specific to grf-py commands, remove them before passing the rest to grf.main
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('-j', '--jobs', type=int, help='Number of parallel processes for aseprite export (default: number of CPUs)')
+    parser.add_argument('--no-ase-cache', action='store_true', help='Don\'t use the cache of exported aseprite images')
+    parser.add_argument('--ase-decoder', choices=('cli', 'native'), help='Decode aseprite files with aseprite executable (cli) or built-in reader (native), overrides ASEPRITE_DECODER')
+    args, rest = parser.parse_known_args()
+    sys.argv[1:] = rest
+    lib.ASE_JOBS = args.jobs
+    if args.ase_decoder is not None:
+        lib.ASE_DECODER = args.ase_decoder
+    if args.no_ase_cache:
+        lib.ASE_CACHE = None
+
+
+COMMANDS = [{
+    'name': 'debugcc',
+    'help': 'Takes an image and produces another image with all variants of CC recolour',
+    'add_args': cmd_debugcc_add_args,
+    'handler': cmd_debugcc_handler,
+}, {
+    'name': 'debugstruct',
+    'help': 'Takes an image and produces another image with all variants of structure recolour',
+    'add_args': cmd_debugstruct_add_args,
+    'handler': cmd_debugstruct_handler,
+}, {
+    'name': 'debuglight',
+    'help': 'Takes an image and produces animated gif with light cycle',
+    'add_args': cmd_debuglight_add_args,
+    'handler': cmd_debuglight_handler,
+}, {
+    'name': 'debuganim',
+    'help': 'Takes an image with ANIMATED layer and produces animated gif with palette animation (water, fire, lights)',
+    'add_args': cmd_debuganim_add_args,
+    'handler': cmd_debuganim_handler,
+}, {
+    'name': 'checkase',
+    'help': 'Compares images decoded by the native aseprite reader with the aseprite executable output',
+    'add_args': cmd_checkase_add_args,
+    'handler': cmd_checkase_handler,
+}]
+
+# Commands that only preview the given file and don't need the sprites of the grf
+PREVIEW_COMMANDS = ('debugcc', 'debugstruct', 'debuglight', 'debuganim')
+
+# Commands grf.main adds itself
+GRF_COMMANDS = ('build', 'watch', 'init_id_map')
+
+
+# Command grf.main will run, found with a parser of the same structure (arguments of the commands are
+# left to grf.main). None if there is no command or the arguments are invalid, grf.main reports it.
+def get_command():
+    parser = argparse.ArgumentParser(add_help=False, exit_on_error=False)
+    subparsers = parser.add_subparsers(dest='command')
+    for name in GRF_COMMANDS + tuple(c['name'] for c in COMMANDS):
+        subparsers.add_parser(name, add_help=False)
+    try:
+        args, _ = parser.parse_known_args()
+    except argparse.ArgumentError:
+        return None
+    return args.command
+
+
+def make_newgrf():
+    return lib.NewGRF(
+        grfid=b'TODO',
+        name='BonkyGFX',
+        description='BonkyGFX',
+        min_compatible_version=0,
+        version=0,
+    )
+
+
+parse_lib_args()
+
+# Run preview commands before registering all the sprites below
+if get_command() in PREVIEW_COMMANDS:
+    grf.main(make_newgrf(), 'bonkygfx.grf', commands=COMMANDS)
+    sys.exit(0)
+
+
 def animated(name, grid, *args, layers=None, ignore_layers=None, **kw):
     grid_args = {}
     if isinstance(grid, lib.BaseGrid):
@@ -54,13 +235,7 @@ ICON_DIR = SPRITE_DIR / 'icons'
 FACES_DIR = SPRITE_DIR / 'faces'
 
 
-g = grf.NewGRF(
-    grfid=b'TODO',
-    name='BonkyGFX',
-    description='BonkyGFX',
-    min_compatible_version=0,
-    version=0,
-)
+g = make_newgrf()
 
 # TODO (I commented this part out as it was often giving me all vehicles even though the paremeter was set to false)
 # g.add_bool_parameter(
@@ -88,7 +263,7 @@ g = grf.NewGRF(
 # TODO Animated "Zzzz" waiting cursor if possible, otherwise use better colors than anim-palette
 # TODO compositing icons onto cursor
 # TODO sprite width is 104/2=52 to be able to add wider icons such as station
-@lib.template(grf.FileSprite)
+@lib.template(lib.FileSprite)
 def tmpl_cursors(func, z, frame):
     grid = lib.RectGrid(func=func, width=48 * z, height=32 * z, padding=z)
     grid.set_default(frame=frame)
@@ -101,7 +276,7 @@ for i in range(2):
 
 # ------------------------------ Ground Tiles ------------------------------
 
-@lib.template(grf.FileSprite)
+@lib.template(lib.FileSprite)
 def tmpl_groundtiles(func, z, frame=1, above=0):
     grid = lib.FlexGrid(func=func, padding=z, start=(0, 0), add_yofs=-(z // 2) - above * z, add_height=above * z)
     grid.set_default(width=64 * z, height=32 * z - 1, xofs=-31 * z, yofs=0, frame=frame)
@@ -134,7 +309,7 @@ def tmpl_groundtiles(func, z, frame=1, above=0):
 
 
 def tmpl_groundtiles_extra(name, paths, zoom, *args):
-    @lib.template(grf.FileSprite)
+    @lib.template(lib.FileSprite)
     def tmpl_extra(func, z, frame=1):
         assert z == 2
         grid = lib.FlexGrid(func=func, padding=z, start=(1235 * z, 0), add_yofs=-(z // 2))
@@ -203,7 +378,7 @@ general_concrete[0].replace_old(4676)  # Toyland extra concrete
 general_concrete[0].replace_old(2022, climate=TOYLAND)  # Some toyland industries use coal mine dirt tile, replace it with concrete
 
 
-@lib.template(grf.FileSprite)
+@lib.template(lib.FileSprite)
 def tmpl_foundations(func, z, frame=1):
     grid = lib.RectGrid(func=func, width=64 * z, height=41 * z - 1, padding=z, add_yofs=-(z // 2))
     # TODO figure out why it glitches with crop
@@ -242,7 +417,7 @@ foundations[:14].replace_old(990)
 foundations[14:].replace_new(0x06, 0)
 
 
-@lib.template(grf.FileSprite)
+@lib.template(lib.FileSprite)
 def tmpl_water_slopes(func, z, frame=1, above=0):
     grid = lib.FlexGrid(func=func, padding=z, start=(0, 0), add_yofs=-(z // 2) - above * z, add_height=above * z)
     grid.set_default(width=64 * z, height=32 * z - 1, xofs=-31 * z, yofs=0, frame=frame)
@@ -262,7 +437,7 @@ def tmpl_water_slopes(func, z, frame=1, above=0):
 
 # ------------------------------ Airport Tiles ------------------------------
 
-@lib.template(grf.FileSprite)
+@lib.template(lib.FileSprite)
 def tmpl_airport_tiles(func, z):
     grid = lib.FlexGrid(func=func, padding=2, add_yofs=-(z // 2))
     grid.set_default(width=64 * z, height=32 * z - 1, xofs=-31 * z, yofs=0)
@@ -320,7 +495,7 @@ lib.SpriteCollection('tile_selection') \
 
 
 def tree(name, sprite_id, path, **kw):
-    @lib.template(grf.FileSprite)
+    @lib.template(lib.FileSprite)
     def tmpl(func, z, frame):
         # Variation of OpenGFX1 template with 2x zoom and only one tree
         return [
@@ -608,7 +783,7 @@ engine_sheet('rail_engines_arctic.ase', (
 # ------------------------------ Water Vehicles ------------------------------
 
 
-@lib.template(grf.FileSprite)
+@lib.template(lib.FileSprite)
 def tmpl_water_ships(func, z):
     grid = lib.RectGrid(func=func, width=96 * z, height=(75 * z)+1, padding=z)
     grid.set_default(xofs=-20 * z, yofs=-39 * z) # TODO not great
@@ -658,7 +833,7 @@ water_ships = lib.SpriteCollection('water_ships') \
 
 # ------------------------------ Air Vehicles ------------------------------
 
-@lib.template(grf.FileSprite)
+@lib.template(lib.FileSprite)
 def tmpl_air_planes(func, z):
     grid = lib.RectGrid(func=func, width=80 * z, height=(60 * z)+1, padding=z)
     grid.set_default(xofs=-40 * z, yofs=-30 * z)
@@ -760,7 +935,7 @@ air_planes[64:72].replace_old(3797) # big
 
 # ------------------------------ Road Infrastructure ------------------------------
 
-@lib.template(grf.FileSprite)
+@lib.template(lib.FileSprite)
 def tmpl_roadtiles(func, z, frame, **kw):
     grid = lib.FlexGrid(func=func, padding=2, add_yofs=-(z // 2))
     grid.set_default(frame=frame, width=64 * z, height=32 * z - 1, xofs=-31 * z, yofs=0, ignore_layers='RAMPS/*', **kw)
@@ -808,7 +983,7 @@ desert_and_snow_road.unspecify(climate=ARCTIC).replace_old(1351)  # default spri
 desert_and_snow_road.replace_old(1351, climate=TROPICAL)  # in tropic - desert road
 
 
-@lib.template(grf.FileSprite)
+@lib.template(lib.FileSprite)
 def tmpl_road_ramps(func, z, **kw):
     assert z == 2
     grid = lib.RectGrid(func=func, width=64 * z, height=40 * z - 1, padding=z)
@@ -939,21 +1114,21 @@ bus_stops[16:].replace_new(0x11, 0)
 
 # ------------------------------ Rail infrastructure ------------------------------
 
-@lib.template(grf.FileSprite)
+@lib.template(lib.FileSprite)
 def tmpl_rails(func, z, layers, frame):
     grid = lib.FlexGrid(func=func, padding=2, add_yofs=-(z // 2))
     grid.set_default(width=64 * z, height = 32 * z - 1, xofs=-31 * z, yofs=0, layers=layers, frame=frame)
     return list(map(grid, ('y', 'x', 'n', 's', 'e', 'w', 'cross')))
 
 
-@lib.template(grf.FileSprite)
+@lib.template(lib.FileSprite)
 def tmpl_ballast(func, z, layers, frame):
     grid = lib.FlexGrid(func=func, padding=2, start=(910, 0), add_yofs=-(z // 2))
     grid.set_default(width=64 * z, height = 32 * z - 1, xofs=-31 * z, yofs=0, layers=layers, frame=frame)
     return list(map(grid, ('ground_tne', 'ground_tsw', 'ground_tnw', 'ground_tse', 'ground_x')))
 
 
-@lib.template(grf.FileSprite)
+@lib.template(lib.FileSprite)
 def tmpl_slope_rails(func, z, layers, frame):
     grid = lib.FlexGrid(func=func, padding=2, start=(1560, 0), add_yofs=-(z // 2))
     grid.set_default(width=64 * z, xofs=-31 * z, yofs=0, layers=layers, frame=frame)
@@ -1005,7 +1180,7 @@ replace_rail_type('maglev', 3, 1169)
 
 
 
-@lib.template(grf.FileSprite)
+@lib.template(lib.FileSprite)
 def tmpl_rail_fences(func, z):
     assert z == 2  # xofs/yofs are fixed
     relative = 2
@@ -1029,7 +1204,7 @@ lib.SpriteCollection('rail_fence') \
     .replace_old(1301)
 
 
-@lib.template(grf.FileSprite)
+@lib.template(lib.FileSprite)
 def tmpl_signals(func, z, frame_red, frame_green):
     grid = lib.RectGrid(func=func, width=22, height=30, padding=1)
     grid.set_default(xofs=-7, yofs=-28)
@@ -1106,7 +1281,7 @@ lib.SpriteCollection('maglev_depot') \
 
 # ------------------------------ Water ------------------------------
 
-@lib.template(grf.FileSprite)
+@lib.template(lib.FileSprite)
 def tmpl_water_full(func, z):
     x = y = 0
     grid = lib.FlexGrid(func=func, padding=z, start=(0, 0), add_yofs=-(z // 2))
@@ -1146,7 +1321,7 @@ water.compose_on(ground, WATER_COMPOSITION).replace_new(0x0d, 0)
 
 # ------------------------------ Towns ------------------------------
 
-@lib.template(grf.FileSprite)
+@lib.template(lib.FileSprite)
 def tmpl_street_lights(func, z, frame):
     grid = lib.HouseGrid(func=func, height=49, z=z)
     grid.set_default(frame=frame)
@@ -1165,7 +1340,7 @@ lib.SpriteCollection('street_lights') \
     .replace_old(1406)
 
 
-@lib.template(grf.FileSprite)
+@lib.template(lib.FileSprite)
 def tmpl_statues(func, z):
     grid = lib.HouseGrid(func=func, height=75, z=z)
     return [
@@ -1209,7 +1384,7 @@ def house(name, sprite_id, grid_pos, *, stages, ground_last=False, bb=(0, 0), re
     pattern.reverse()
     compose_pattern.reverse()
 
-    @lib.template(grf.FileSprite)
+    @lib.template(lib.FileSprite)
     def tmpl(func, z):
         tall_grid = lib.HouseGrid(func=func, offset=(1169, 0), height=201, z=2, padding=3)
         grid = lib.HouseGrid(func=func, height=100, z=z)
@@ -1261,7 +1436,7 @@ def house(name, sprite_id, grid_pos, *, stages, ground_last=False, bb=(0, 0), re
 
 
 def house1x2(name, sprite_id, *, offset):
-    @lib.template(grf.FileSprite)
+    @lib.template(lib.FileSprite)
     def tmpl(func, z):
         # TODO uses common construction sprites for now
         construction_grid = lib.HouseGrid(func=func, height=100, z=z)
@@ -1283,7 +1458,7 @@ def house1x2(name, sprite_id, *, offset):
 
 
 def house2x2(name, sprite_id, *, offset):
-    @lib.template(grf.FileSprite)
+    @lib.template(lib.FileSprite)
     def tmpl(func, z):
         grid = lib.BuildingSlicesGrid(func=func, offset=offset, height=100, z=z, tile_size=(2, 2))
         building_layers = ('BUILDING', 'Spriteborder')
@@ -1308,7 +1483,7 @@ def house2x2(name, sprite_id, *, offset):
 
 
 def mall(name, sprite_id, *, offset):
-    @lib.template(grf.FileSprite)
+    @lib.template(lib.FileSprite)
     def tmpl(func, z):
         # TODO uses common construction sprites for now
         construction_grid = lib.HouseGrid(func=func, height=100, z=z)
@@ -1403,7 +1578,7 @@ house('cinema_4405', 4404, (8, 3), stages=(1, 1), animated=True)
 mall('mall_4417', 4406, offset=(780, 812))
 
 
-@lib.template(grf.FileSprite)
+@lib.template(lib.FileSprite)
 def tmpl_houses_toyland(func, z):
     grid = lib.HouseGrid(func=func, height=100, z=z)
     grid.set_default(layers=('BUILDING/*', 'Spriteborder'))
@@ -1485,7 +1660,7 @@ houses_toyland[:48].replace_old(4627)
 houses_toyland[48:51].replace_old(4695)
 
 
-@lib.template(grf.FileSprite)
+@lib.template(lib.FileSprite)
 def tmpl_transmitter(func, z):
     grid = lib.HouseGrid(func=func, height=123, z=z)
     grid.set_default(layers=('BUILDING/*', 'Spriteborder'))
@@ -1497,7 +1672,7 @@ lib.SpriteCollection('transmitter') \
     .replace_old(2601)
 
 
-@lib.template(grf.FileSprite)
+@lib.template(lib.FileSprite)
 def tmpl_lighthouse(func, z):
     grid = lib.HouseGrid(func=func, height=123, z=z)
     grid.set_default(layers=('BUILDING/*', 'Spriteborder'))
@@ -1509,7 +1684,7 @@ lib.SpriteCollection('lighthouse') \
     .replace_old(2602)
 
 
-@lib.template(grf.FileSprite)
+@lib.template(lib.FileSprite)
 def tmpl_town_tree(func, z, x):
     grid = lib.RectGrid(func=func, width=19 * z, height=41 * z, padding=z)
     return [grid('', (x, 0), xofs=-9 * z, yofs=-37 * z)]
@@ -1524,7 +1699,7 @@ lib.SpriteCollection('town_tree') \
 
 # ------------------------------ Industries ------------------------------
 
-@lib.template(grf.FileSprite)
+@lib.template(lib.FileSprite)
 def tmpl_coal_mine(func, z):
     # bb values are (sx, sy) from https://github.com/OpenTTD/OpenTTD/blob/master/src/table/industry_land.h
     grid = lib.HouseGrid(func=func, height=75, z=z)
@@ -1552,7 +1727,7 @@ lib.SpriteCollection('coal_mine') \
     .replace_old(2011)
 
 
-@lib.template(grf.FileSprite)
+@lib.template(lib.FileSprite)
 def tmpl_power_plant(func, z):
     # bb values are (sx, sy) from https://github.com/OpenTTD/OpenTTD/blob/master/src/table/industry_land.h
     grid = lib.HouseGrid(func=func, height=75, z=z)
@@ -1581,7 +1756,7 @@ lib.SpriteCollection('power_plant') \
     .replace_old(2045)
 
 
-@lib.template(grf.FileSprite)
+@lib.template(lib.FileSprite)
 def tmpl_chimney_smoke(func, z):
     return [
         func(f'{i}', x=2, y=2, w=128, h=128, xofs=0, yofs=-128 - (z // 2), frame=i + 1)
@@ -1593,7 +1768,7 @@ lib.SpriteCollection('chimney_smoke') \
     .replace_old(3701)
 
 
-@lib.template(grf.FileSprite)
+@lib.template(lib.FileSprite)
 def tmpl_sawmill(func, z):
     # bb values are (sx, sy) from https://github.com/OpenTTD/OpenTTD/blob/master/src/table/industry_land.h
     grid = lib.HouseGrid(func=func, height=75, z=z)
@@ -1617,7 +1792,7 @@ lib.SpriteCollection('sawmill') \
     .replace_old(2061)
 
 
-@lib.template(grf.FileSprite)
+@lib.template(lib.FileSprite)
 def tmpl_forest(func, z):
     grid = lib.HouseGrid(func=func, height=75, z=z)
     ground_layers = ('TILE/*', 'Spriteborder')
@@ -1639,7 +1814,7 @@ lib.SpriteCollection('forest') \
     .replace_old(2072)
 
 
-@lib.template(grf.FileSprite)
+@lib.template(lib.FileSprite)
 def tmpl_battery_farm(func, z):
     grid = lib.HouseGrid(func=func, height=75, z=z)
     grid.set_default(ignore_layers=('TILE/*', 'Spriteborder'))
@@ -1657,7 +1832,7 @@ lib.SpriteCollection('battery_farm') \
     .replace_old(4686)
 
 
-@lib.template(grf.FileSprite)
+@lib.template(lib.FileSprite)
 def tmpl_plantation(func, z):
     grid = lib.HouseGrid(func=func, height=75, z=z)
     return [
@@ -1672,7 +1847,7 @@ lib.SpriteCollection('plantation') \
     .replace_old(2341)
 
 
-@lib.template(grf.FileSprite)
+@lib.template(lib.FileSprite)
 def tmpl_water_tower(func, z):
     grid = lib.HouseGrid(func=func, height=128, z=z)
     grid.set_default(ignore_layers=('TILE/*', 'Spriteborder'))
@@ -1688,7 +1863,7 @@ lib.SpriteCollection('water_tower') \
     .replace_old(2344)
 
 
-@lib.template(grf.FileSprite)
+@lib.template(lib.FileSprite)
 def tmpl_water_supply(func, z):
     grid = lib.HouseGrid(func=func, height=128, z=z)
     grid.set_default(ignore_layers=('TILE/*', 'Spriteborder'))
@@ -1707,7 +1882,7 @@ lib.SpriteCollection('water_supply') \
     .replace_old(2347)
 
 
-@lib.template(grf.FileSprite)
+@lib.template(lib.FileSprite)
 def tmpl_food_processing_plant(func, z):
     grid = lib.HouseGrid(func=func, height=75, z=z)
     grid.set_default(ignore_layers='TILE/*')
@@ -1732,7 +1907,7 @@ lib.SpriteCollection('food_processing_plant') \
     .replace_old(2188)
 
 
-@lib.template(grf.FileSprite)
+@lib.template(lib.FileSprite)
 def tmpl_paper_mill(func, z):
     grid = lib.HouseGrid(func=func, height=75, z=z)
     ground_layers = 'TILE/*'
@@ -1767,7 +1942,7 @@ lib.SpriteCollection('paper_mill') \
     # 2206 heeft anim
 
 
-@lib.template(grf.FileSprite)
+@lib.template(lib.FileSprite)
 def tmpl_oil_refinery(func, z):
     grid = lib.HouseGrid(func=func, height=128, z=z)
     return [
@@ -1796,7 +1971,7 @@ lib.SpriteCollection('oil_refinery') \
     .replace_old(2078)
 
 
-@lib.template(grf.FileSprite)
+@lib.template(lib.FileSprite)
 def tmpl_oil_rig(func, z):
     assert z == 2
 
@@ -1830,7 +2005,7 @@ lib.SpriteCollection('oil_rig') \
     .replace_old(2096)
 
 
-@lib.template(grf.FileSprite)
+@lib.template(lib.FileSprite)
 def tmpl_farm(func, z):
     ground_layers = ('TILE', 'Spriteborder')
     building_layers = ('BUILDING', 'Spriteborder')
@@ -1861,7 +2036,7 @@ lib.SpriteCollection('farm') \
     .replace_old(2106)
 
 
-@lib.template(grf.FileSprite)
+@lib.template(lib.FileSprite)
 def tmpl_farm_fences(func, z, frame):
     relative = 0
     x_xofs, x_yofs = -59 - relative, 21 - relative // 2
@@ -1882,7 +2057,7 @@ for i in range(6):
         .replace_old(4090 + i * 6)
 
 
-@lib.template(grf.FileSprite)
+@lib.template(lib.FileSprite)
 def tmpl_steel_mill(func, z):
     assert z == 2
     ground_layers = ('TILE/*', 'Spriteborder')
@@ -1932,7 +2107,7 @@ lib.SpriteCollection('steel_mill') \
     .replace_old(2118)
 
 
-@lib.template(grf.FileSprite)
+@lib.template(lib.FileSprite)
 def tmpl_factory(func, z):
     assert z == 2
     ground = func('ground', 2, 2, 256, 201, xofs=-126, yofs=-74, layers=('TILE/*', 'Spriteborder'), frame=3)
@@ -1960,7 +2135,7 @@ lib.SpriteCollection('factory') \
     .replace_old(2146)
 
 
-@lib.template(grf.FileSprite)
+@lib.template(lib.FileSprite)
 def tmpl_printing_works(func, z):
     assert z == 2
     return [
@@ -1986,7 +2161,7 @@ lib.SpriteCollection('printing_works') \
     .replace_old(2161)
 
 
-@lib.template(grf.FileSprite)
+@lib.template(lib.FileSprite)
 def tmpl_candy_factory(func, z):
     grid = lib.BuildingSlicesGrid(func=func, z=z, tile_size=(2, 2), height=100)
     grid.set_default(ignore_layers='TILE/*')
@@ -2009,7 +2184,7 @@ candy_factory = lib.SpriteCollection('candy_factory') \
     .replace_old(4677)
 
 
-@lib.template(grf.FileSprite)
+@lib.template(lib.FileSprite)
 def tmpl_toy_shop(func, z):
     grid = lib.BuildingSlicesGrid(func=func, z=z, tile_size=(2, 2), height=100)
     grid.set_default(ignore_layers='TILE/*')
@@ -2033,7 +2208,7 @@ toy_shop = lib.SpriteCollection('toy_shop') \
 
 
 # TODO Amateur Code
-@lib.template(grf.FileSprite)
+@lib.template(lib.FileSprite)
 def tmpl_lumber_mill(func, z):
     assert z == 2
     return [
@@ -2058,7 +2233,7 @@ lumber_mill = lib.SpriteCollection('lumber_mill') \
     .replace_old(2353)
 
 
-@lib.template(grf.FileSprite)
+@lib.template(lib.FileSprite)
 def tmpl_fizzy_drink_factory(func, z):
     grid = lib.BuildingSlicesGrid(func=func, z=z, tile_size=(2, 2), height=100)
     grid.set_default(ignore_layers='TILE/*')
@@ -2077,7 +2252,7 @@ fizzy_drink_factory = lib.SpriteCollection('fizzy_drink_factory') \
     .replace_old(4737)
 
 
-@lib.template(grf.FileSprite)
+@lib.template(lib.FileSprite)
 def tmpl_toffee_quarry(func, z):
     grid = lib.BuildingSlicesGrid(func=func, offset=(0, 1), z=z, tile_size=(3, 1), height=161)
     grid.set_default(layers='BUILDING', frame=1)
@@ -2095,7 +2270,7 @@ toffee_quarry = lib.SpriteCollection('toffee_quarry') \
     .replace_old(4763)
 
 
-@lib.template(grf.FileSprite)
+@lib.template(lib.FileSprite)
 def tmpl_oil_wells(func, z):
     grid = lib.HouseGrid(func=func, height=75, z=z)
     f = lambda frame: grid('frame{i}', (0, 0), layers=('BUILDING/*', 'Spriteborder'), frame=frame)
@@ -2111,7 +2286,7 @@ oil_wells[0].compose_on(ground[0]).replace_old(2173)
 oil_wells[1:].replace_old(2174)
 
 
-@lib.template(grf.FileSprite)
+@lib.template(lib.FileSprite)
 def tmpl_plastic_fountains(func, z):
     grid = lib.HouseGrid(func=func, height=75, z=z)
     return [
@@ -2128,7 +2303,7 @@ plastic_fountain[:8].compose_on(ground[0]).replace_old(4721)
 plastic_fountain[8:].replace_old(4729)
 
 
-@lib.template(grf.FileSprite)
+@lib.template(lib.FileSprite)
 def tmpl_cola_wells(func, z):
     grid = lib.HouseGrid(func=func, height=75, z=z)
     return [
@@ -2143,7 +2318,7 @@ lib.SpriteCollection('cola_wells') \
     .replace_old(4691)
 
 
-@lib.template(grf.FileSprite)
+@lib.template(lib.FileSprite)
 def tmpl_bank(func, z, frame):
     assert z == 2
     ground = func('ground', 2, 2, 192, 160, xofs=-126, yofs=-65, layers=('TILE/*', 'Spriteborder'), frame=frame)
@@ -2166,7 +2341,7 @@ lib.SpriteCollection('bank') \
     .replace_old(2184)
 
 
-@lib.template(grf.FileSprite)
+@lib.template(lib.FileSprite)
 def tmpl_iron_ore_mine(func, z, frame):
     ground = func('ground', 2, 2, 512, 294, xofs=-254, yofs=-39, frame=frame)
     return [
@@ -2182,7 +2357,7 @@ for i in range(0, 3):
         .replace_old(2293 + 16 * i)
 
 
-@lib.template(grf.FileSprite)
+@lib.template(lib.FileSprite)
 def tmpl_toy_factory(func, z):
     grid = lib.BuildingSlicesGrid(func=func, offset=(0, 1), z=z, tile_size=(4, 2), height=161)
     grid.set_default(layers=('BUILDING', 'BUILDING_INSIDE', 'Spriteborder'))
@@ -2212,7 +2387,7 @@ lib.SpriteCollection('toy_factory') \
     .replace_old(4712)
 
 
-@lib.template(grf.FileSprite)
+@lib.template(lib.FileSprite)
 def tmpl_sugar_mine(func, z):
     grid = lib.BuildingSlicesGrid(func=func, offset=(0, 1), z=z, tile_size=(4, 2), height=161)
     grid.set_default(layers=('BUILDING', 'Spriteborder'))
@@ -2265,7 +2440,7 @@ sugar_mine[4:7].replace_old(4768 + 4)
 sugar_mine[7:].replace_old(4768 + 7)
 
 
-@lib.template(grf.FileSprite)
+@lib.template(lib.FileSprite)
 def tmpl_bubble_generator(func, z):
     grid = lib.BuildingSlicesGrid(func=func, offset=(0, 1), z=z, tile_size=(3, 2), height=161)
     grid.set_default(layers=('BUILDING', 'Spriteborder'))
@@ -2284,7 +2459,7 @@ lib.SpriteCollection('bubble_generator') \
     .replace_old(4743)
 
 
-@lib.template(grf.FileSprite)
+@lib.template(lib.FileSprite)
 def tmpl_bubble_particle(func, z):
     return [
         # func(f'{i}', x=2, y=2, w=44, h=44, xofs=-22, yofs=(-44 - (z // 2))+37, frame=i + 1)
@@ -2301,7 +2476,7 @@ lib.SpriteCollection('bubble_particle') \
 #TODO what category and folder should this sprite be in?
 # ------------------------------ Other? ------------------------------
 
-@lib.template(grf.FileSprite)
+@lib.template(lib.FileSprite)
 def tmpl_land_ownership_sign(func, z):
     grid = lib.RectGrid(func=func, width=20 * z, height=20 * z, padding=z)
     return [cc(grid('', (0, 0), xofs=-9 * z, yofs=-20 * z))]
@@ -2314,7 +2489,7 @@ lib.SpriteCollection('land_ownership_sign') \
 
 # ------------------------------ User Interface ------------------------------
 
-@lib.template(grf.FileSprite)
+@lib.template(lib.FileSprite)
 def tmpl_cargo_icons(func, z, frame):
     grid = lib.RectGrid(func=func, width=11 * z, height=11 * z, padding=z)
     grid.set_default(frame=frame)
@@ -2370,7 +2545,7 @@ ANIMATED_SRPITES = (4085, 4086)  # TODO
 COPY_ICONS = {4993: 5014, 4994: 5015, 4995: 5016, 4996: 5017}
 
 ase = lib.aseidx(ICON_DIR / 'icons.ase')
-func = lambda name, *args, **kw: grf.FileSprite(ase, *args, **kw, name=name, ignore_layers='REF Numbers')
+func = lambda name, *args, **kw: lib.FileSprite(ase, *args, **kw, name=name, ignore_layers='REF Numbers')
 z = 2
 grid = lib.RectGrid(func=func, width=20 * z, height=20 * z, padding=z)
 grid.set_default(zoom=ZOOM_2X)
@@ -2409,7 +2584,7 @@ for i, row in enumerate(ICON_SHEET):
 # ------------------------------ Faces ------------------------------
 
 
-@lib.template(grf.FileSprite)
+@lib.template(lib.FileSprite)
 def tmpl_faces(func, z):
     WHITE_SKIN = (255, 176, 112)
     BLACK_SKIN = (128, 88, 56)
@@ -2559,67 +2734,7 @@ for i in reversed(modes_order):
         g.add(grf.Label(0, b''))
 
 
-# ------------------------------ Command Line Interface ------------------------------
-
-def cmd_debugcc_add_args(parser):
-    parser.add_argument('ase_file', help='Aseprite image file')
-    parser.add_argument('--horizontal', action='store_true', help='Stack resulting images horizontally')
-    parser.add_argument('--layer', help='Name of the layer in aseprite file to export')
-    parser.add_argument('--frame', help='Frame number to export', type=int, default=1)
-
-
-def cmd_debugcc_handler(g, grf_file, args):
-    ase = lib.AseImageFile(args.ase_file)
-    sprite = grf.FileSprite(ase, 0, 0, None, None, name=args.ase_file, layers=args.layer, frame=args.frame)
-    sprite = cc(sprite)
-    lib.debug_cc_recolour([sprite], horizontal=args.horizontal)
-
-
-def cmd_debugstruct_add_args(parser):
-    parser.add_argument('ase_file', help='Aseprite image file')
-    parser.add_argument('--horizontal', action='store_true', help='Stack resulting images horizontally')
-    parser.add_argument('--layer', help='Name of the layer in aseprite file to export')
-    parser.add_argument('--frame', help='Frame number to export', type=int, default=1)
-
-
-def cmd_debugstruct_handler(g, grf_file, args):
-    ase = lib.AseImageFile(args.ase_file)
-    sprite = grf.FileSprite(ase, 0, 0, None, None, name=args.ase_file, layers=args.layer, frame=args.frame)
-    sprite = struct(sprite)
-    lib.debug_struct_recolour([sprite], horizontal=args.horizontal)
+# Check all the sprite areas at once before building anything
+lib.validate_file_sprites(lib.iter_registered_sprites())
 
-
-def cmd_debuglight_add_args(parser):
-    parser.add_argument('ase_file', help='Aseprite image file')
-    parser.add_argument('--horizontal', action='store_true', help='Stack resulting images horizontally')
-
-
-def cmd_debuglight_handler(g, grf_file, args):
-    in_file = args.ase_file
-    ase = lib.AseImageFile(in_file)
-    aseo = lib.AseImageFile(in_file)
-    sprite = grf.FileSprite(ase, 0, 0, None, None, name=f'{in_file}_image', ignore_layers='Light order')
-    order = grf.FileSprite(aseo, 0, 0, None, None, name=f'{in_file}_order', layers='Light order')
-    lib.debug_light_cycle([lib.MagentaToLight(sprite, order)], horizontal=args.horizontal)
-
-
-grf.main(
-    g,
-    'bonkygfx.grf',
-    commands=[{
-        'name': 'debugcc',
-        'help': 'Takes an image and produces another image with all variants of CC recolour',
-        'add_args': cmd_debugcc_add_args,
-        'handler': cmd_debugcc_handler,
-    }, {
-        'name': 'debugstruct',
-        'help': 'Takes an image and produces another image with all variants of structure recolour',
-        'add_args': cmd_debugstruct_add_args,
-        'handler': cmd_debugstruct_handler,
-    }, {
-        'name': 'debuglight',
-        'help': 'Takes an image and produces animated gif with light cycle',
-        'add_args': cmd_debuglight_add_args,
-        'handler': cmd_debuglight_handler,
-    }]
-)
+grf.main(g, 'bonkygfx.grf', commands=COMMANDS)
@@ -1,9 +1,16 @@
+import concurrent.futures
+import functools
+import hashlib
+import json
+import multiprocessing
 import os
 import pathlib
+import re
+import struct
 import subprocess
 import time
 import tempfile
-from collections import defaultdict
+from collections import Counter, OrderedDict, defaultdict
 
 import numpy as np
 from PIL import Image
@@ -11,6 +18,8 @@ from PIL import Image
 import grf
 from grf import ZOOM_NORMAL, ZOOM_2X, ZOOM_4X, TEMPERATE, ARCTIC, TROPICAL, TOYLAND, ALL_CLIMATES
 
+import aseprite
+
 
 # VALUE_TO_BRIGHTNESS = np.array([0, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16, 17, 18, 19, 20, 21, 22, 23, 24, 25, 26, 27, 28, 29, 30, 31, 32, 33, 34, 35, 36, 37, 38, 39, 40, 41, 42, 43, 44, 45, 46, 47, 48, 49, 50, 51, 52, 53, 54, 55, 56, 57, 58, 59, 60, 61, 62, 63, 64, 66, 67, 68, 69, 70, 71, 72, 73, 74, 75, 76, 77, 78, 79, 80, 81, 82, 83, 84, 85, 86, 87, 88, 89, 90, 91, 92, 93, 94, 95, 96, 97, 98, 99, 100, 101, 102, 103, 104, 105, 106, 107, 108, 109, 110, 111, 91, 91, 92, 93, 94, 95, 95, 96, 97, 98, 99, 100, 100, 101, 102, 103, 104, 105, 105, 106, 107, 108, 109, 109, 110, 111, 112, 113, 114, 114, 115, 116, 117, 118, 118, 119, 120, 121, 122, 123, 123, 124, 125, 126, 127, 127, 128, 129, 130, 131, 107, 108, 109, 109, 110, 111, 111, 112, 113, 113, 114, 115, 115, 116, 117, 117, 118, 119, 119, 120, 121, 121, 122, 123, 123, 124, 125, 125, 126, 127, 127, 128, 129, 130, 130, 131, 132, 132, 133, 134, 134, 135, 136, 136, 137, 138, 138, 139, 140, 140, 120, 120, 121, 121, 122, 122, 123, 124, 124, 125, 125, 126, 126, 127, 127, 128, 129, 129, 130, 130, 131, 131, 132, 133, 133, 134, 134, 135, 135, 136, 137, 137, 138, 138, 139, 139, 140, 141, 141, 142, 142, 143, 143, 144, 145, 146, 146, 147, 147, 148, 127, 128, 128, 128, 128, 130, 130, 131, 131, 132, 132, 133, 133, 134, 134, 135, 135, 136, 136, 137, 137, 138, 138, 139, 139, 140, 140, 141, 141, 142, 143, 143, 144, 144, 144, 145, 145, 146, 146, 147, 147, 148, 148, 149, 149, 150, 150, 151, 151, 152, 130, 131, 131, 132, 132, 133, 133, 134, 134, 135, 135, 136, 136, 137, 137, 138, 138, 139, 140, 140, 141, 141, 142, 142, 143, 143, 144, 144, 145, 145, 146, 146, 147, 147, 148, 148, 149, 150, 150, 151, 151, 152, 152, 153, 153, 154, 155, 155, 156, 156, 130, 130, 131, 131, 132, 132, 132, 133, 134, 134, 135, 135, 136, 136, 137, 137, 138, 139, 139, 140, 140, 141, 141, 142, 142, 143, 144, 144, 145, 145, 146, 146, 147, 147, 148, 149, 149, 150, 150, 151, 151, 152, 152, 153, 154, 154, 155, 156, 156, 157, 131, 132, 132, 133, 133, 134, 134, 135, 135, 136, 136, 137, 138, 138, 139, 139, 140, 140, 141, 141, 142, 143, 143, 144, 144, 145, 145, 146, 147, 147, 148, 149, 149, 150, 151, 151, 152, 152, 153, 154, 154, 155, 156, 156, 157, 157, 158, 159, 160, 160, 161, 162, 162, 163, 164, 165, 166, 166, 167, 168, 168, 169, 170, 171, 172, 173, 174, 174, 175, 176, 177, 178, 179, 180, 181, 182, 183, 184, 185, 186, 187, 188, 189, 191, 192, 193, 194, 195, 197, 198, 199, 201, 203, 204, 206, 208, 210, 211, 214, 216, 218, 218])
 # VALUE_TO_INDEX = np.array([0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7])
@@ -23,14 +32,46 @@ CC_VALUE_TO_INDEX = np.array([0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0,
 STRUCT_VALUE_TO_BRIGHTNESS = np.array([0, 0, 0, 0, 0, 2, 2, 3, 3, 3, 5, 6, 10, 11, 15, 15, 19, 19, 23, 25, 31, 31, 35, 37, 42, 47, 47, 51, 57, 63, 63, 63, 69, 74, 79, 83, 87, 89, 95, 99, 105, 107, 111, 115, 120, 125, 128, 128, 128, 132, 132, 132, 132, 136, 136, 136, 136, 136, 136, 136, 140, 140, 140, 93, 95, 95, 98, 101, 101, 101, 106, 106, 108, 108, 108, 113, 115, 115, 117, 119, 120, 121, 124, 125, 127, 128, 128, 131, 132, 135, 136, 137, 137, 139, 142, 142, 144, 144, 147, 110, 111, 111, 113, 115, 115, 116, 118, 119, 121, 121, 123, 124, 124, 126, 127, 128, 128, 130, 130, 132, 133, 134, 136, 136, 136, 138, 140, 141, 141, 144, 144, 144, 110, 111, 112, 112, 113, 115, 115, 116, 118, 118, 119, 119, 120, 121, 122, 123, 124, 124, 125, 126, 127, 127, 128, 129, 130, 131, 131, 132, 133, 134, 134, 134, 136, 137, 137, 139, 139, 140, 117, 117, 119, 119, 119, 120, 121, 122, 122, 123, 123, 124, 124, 125, 126, 127, 127, 128, 128, 129, 130, 130, 131, 131, 132, 132, 133, 134, 134, 135, 135, 136, 137, 113, 113, 113, 115, 115, 115, 115, 117, 118, 118, 118, 118, 118, 120, 120, 120, 121, 122, 123, 123, 123, 123, 124, 125, 125, 126, 127, 127, 127, 128, 128, 129, 129, 130, 131, 131, 132, 132, 133, 134, 134, 134, 135, 135, 135, 137, 137, 120, 121, 122, 122, 122, 123, 123, 124, 124, 125, 125, 126, 126, 127, 127, 127, 128, 128, 129, 130, 130, 130, 131, 132, 132, 132, 132, 134, 134, 134, 134, 135, 136, 136, 121, 121, 121, 122, 122, 123, 123, 123, 124, 124, 125, 125, 126, 126, 126, 127, 127, 127, 128, 128, 129, 129, 129, 130, 130, 131, 132, 133, 133, 133, 134, 134, 134, 134, 135, 136, 136, 136, 136, 119, 119, 119, 119, 120, 120, 121, 121, 121, 121, 122, 122, 122, 123, 123, 123, 123, 124, 124, 124, 124, 124, 125, 125, 126, 126, 126, 126, 127, 127, 127, 127, 128, 128, 128, 129, 129, 129, 129, 130, 131, 131, 131, 132, 132, 132, 133, 134, 134, 134, 135, 135, 136, 136, 137, 137, 137, 139, 139, 139, 139, 123, 123, 123, 124, 124, 124, 125, 125, 125, 125, 126, 126, 126, 126, 127, 127, 127, 127, 128, 128, 128, 128, 129, 129, 129, 130, 130, 131, 131, 131, 132, 132, 133, 133, 134, 134, 134, 135, 135, 135, 135, 135, 136, 136, 136, 137, 137, 137, 139, 139, 139, 139, 144, 144, 144, 144, 146, 146, 146, 147, 149, 149, 152, 152, 152, 152, 152, 156, 158, 158, 159, 159, 160, 162, 162, 163, 163, 163, 169, 171, 181, 181, 183, 185, 185, 185, 187, 187, 189, 190, 191, 191, 191, 194, 196, 196, 198, 198, 198, 198, 201, 202, 204, 204, 205, 207, 210, 210, 210, 210, 212, 214, 216, 217, 217, 234, 236, 240, 240, 243, 243, 248, 248, 251, 253, 255, 255])
 STRUCT_VALUE_TO_INDEX = np.array([0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 8, 8, 8, 8, 8, 8, 8, 8, 8, 8, 8, 8, 8, 8, 8, 8, 8, 8, 8, 8, 8, 8, 8, 8, 8, 8, 8, 8, 8, 8, 8, 8, 8, 8, 8, 8, 8, 8, 8, 8, 8, 8, 8, 8, 8, 8, 8, 8, 8, 8, 8, 8, 8, 8, 8, 8, 8, 8, 8, 8, 8, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9])
 
-MAGENTA_TO_CC = (0, 0xC6, CC_VALUE_TO_BRIGHTNESS, CC_VALUE_TO_INDEX)
-MAGENTA_TO_STRUCT = (1, 0x46, STRUCT_VALUE_TO_BRIGHTNESS, STRUCT_VALUE_TO_INDEX)
-MAGENTA_TO_HOUSE_CC = (
+
+# Replaces magenta pixels with brightness (in red channel) and mask index looked up by the magenta value
+# (red + green, see get_magenta_values). Tables are indexed by value so all the pixels are done in one gather.
+class RecolourTable:
+    def __init__(self, fingerprint_id, first, value_to_brightness, value_to_index):
+        self.fingerprint_id = fingerprint_id
+        self.rgb = np.zeros((len(value_to_brightness), 3), dtype=np.uint8)
+        self.rgb[:, 0] = value_to_brightness
+        self.mask = (value_to_index + first).astype(np.uint8)
+
+    # Pixels that already have a mask are skipped. Returns new rgb and mask layers.
+    def apply(self, w, h, rgb, mask):
+        value = get_magenta_values(rgb)
+        if mask is not None:
+            value[mask != 0] = 0
+
+        # Write through flat indices of contiguous arrays, it's faster than boolean or 2d indexing
+        pos = np.flatnonzero(value)
+        value = value.ravel()[pos]
+
+        rgb = np.ascontiguousarray(grf.np_make_writable(rgb))
+        rgb.reshape(-1, 3)[pos] = self.rgb[value]
+
+        if mask is None:
+            mask = np.zeros((h, w), dtype=np.uint8)
+        else:
+            mask = np.ascontiguousarray(grf.np_make_writable(mask))
+        mask.reshape(-1)[pos] = self.mask[value]
+
+        return rgb, mask
+
+
+MAGENTA_TO_CC = RecolourTable(0, 0xC6, CC_VALUE_TO_BRIGHTNESS, CC_VALUE_TO_INDEX)
+MAGENTA_TO_STRUCT = RecolourTable(1, 0x46, STRUCT_VALUE_TO_BRIGHTNESS, STRUCT_VALUE_TO_INDEX)
+MAGENTA_TO_HOUSE_CC = RecolourTable(
     2, 0xC6,
     np.array([0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 1, 1, 1, 1, 1, 2, 2, 3, 3, 3, 4, 5, 5, 5, 7, 7, 7, 7, 9, 9, 11, 11, 12, 13, 14, 15, 15, 17, 17, 19, 19, 21, 21, 23, 24, 25, 26, 27, 29, 29, 31, 31, 31, 35, 35, 37, 37, 39, 39, 41, 41, 43, 44, 46, 47, 47, 49, 51, 51, 53, 54, 55, 57, 58, 59, 61, 63, 63, 63, 67, 67, 69, 69, 71, 73, 73, 75, 76, 78, 79, 81, 83, 83, 85, 85, 87, 89, 90, 91, 93, 95, 95, 97, 98, 99, 101, 103, 104, 105, 107, 108, 110, 111, 113, 114, 115, 117, 118, 119, 121, 123, 124, 126, 127, 128, 128, 130, 131, 132, 133, 134, 134, 136, 136, 136, 138, 138, 141, 117, 117, 118, 119, 119, 119, 122, 122, 123, 123, 124, 125, 125, 126, 127, 128, 128, 129, 130, 131, 131, 132, 132, 134, 134, 134, 136, 136, 137, 137, 138, 116, 117, 118, 118, 119, 119, 120, 121, 121, 122, 122, 123, 123, 124, 125, 125, 126, 127, 127, 128, 128, 129, 130, 130, 131, 131, 132, 132, 134, 134, 134, 135, 135, 136, 136, 137, 119, 119, 120, 120, 121, 122, 122, 123, 123, 124, 124, 125, 126, 126, 126, 127, 127, 128, 128, 129, 130, 130, 130, 132, 132, 132, 132, 133, 134, 134, 135, 136, 136, 136, 137, 137, 120, 121, 121, 121, 122, 122, 123, 123, 123, 123, 125, 125, 125, 125, 126, 126, 127, 127, 127, 128, 128, 128, 129, 130, 130, 131, 131, 131, 132, 132, 133, 133, 134, 134, 135, 135, 135, 135, 119, 119, 119, 120, 120, 120, 121, 121, 122, 122, 123, 123, 123, 123, 124, 124, 125, 125, 125, 126, 126, 127, 127, 127, 127, 128, 128, 128, 129, 129, 130, 131, 131, 132, 132, 133, 133, 133, 134, 134, 134, 135, 135, 136, 137, 137, 137, 119, 119, 120, 120, 121, 121, 121, 121, 122, 122, 122, 122, 122, 123, 124, 124, 124, 124, 125, 125, 125, 125, 126, 126, 127, 127, 127, 127, 127, 128, 128, 129, 129, 129, 130, 130, 131, 131, 131, 132, 132, 133, 133, 134, 134, 134, 135, 135, 135, 136, 137, 137, 137, 137, 137, 139, 122, 122, 123, 123, 123, 123, 124, 124, 124, 125, 125, 125, 126, 126, 126, 126, 127, 127, 127, 127, 128, 128, 128, 129, 129, 129, 130, 131, 131, 131, 131, 132, 132, 133, 133, 133, 134, 134, 135, 135, 135, 137, 137, 137, 137, 137, 138, 138, 139, 139, 141, 141, 141, 141, 141, 141, 141, 143, 144, 144, 144, 144, 145, 148, 149, 151, 152, 153, 153, 153, 155, 155, 156, 156, 158, 158, 159, 159, 159, 163, 163, 164, 164, 166, 166, 168, 168, 168, 236, 236, 236, 245, 245, 249, 250, 252, 253, 254, 254, 254, 254, 238, 238, 242, 245, 245, 248, 248, 254, 255, 255, 255, 255, 255, 255, 255, 255, 255, 255, 255, 255, 255, 255, 255, 255, 255, 255]),
     np.array([0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 1, 1, 3, 0, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 5, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7]),
 )
-MAGENTA_TO_SELECTION = (
+MAGENTA_TO_SELECTION = RecolourTable(
     2, 0x0A,
     np.array([0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 2, 2, 2, 2, 2, 2, 3, 3, 3, 3, 3, 3, 3, 3, 3, 4, 4, 4, 4, 5, 5, 5, 6, 6, 6, 6, 6, 7, 7, 7, 8, 8, 9, 9, 9, 9, 10, 10, 10, 11, 11, 12, 12, 10, 10, 13, 13, 14, 14, 15, 15, 14, 14, 16, 16, 17, 17, 18, 18, 19, 19, 19, 18, 18, 20, 20, 21, 21, 22, 19, 19, 23, 23, 24, 24, 25, 25, 23, 23, 26, 26, 27, 27, 28, 28, 26, 26, 29, 29, 30, 30, 31, 31, 29, 32, 32, 33, 33, 34, 34, 35, 35, 32, 32, 36, 36, 37, 38, 38, 35, 35, 39, 39, 40, 40, 41, 38, 38, 42, 42, 43, 43, 44, 44, 41, 45, 45, 46, 46, 47, 47, 40, 48, 48, 49, 49, 50, 50, 51, 47, 47, 52, 52, 53, 53, 54, 50, 50, 55, 55, 56, 56, 57, 48, 48, 58, 58, 59, 60, 60, 55, 55, 61, 62, 62, 63, 63, 58, 64, 64, 65, 65, 66, 67, 67, 49, 49, 68, 69, 69, 70, 70, 64, 71, 71, 72, 72, 73, 67, 67, 74, 74, 75, 76, 76, 70, 77, 77, 78, 78, 79, 73, 73, 80, 81, 81, 82, 82, 83, 76, 76, 84, 85, 85, 86, 86, 79, 87, 87, 88, 89, 89, 82, 82, 90, 91, 91, 92, 78, 78, 93, 94, 94, 95, 95, 87, 96, 96, 97, 98, 98, 99, 91, 91, 100, 101, 101, 102, 102, 86, 103, 103, 104, 105, 105, 96, 106, 106, 107, 108, 108, 99, 109, 109, 110, 111, 111, 102, 112, 112, 113, 114, 114, 115, 97, 97, 116, 117, 117, 118, 108, 108, 119, 120, 120, 121, 111, 111, 122, 123, 123, 124, 114, 114, 125, 126, 126, 127, 107, 107, 128, 128, 129, 129, 130, 130, 131, 131, 120, 120, 132, 132, 133, 133, 134, 134, 123, 123, 135, 135, 136, 136, 137, 137, 107, 107, 138, 138, 139, 139, 140, 140, 128, 128, 141, 141, 142, 142, 143, 143, 131, 131, 144, 144, 145, 145, 146, 146, 147, 147, 124, 124, 148, 148, 149, 149, 150, 150, 117, 117, 151, 151, 152, 152, 153, 153, 140, 140, 154, 154, 155, 155, 156, 156, 143, 143, 157, 157, 158, 158, 159, 159, 146, 146, 160, 160, 161, 161, 162, 162, 163, 163, 149, 149, 164, 164, 165, 165, 166, 166, 152, 152, 167, 167, 168, 168, 169, 169, 155, 155, 170, 170, 171, 171, 172, 172, 145, 145, 173, 173, 174, 174, 175, 175, 160, 160, 176, 176, 177, 177, 178, 178, 179, 179, 164, 164, 180, 180, 181, 181, 182, 182, 153, 153, 183, 183, 184, 184, 185, 185, 156, 156, 186, 186, 187, 187, 188, 188, 172, 172, 189, 189, 190, 190, 191, 191, 175, 175, 192, 192, 193, 193, 194, 194, 195]),
     np.array([0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 1, 0, 0, 0, 0, 0, 0, 0, 1, 1, 0, 0, 0, 0, 0, 0, 0, 3, 3, 0, 0, 0, 0, 0, 0, 1, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 1, 0, 0, 0, 0, 0, 2, 2, 0, 0, 0, 0, 0, 0, 1, 1, 0, 0, 0, 0, 0, 0, 1, 1, 0, 0, 0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 0, 0, 0, 1, 1, 0, 0, 0, 0, 0, 1, 1, 0, 0, 0, 0, 0, 1, 1, 0, 0, 0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 0, 2, 0, 0, 0, 0, 0, 0, 0, 1, 1, 0, 0, 0, 0, 0, 1, 1, 0, 0, 0, 0, 0, 2, 2, 0, 0, 0, 0, 0, 1, 1, 0, 0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 0, 0, 4, 4, 0, 0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 1, 1, 0, 0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 1, 1, 0, 0, 0, 0, 0, 0, 1, 1, 0, 0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 1, 1, 0, 0, 0, 0, 2, 2, 0, 0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 0, 1, 1, 0, 0, 0, 0, 0, 2, 0, 0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 0, 2, 2, 0, 0, 0, 0, 1, 1, 0, 0, 0, 0, 1, 1, 0, 0, 0, 0, 1, 1, 0, 0, 0, 0, 2, 2, 0, 0, 0, 0, 0, 0, 0, 0, 1, 1, 0, 0, 0, 0, 0, 0, 1, 1, 0, 0, 0, 0, 0, 0, 3, 3, 0, 0, 0, 0, 0, 0, 1, 1, 0, 0, 0, 0, 0, 0, 1, 1, 0, 0, 0, 0, 0, 0, 0, 0, 2, 2, 0, 0, 0, 0, 0, 0, 3, 3, 0, 0, 0, 0, 0, 0, 1, 1, 0, 0, 0, 0, 0, 0, 1, 1, 0, 0, 0, 0, 0, 0, 1, 1, 0, 0, 0, 0, 0, 0, 0, 0, 1, 1, 0, 0, 0, 0, 0, 0, 1, 1, 0, 0, 0, 0, 0, 0, 1, 1, 0, 0, 0, 0, 0, 0, 2, 2, 0, 0, 0, 0, 0, 0, 1, 1, 0, 0, 0, 0, 0, 0, 0, 0, 1, 1, 0, 0, 0, 0, 0, 0, 2, 2, 0, 0, 0, 0, 0, 0, 2, 2, 0, 0, 0, 0, 0, 0, 1, 1, 0, 0, 0, 0, 0, 0, 1, 1, 0, 0, 0, 0, 0, 0, 0]),
@@ -112,6 +153,9 @@ def template(sprite_class):
 
 
 class BaseGrid:
+    # Grids are created for every sprite sheet, attributes are kept in slots to save memory
+    __slots__ = ('func', 'add_xofs', 'add_yofs', 'add_width', 'add_height', 'kw')
+
     def __init__(self, *, func, add_xofs=0, add_yofs=0, add_width=0, add_height=0):
         self.func = func
         self.add_xofs = add_xofs
@@ -136,6 +180,8 @@ class BaseGrid:
 
 
 class RectGrid(BaseGrid):
+    __slots__ = ('height', 'width', 'padding')
+
     def __init__(self, *, func, width, height, padding=0, **kw):
         super().__init__(func=func, **kw)
         self.set_default(width=width, height=height)
@@ -153,6 +199,8 @@ class RectGrid(BaseGrid):
 
 
 class FlexGrid(BaseGrid):
+    __slots__ = ('padding', 'x', 'y')
+
     def __init__(self, *, func, padding=0, start=(0, 0), **kw):
         super().__init__(func=func, **kw)
         self.padding = padding
@@ -171,6 +219,8 @@ class FlexGrid(BaseGrid):
 
 
 class HouseGrid(BaseGrid):
+    __slots__ = ('z', 'zwidth', 'zheight', 'zpadding', 'offset')
+
     def __init__(self, *, func, height, width=64, padding=2, z=2, offset=(0, 0), **kw):
         super().__init__(func=func, **kw)
         self.z = z
@@ -215,7 +265,11 @@ class HouseGrid(BaseGrid):
 
 
 class BuildingSlicesGrid(BaseGrid):
+    __slots__ = ('height', 'z', 'tile_size', 'offset', 'zheight', 'zborder', '_ground_sprite', '_ground_grid')
+
     class GroundGrid(BaseGrid):
+        __slots__ = ('building_grid', )
+
         def __init__(self, building_grid):
             super().__init__(func=building_grid.func)
             self.building_grid = building_grid
@@ -328,30 +382,298 @@ def replace_new(collection, set_type, offset, sprites, **kw):
         new_sprites[key][set_type][offset + i] = s
 
 
+@functools.lru_cache(maxsize=None)
+def _get_file_hash(path, mtime, size):
+    return hashlib.sha256(pathlib.Path(path).read_bytes()).hexdigest()
+
+
+# Hash of the file contents, only recalculated when file is modified (for watch mode)
+def get_file_hash(path):
+    st = os.stat(path)
+    return _get_file_hash(str(path), st.st_mtime_ns, st.st_size)
+
+
+# Sprite fingerprint that includes contents of all its files, None if sprite can't be cached
+def get_sprite_fingerprint(s):
+    try:
+        fingerprint = s.get_fingerprint()
+    except grf.Uncacheable:
+        return None
+
+    files_data = []
+    for f in s.get_resource_files():
+        files_data.append((f.get_fingerprint(), None if f.path is None else get_file_hash(f.path)))
+
+    return {
+        'data': fingerprint,
+        'files': files_data,
+    }
+
+
+# All the sprites registered with the same fingerprint, their data is generated only once
+class SharedSpriteData:
+    def __init__(self, sprite, fingerprint):
+        self.sprite = sprite
+        self.fingerprint = fingerprint
+        self.uses = 0
+        self.prepared = False
+        self.data = None
+        self.build_time = 0
+
+
+# Stands in for one of the identical sprites in the grf, prepares and encodes the original sprite
+# only for the first use
+class SharedSprite(grf.Sprite):
+    def __init__(self, shared):
+        s = shared.sprite
+        super().__init__(s.w, s.h, xofs=s.xofs, yofs=s.yofs, zoom=s.zoom, bpp=s.bpp, crop=s.crop, name=s.name)
+        self.shared = shared
+
+    def prepare_files(self):
+        if not self.shared.prepared:
+            self.shared.sprite.prepare_files()
+            self.shared.prepared = True
+
+    def get_data_layers(self, context):
+        return self.shared.sprite.get_data_layers(context)
+
+    def get_real_data(self, context):
+        if self.shared.data is None:
+            start = time.perf_counter()
+            self.shared.data = self.shared.sprite.get_real_data(context)
+            self.shared.build_time = time.perf_counter() - start
+        return self.shared.data
+
+    def get_resource_files(self):
+        return self.shared.sprite.get_resource_files()
+
+    def get_fingerprint(self):
+        return self.shared.sprite.get_fingerprint()
+
+
+# NewGRF that checks whether cached sprite is still valid by the contents of its resource files
+# instead of the modification time. So checking out a branch or touching a file only rebuilds
+# sprites of the files that actually changed.
+# Sprites that are registered several times with the same contents (same ground in different places,
+# copied icons) are grouped by fingerprint and built once for all the slots.
+class NewGRF(grf.NewGRF):
+    def __init__(self, *args, **kw):
+        super().__init__(*args, **kw)
+        self._fingerprints = {}
+        self._shared = []
+
+    def _share_sprites(self, sprites):
+        groups = {}
+        replaced = {}
+
+        def share(s):
+            if not isinstance(s, grf.Sprite):
+                return s
+            fingerprint = self._fingerprints.get(s)
+            if fingerprint is None:
+                fingerprint = get_sprite_fingerprint(s)
+                if fingerprint is None:
+                    return s
+                self._fingerprints[s] = fingerprint
+            key = hashlib.sha256(json.dumps(fingerprint, sort_keys=True).encode()).hexdigest()
+            shared = groups.get(key)
+            if shared is None:
+                shared = groups[key] = SharedSpriteData(s, fingerprint)
+            shared.uses += 1
+            return shared
+
+        for a in sprites:
+            if id(a) in replaced:
+                continue
+            if isinstance(a, grf.AlternativeSprites):
+                replaced[id(a)] = (a, [share(s) for s in a.sprites])
+            elif isinstance(a, grf.SingleResourceAction):
+                replaced[id(a)] = (a, [share(a.resource)])
+
+        def unshare(s):
+            if not isinstance(s, SharedSpriteData):
+                return s
+            return SharedSprite(s) if s.uses > 1 else s.sprite
+
+        def make_action(a, sprites):
+            sprites = [unshare(s) for s in sprites]
+            if isinstance(a, grf.AlternativeSprites):
+                return grf.AlternativeSprites(*sprites)
+            return grf.SingleResourceAction(sprites[0])
+
+        actions = {k: make_action(a, sl) for k, (a, sl) in replaced.items()}
+        self._shared = [x for x in groups.values() if x.uses > 1]
+        return [actions.get(id(a), a) for a in sprites]
+
+    def generate_sprites(self):
+        self._fingerprints = {}
+        return self._share_sprites(super().generate_sprites())
+
+    def get_sprite_fingerprint(self, s):
+        if isinstance(s, SharedSprite):
+            return s.shared.fingerprint
+        if not isinstance(s, grf.Sprite):
+            return None
+        fingerprint = self._fingerprints.get(s)
+        if fingerprint is not None:
+            return fingerprint
+        return get_sprite_fingerprint(s)
+
+    def write(self, *args, **kw):
+        if COMPOSITE_CACHE is not None:
+            COMPOSITE_CACHE.clear()
+        res = super().write(*args, **kw)
+        built = [x for x in self._shared if x.data is not None]
+        if built:
+            saved_bytes = sum(len(x.data) * (x.uses - 1) for x in built)
+            saved_time = sum(x.build_time * (x.uses - 1) for x in built)
+            self._context.print(f'Built {len(built)} sprites once for {sum(x.uses for x in built)} slots, '
+                                f'saved {grf.byte_size_format(saved_bytes)} of encoding, {saved_time:.02f} sec')
+        self._shared = []
+        self._fingerprints = {}
+        return res
+
+
+def _iter_child_sprites(s):
+    for v in vars(s).values():
+        if isinstance(v, grf.Sprite):
+            yield v
+        elif isinstance(v, (list, tuple, dict)):
+            for x in (v.values() if isinstance(v, dict) else v):
+                if isinstance(x, grf.Sprite):
+                    yield x
+
+
+# Returns (frames, width, height) of the image file, read from the file header
+def _read_image_size(f):
+    if isinstance(f, AseImageFile):
+        return aseprite.read_header(f.path)
+    with Image.open(f.path) as im:
+        return (getattr(im, 'n_frames', 1), *im.size)
+
+
+# Checks that all file sprites (including the wrapped ones) are within their image and frame range.
+# Sprites only fail on it when they're built, this reads just the file headers before anything is
+# exported and raises with the list of all the bad sprites so they can be fixed at once.
+def validate_file_sprites(sprites):
+    sizes = {}
+    seen = set()
+    errors = []
+    stack = list(sprites)[::-1]
+    while stack:
+        s = stack.pop()
+        if id(s) in seen:
+            continue
+        seen.add(id(s))
+        stack.extend(list(_iter_child_sprites(s))[::-1])
+        if not isinstance(s, grf.FileSprite):
+            continue
+
+        size = sizes.get(s.file)
+        if size is None:
+            size = sizes[s.file] = _read_image_size(s.file)
+        nf, fw, fh = size
+        frame = s.kw.get('frame', 1)
+        sized = s.w is not None and s.h is not None
+        if frame > nf or sized and (s.x < 0 or s.y < 0 or s.x + s.w > fw or s.y + s.h > fh):
+            w, h = (s.w, s.h) if sized else (-1, -1)
+            errors.append(f'  {s.name}: frame {frame} area ({s.x}..{s.x + w}, {s.y}..{s.y + h}), '
+                          f'{s.file.path} has {nf} frames of ({fw}, {fh})')
+    if errors:
+        raise RuntimeError(f'{len(errors)} sprites are outside of their image borders:\n' + '\n'.join(errors))
+
+
+def _iter_sprites(sprites):
+    for s in sprites:
+        if isinstance(s, grf.AlternativeSprites):
+            yield from s.sprites
+        else:
+            yield s
+
+
+# Iterates over all the sprites added with replace_old and replace_new
+def iter_registered_sprites():
+    for sprites in old_sprites.values():
+        yield from _iter_sprites(sprites.values())
+    for set_type_sprites in new_sprites.values():
+        for sprites in set_type_sprites.values():
+            yield from _iter_sprites(sprites.values())
+
+
+# Lazy slice/pick/repeat of a sprite list, keeps the original list and a map of indexes into it.
+# Views of views share the original list with the index maps combined, sprites are only looked up
+# when the collection entry is used for replacing or composing. Making a view is a bit slower than
+# copying a short list, it pays off for chains of views and entries that are never used.
+class SpriteListView:
+    __slots__ = ('sprites', 'indexes')
+
+    def __init__(self, sprites, indexes):
+        self.sprites = sprites
+        self.indexes = indexes
+
+    @classmethod
+    def of(cls, sprites):
+        if isinstance(sprites, cls):
+            return sprites
+        return cls(sprites, range(len(sprites)))
+
+    # Same as list indexing except that a slice gives another view
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return SpriteListView(self.sprites, self.indexes[index])
+        return self.sprites[self.indexes[index]]
+
+    def pick(self, indexes):
+        return SpriteListView(self.sprites, tuple([self.indexes[i] for i in indexes]))
+
+    def __mul__(self, amount):
+        return SpriteListView(self.sprites, tuple(self.indexes) * amount)
+
+    def __len__(self):
+        return len(self.indexes)
+
+    def __iter__(self):
+        return (self.sprites[i] for i in self.indexes)
+
+    def resolve(self):
+        return list(self)
+
+
+def resolve_sprites(sprites):
+    if isinstance(sprites, SpriteListView):
+        return sprites.resolve()
+    return sprites
+
+
 class SpriteCollection:
     def __init__(self, name):
         self.name = name
         self.sprites = []
+        self._index = None
+
+    def _add_entry(self, zoom, kw, sprites):
+        self.sprites.append((zoom, kw, sprites))
+        self._index = None
 
     def __getitem__(self, sl):
         if isinstance(sl, int):
             sl = slice(sl, sl + 1)
         res = SpriteCollection(self.name)
         for zoom, kw, sprites in self.sprites:
-            res.sprites.append((zoom, kw, sprites[sl]))
+            res._add_entry(zoom, kw, SpriteListView.of(sprites)[sl])
         return res
 
     def pick(self, *indexes):
         res = SpriteCollection(self.name)
         for zoom, kw, sprites in self.sprites:
-            res.sprites.append((zoom, kw, [sprites[i] for i in indexes]))
+            res._add_entry(zoom, kw, SpriteListView.of(sprites).pick(indexes))
         return res
 
     def __mul__(self, amount):
         assert isinstance(amount, int)
         res = SpriteCollection(self.name)
         for zoom, kw, sprites in self.sprites:
-            res.sprites.append((zoom, kw, sprites * amount))
+            res._add_entry(zoom, kw, SpriteListView.of(sprites) * amount)
         return res
 
     def __len__(self):
@@ -370,24 +692,21 @@ class SpriteCollection:
             kwsuffix = 'thin_' if kw['thin'] else 'thick_'
         sprites = template(f'{self.name}{name_str}_{{suffix}}_{kwsuffix}{z}x', files, zoom, *args)
         assert all(s.zoom  == zoom or s == grf.EMPTY_SPRITE for s in sprites)
-        self.sprites.append((zoom, kw, sprites))
+        self._add_entry(zoom, kw, sprites)
         return self
 
     def add_sprites(self, sprites, **kw):
         zoom = sprites[0].zoom
-        self.sprites.append((zoom, kw, sprites))
+        self._add_entry(zoom, kw, sprites)
         return self
 
     def compose_on(self, dest, pattern=None, exact_size=True, offsets=None):
-        srckeys = set(tuple(p) for _, kw, _ in self.sprites for p in kw.items())
-        dstkeys = set(tuple(p) for _, kw, _ in dest.sprites for p in kw.items())
-
         compose_keys = set()
+        dst_kws = [(dstkeys, dict(dstkeys)) for dstkeys in dest.get_keys()]
         # print(self.name, dest.name)
         for srckeys in self.get_keys():
-            for dstkeys in dest.get_keys():
-                srckw = dict(srckeys)
-                dstkw = dict(dstkeys)
+            srckw = dict(srckeys)
+            for dstkeys, dstkw in dst_kws:
                 if any(k in dstkw and dstkw[k] != v for k, v in srckw.items()):
                     # have same key with different values -> incompatible
                     continue
@@ -434,40 +753,61 @@ class SpriteCollection:
             src1x, src2x = srcl
             dst1x, dst2x = dstl
             if src1x is not None and dst1x is not None:
-                res.sprites.append((ZOOM_NORMAL, dict(keys), patternzip(dst1x, src1x)))
+                res._add_entry(ZOOM_NORMAL, dict(keys), patternzip(dst1x, src1x))
             if src2x is not None and dst2x is not None:
-                res.sprites.append((ZOOM_2X, dict(keys), patternzip(dst2x, src2x)))
+                res._add_entry(ZOOM_2X, dict(keys), patternzip(dst2x, src2x))
         return res
 
+    # Entries indexed by their keyword set: {frozenset(kw.items()): {zoom: (position, sprites)}},
+    # only the first added entry of each keyword set and zoom is kept as it's the one lookups pick.
+    # Rebuilt on first lookup after entries were added, resolved lookups are memoized in _matches.
+    def _get_index(self):
+        if self._index is None:
+            self._index = {}
+            self._matches = {}
+            self._keys = {ZOOM_NORMAL: set(), ZOOM_2X: set()}
+            for pos, (zoom, kw, sprites) in enumerate(self.sprites):
+                self._index.setdefault(frozenset(kw.items()), {}).setdefault(zoom, (pos, sprites))
+                if zoom in self._keys:
+                    self._keys[zoom].add(dict_to_key(kw))
+        return self._index
+
     def get_keys(self):
-        keys1x = set(dict_to_key(kw) for zoom, kw, _ in self.sprites if zoom == ZOOM_NORMAL)
-        keys2x = set(dict_to_key(kw) for zoom, kw, _ in self.sprites if zoom == ZOOM_2X)
+        self._get_index()
+        keys1x, keys2x = self._keys[ZOOM_NORMAL], self._keys[ZOOM_2X]
         if len(keys2x) > len(keys1x):
             return keys2x
         return keys1x
 
-    def _find_sprites(self, keys, exact):
-        kw = dict(keys)
-        d = {}
-        for zoom, params, sprites in self.sprites:
-            if any(k not in kw for k in params):
-                continue
-            if any(k in params and params[k] != v for k, v in kw.items()):
+    # Best match for each zoom is the entry with most keywords that all match the keys (first added on
+    # a tie), returns (1x sprites, 2x sprites, whether some entry has exactly the keys) with views resolved
+    def _match(self, keys):
+        index = self._get_index()
+        keys = frozenset(keys)
+        res = self._matches.get(keys)
+        if res is not None:
+            return res
+
+        best = {}
+        for params, entries in index.items():
+            if not params <= keys:
                 continue
-            matches = sum(k in params for k in kw)
-            if zoom not in d or d[zoom][0] < matches:
-                d[zoom] = (matches, sprites)
-
-        # print(self.name, ', '.join(map(str, d.keys())), kw)
-        # for zoom in (ZOOM_NORMAL, ZOOM_2X):
-        #     if zoom in d:
-        #         print('  ', zoom_to_factor(zoom), ', '.join(x.name for x in d[zoom][1]))
-        # print()
+            for zoom, (pos, sprites) in entries.items():
+                if zoom not in best or (best[zoom][0], -best[zoom][1]) < (len(params), -pos):
+                    best[zoom] = (len(params), pos, sprites)
+
+        res = self._matches[keys] = (
+            resolve_sprites(best.get(ZOOM_NORMAL, (0, 0, None))[2]),
+            resolve_sprites(best.get(ZOOM_2X, (0, 0, None))[2]),
+            keys in index,
+        )
+        return res
 
-        if exact and all(v[0] != len(kw) for v in d.values()):
+    def _find_sprites(self, keys, exact):
+        sprites1x, sprites2x, has_exact = self._match(keys)
+        if exact and not has_exact:
             return None, None
-
-        return d.get(ZOOM_NORMAL, (0, None))[1], d.get(ZOOM_2X, (0, None))[1]
+        return sprites1x, sprites2x
 
     def get_sprites(self, keys):
         return self._find_sprites(keys, False)
@@ -489,39 +829,22 @@ class SpriteCollection:
         if not keys:
             return self
 
+        # Group entries by the set of keys they match (incompatible keys just don't count)
         matches = {}
-        for zoom, kw, sprites in self.sprites:
-
-            # Find common keys
-            match = []
-            for k, v in kw.items():
-                if k in keys:
-                    if v != keys[k]:
-                        continue  # Incompatible keys are filtered out
-                    match.append(k)
-            m = frozenset(match)
-
-            if m in matches:
-                matches[m].append((zoom, kw, sprites))
-                continue
-
-            # There is a better match already
-            if any(m.issubset(mi) for mi in matches.keys()):
-                continue
-
-            # Delete worse matches
-            for mi in list(matches.keys()):
-                if mi.issubset(m):
-                    del matches[mi]
-
-            if unspecify:
-                kw = {k: v for k, v in kw.items() if k not in keys}
-
-            matches[m] = [(zoom, kw, sprites)]
+        for entry in self.sprites:
+            kw = entry[1]
+            m = frozenset(k for k, v in kw.items() if k in keys and v == keys[k])
+            matches.setdefault(m, []).append(entry)
 
+        # Keep only the best matches, groups with a matching key set that is a superset of theirs are better
         res = SpriteCollection(self.name)
-        for sl in matches.values():
-            res.sprites.extend(sl)
+        for m, entries in matches.items():
+            if any(m < mi for mi in matches):
+                continue
+            for zoom, kw, sprites in entries:
+                if unspecify:
+                    kw = {k: v for k, v in kw.items() if k not in keys}
+                res._add_entry(zoom, kw, sprites)
         return res
 
     def reduce(self, **keys):
@@ -548,41 +871,59 @@ class SpriteCollection:
             replace_new(self, set_type, offset, sprites, **dict(k), **kw)
 
 
-class CCReplacingFileSprite(grf.FileSprite):
-    def __init__(self, file, *args, **kw):
-        super().__init__(file, *args, **kw)
+# FileSprite that takes aseprite images as a view of the exported array instead of
+# cropping a copy out of the whole image for every sprite
+class FileSprite(grf.FileSprite):
+    def get_data_layers(self, context):
+        if not isinstance(self.file, AseImageFile):
+            return super().get_data_layers(context)
+        try:
+            return self._get_ase_data_layers(context)
+        finally:
+            self.file.release(**self.kw)
 
-    def get_data_layers(self, context, *args, **kw):
-        w, h, img, bpp = self._do_get_image(context)
+    def _get_ase_data_layers(self, context):
+        if self.file.colourkey is not None:
+            return super().get_data_layers(context)
 
         timer = context.start_timer()
+        npimg, bpp = self.file.get_array(**self.kw)
+        if self.bpp is not None and bpp != self.bpp:
+            # Let grf-py do bpp conversion
+            return super().get_data_layers(context)
+
+        ih, iw = npimg.shape[:2]
+        unsized = (self.w is None or self.h is None)
+        if unsized and self.x == 0 and self.y == 0:
+            # Whole image
+            self.w, self.h = iw, ih
+        elif unsized:
+            raise RuntimeError(f'Sprite {self.name} at ({self.x}, {self.y}) needs both width and height, only the whole image sprite (at 0, 0) can have no size')
+        if self.x < 0 or self.y < 0 or self.x + self.w > iw or self.y + self.h > ih:
+            raise RuntimeError(f"Sprite {self.name} area ({self.x}..{self.x + self.w}, {self.y}..{self.y + self.h}) is outside image borders (0..{iw}, 0..{ih})")
+        region = npimg[self.y: self.y + self.h, self.x: self.x + self.w]
+
+        timer.count_loading()
 
-        if bpp != grf.BPP_32 and bpp != grf.BPP_24:
-            raise RuntimeError('Only 32-bit RGB sprites are currently supported for CC replacement')
+        if bpp == grf.BPP_32:
+            return self.w, self.h, region[:, :, :3], region[:, :, 3], None
+        return self.w, self.h, region, None, None
 
-        self.bpp = bpp
-        npimg = np.asarray(img).copy()
 
-        magenta_mask = (
-            (npimg[:, :, 0] == npimg[:, :, 2]) &
-            (
-                ((npimg[:, :, 0] == 255) & (npimg[:, :, 1] != 255)) |
-                ((npimg[:, :, 1] == 0) & (npimg[:, :, 0] != 0))
-            )
-        )
+class CCReplacingFileSprite(FileSprite):
+    def __init__(self, file, *args, **kw):
+        super().__init__(file, *args, **kw)
+
+    def get_data_layers(self, context, *args, **kw):
+        w, h, rgb, alpha, _ = super().get_data_layers(context)
 
-        value = npimg[magenta_mask][:, 0].astype(np.uint16) + npimg[magenta_mask][:, 1]
-        npimg[magenta_mask, 0] = CC_VALUE_TO_BRIGHTNESS[value]
-        npimg[magenta_mask, 1] = 0
-        npimg[magenta_mask, 2] = 0
+        timer = context.start_timer()
 
-        mask = np.zeros((h, w), dtype=np.uint8)
-        mask[magenta_mask] = CC_VALUE_TO_INDEX[value] + 0xC6
+        if rgb is None:
+            raise RuntimeError('Only 32-bit RGB sprites are currently supported for CC replacement')
 
-        if bpp == grf.BPP_32:
-            rgb, alpha = npimg[:, :, :3], npimg[:, :, 3]
-        else:
-            rgb, alpha = npimg, None
+        self.bpp = grf.BPP_24 if alpha is None else grf.BPP_32
+        rgb, mask = MAGENTA_TO_CC.apply(w, h, rgb, None)
 
         timer.count_custom('Magenta and mask processing')
 
@@ -593,6 +934,27 @@ class CCReplacingFileSprite(grf.FileSprite):
         return super().get_resource_files() + (THIS_FILE,)
 
 
+# Mask of the pixels outside of the ground tile for a 64 * z wide ground sprite. Left and right halves of
+# the tile can be extended upwards by above_l and above_r pixels, sprite is then max of them taller.
+# Returned array is shared, don't modify it.
+@functools.lru_cache(maxsize=None)
+def get_ground_mask(z, above_l=0, above_r=0):
+    tile_ws = 32 * z
+    tile_hs = 16 * z
+    above_h = max(above_l, above_r)
+    h = 32 * z - 1 + above_h
+
+    def get_n(above):
+        i = np.arange(h) - (above_h - above)
+        n = np.where(i < tile_hs + above, i, 32 * z - 2 - i + above)
+        return np.clip((n + 1) * 2, 0, tile_ws)[:, np.newaxis]
+
+    x = np.arange(tile_ws * 2)[np.newaxis, :]
+    ground_mask = (x < tile_ws - get_n(above_l)) | (x >= tile_ws + get_n(above_r))
+    ground_mask.flags.writeable = False
+    return ground_mask
+
+
 class MaskGround(grf.SpriteWrapper):
     def __init__(self, sprite):
         z = zoom_to_factor(sprite.zoom)
@@ -609,21 +971,7 @@ class MaskGround(grf.SpriteWrapper):
         assert w == 64 * z
         assert h == 32 * z - 1
 
-        assert z == 2  # untested for other z
-        tile_ws = 32 * z
-        tile_hs = 16 * z
-
-        ground_mask = np.full((h, w), True)
-
-        def get_n (i, above):
-            # i -= self.above_h - above
-            n = i if i < tile_hs + above else 31 * z - i + above
-            return max(0, min((n + 1) * 2, tile_ws))
-
-        for i in range(h):
-            nl = get_n(i, 0)
-            nr = get_n(i, 0)
-            ground_mask[i, tile_ws - nl: tile_ws + nr] = False
+        ground_mask = get_ground_mask(z)
         if rgb is not None:
             rgb = grf.np_make_writable(rgb)
             rgb[ground_mask, :] = 0
@@ -671,20 +1019,50 @@ class DebugSprite(grf.SpriteWrapper):
         )
 
 
+# Magenta value (red + green) of colours with red == blue that are considered magenta, indexed by red << 8 | green.
+# 0 for the rest, that value never appears in magenta.
+def _make_magenta_value_table():
+    r, g = np.meshgrid(np.arange(256), np.arange(256), indexing='ij')
+    is_magenta = ((r == 255) & (g != 255)) | ((g == 0) & (r != 0))
+    return np.where(is_magenta, r + g, 0).astype(np.uint16).ravel()
+
+
+MAGENTA_VALUE_TABLE = _make_magenta_value_table()
+
+
+# Returns magenta value of each pixel, 0 if it's not magenta
+def get_magenta_values(rgb):
+    r = rgb[:, :, 0]
+    key = r.astype(np.uint16) << 8
+    key |= rgb[:, :, 1]
+    value = MAGENTA_VALUE_TABLE.take(key)
+    value *= (r == rgb[:, :, 2])
+    return value
+
+
 def make_magenta_mask(rgb):
-    return (
-        (rgb[:, :, 0] == rgb[:, :, 2]) &
-        (
-            ((rgb[:, :, 0] == 255) & (rgb[:, :, 1] != 255)) |
-            ((rgb[:, :, 1] == 0) & (rgb[:, :, 0] != 0))
-        )
-    )
+    return get_magenta_values(rgb) != 0
+
+
+# Colour for each magenta value, from black to the colour and then to white (blended in oklab).
+# Calculated once per colour and shared by all MagentaToColour sprites.
+@functools.lru_cache(maxsize=None)
+def get_colour_ramp(colour):
+    oklab_colour = grf.srgb_to_oklab(colour)
+    BLACK = grf.srgb_to_oklab((0, 0, 0))
+    WHITE = grf.srgb_to_oklab((255, 255, 255))
+    ratio = np.arange(255)[:, np.newaxis] / 255.
+    ramp = np.zeros((255 * 2, 3), dtype=np.uint8)
+    ramp[:255] = grf.oklab_to_srgb(grf.oklab_blend(BLACK, oklab_colour, ratio))
+    ramp[255] = colour
+    ramp[256:] = grf.oklab_to_srgb(grf.oklab_blend(oklab_colour, WHITE, ratio[1:]))
+    ramp.flags.writeable = False
+    return ramp
 
 
 class MagentaToColour(grf.SpriteWrapper):
     def __init__(self, sprite, colour):
         self.colour = colour
-        self._oklab_colour = grf.srgb_to_oklab(colour)
         super().__init__((sprite, ))
 
     def get_data_layers(self, context):
@@ -692,20 +1070,11 @@ class MagentaToColour(grf.SpriteWrapper):
 
         timer = context.start_timer()
 
-        magenta_mask = make_magenta_mask(rgb)
-        value = rgb[magenta_mask][:, 0].astype(np.uint16) + rgb[magenta_mask][:, 1]
-        value_map = np.zeros((255 * 2, 3), dtype=np.uint8)
-        BLACK = grf.srgb_to_oklab((0, 0, 0))
-        WHITE = grf.srgb_to_oklab((255, 255, 255))
-        for v in set(value):
-            if v < 255:
-                value_map[v] = grf.oklab_to_srgb(grf.oklab_blend(BLACK, self._oklab_colour, v / 255.))
-            elif v > 255:
-                value_map[v] = grf.oklab_to_srgb(grf.oklab_blend(self._oklab_colour, WHITE, (v - 255) / 255.))
-            else:
-                value_map[v] = self.colour
+        value = get_magenta_values(rgb)
+        ys, xs = np.nonzero(value)
+        value = value[ys, xs]
         rgb = grf.np_make_writable(rgb)
-        rgb[magenta_mask, :] = value_map[value]
+        rgb[ys, xs] = get_colour_ramp(tuple(self.colour))[value]
 
         timer.count_custom('Magenta and mask processing')
 
@@ -724,28 +1093,11 @@ class MagentaRecolour(grf.SpriteWrapper):
         super().__init__((sprite, ))
 
     def get_data_layers(self, context):
-        _fingerprint, first, vtb, vti = self.magenta_map
         w, h, rgb, alpha, mask = self.sprites[0].get_data_layers(context)
 
         timer = context.start_timer()
 
-        rgb = grf.np_make_writable(rgb)
-        magenta_mask = make_magenta_mask(rgb)
-
-        if mask is not None:
-            magenta_mask &= (mask == 0)
-
-        value = rgb[magenta_mask][:, 0].astype(np.uint16) + rgb[magenta_mask][:, 1]
-        rgb[magenta_mask, 0] = vtb[value]
-        rgb[magenta_mask, 1] = 0
-        rgb[magenta_mask, 2] = 0
-
-        if mask is None:
-            mask = np.zeros((h, w), dtype=np.uint8)
-        else:
-            mask = grf.np_make_writable(mask)
-
-        mask[magenta_mask] = vti[value] + first
+        rgb, mask = self.magenta_map.apply(w, h, rgb, mask)
 
         timer.count_custom('Magenta and mask processing')
 
@@ -754,7 +1106,7 @@ class MagentaRecolour(grf.SpriteWrapper):
     def get_fingerprint(self):
         return dict(
             **super().get_fingerprint(),
-            map=self.magenta_map[0],
+            map=self.magenta_map.fingerprint_id,
         )
 
 
@@ -795,24 +1147,25 @@ class MagentaToLight(grf.Sprite):
 
         timer = context.start_timer()
 
-        magenta_mask = make_magenta_mask(rgb)
+        magenta_mask = make_magenta_mask(npimg)
 
+        # Light order colours from the brightest to the darkest are mapped to 0xF1-0xF4
         order_mask = (na > 0)
-        colours = list(set(map(tuple, ni[order_mask])))
+        colours, inverse = np.unique(pack_rgb(ni[order_mask]), return_inverse=True)
         if len(colours) != 4:
             raise ValueError(f'Expected 4 colors in order mask, found {len(colours)} in {self.order.name}')
-        colours.sort(key=lambda x: int(x[0]) + x[1] + x[2], reverse=True)
+        brightness = (colours >> 16) + ((colours >> 8) & 0xff) + (colours & 0xff)
+        light = np.empty(4, dtype=np.uint8)
+        light[np.argsort(-brightness.astype(np.int32), kind='stable')] = np.arange(0xf1, 0xf5, dtype=np.uint8)
 
-        order_mask &= magenta_mask
-        order = ni[order_mask]
-        if np.any(magenta_mask != order_mask):
-            raise ValueError(f'Not all magenta pixels of sprite {self.sprite.name} have a defined order in {self.order.name}')
+        uncovered = magenta_mask & ~order_mask
+        if uncovered.any():
+            ys, xs = np.nonzero(uncovered)
+            raise ValueError(f'Not all magenta pixels of sprite {self.sprite.name} have a defined order in {self.order.name}: {format_pixels(self.sprite, ys, xs)}')
 
         npmask = np.zeros((h, w), dtype=np.uint8)
-        ordered = np.zeros(order.shape[0], dtype=np.uint8)
-        for i, c in enumerate(colours):
-            ordered[(order == c).all(axis=1)] = 0xf1 + i
-        npmask[order_mask] = ordered
+        npmask[order_mask] = light[inverse.ravel()]
+        npmask[~magenta_mask] = 0
 
         timer.count_custom('Magenta and mask processing')
 
@@ -829,6 +1182,47 @@ class MagentaToLight(grf.Sprite):
         }
 
 
+def pack_rgb(rgb):
+    return (rgb[..., 0].astype(np.uint32) << 16) | (rgb[..., 1].astype(np.uint32) << 8) | rgb[..., 2]
+
+
+def _make_palette_lookup():
+    keys = pack_rgb(np.array(list(grf.PALETTE_IDX.keys()), dtype=np.uint8))
+    values = np.array(list(grf.PALETTE_IDX.values()), dtype=np.uint8)
+    order = np.argsort(keys)
+    return keys[order], values[order]
+
+
+# Packed palette colours, sorted for searchsorted, and their indices
+PALETTE_KEYS, PALETTE_VALUES = _make_palette_lookup()
+
+
+# Lists (x, y) of the first few pixels for error messages, in the image file coordinates when
+# possible so they're easier to find
+def format_pixels(sprite, ys, xs, limit=5):
+    ox, oy = (sprite.x, sprite.y) if isinstance(sprite, grf.FileSprite) else (0, 0)
+    res = ', '.join(f'({x + ox}, {y + oy})' for y, x in zip(ys[:limit], xs[:limit]))
+    if len(ys) > limit:
+        res += f' and {len(ys) - limit} more'
+    return res
+
+
+# Palette indices of the colours of pixels selected by pixel_mask (in the same order as rgb[pixel_mask])
+def match_palette(rgb, pixel_mask, sprite):
+    packed = pack_rgb(rgb[pixel_mask])
+    pos = np.searchsorted(PALETTE_KEYS, packed)
+    pos[pos == len(PALETTE_KEYS)] = 0
+    found = (PALETTE_KEYS[pos] == packed)
+    if not found.all():
+        ys, xs = np.nonzero(pixel_mask)
+        errors = []
+        for c in np.unique(packed[~found]):
+            idx = np.flatnonzero(packed == c)
+            errors.append(f'{(int(c) >> 16, (int(c) >> 8) & 0xff, int(c) & 0xff)} at {format_pixels(sprite, ys[idx], xs[idx])}')
+        raise ValueError(f'Colors not in the palette in sprite {sprite.name}: ' + '; '.join(errors))
+    return PALETTE_VALUES[pos]
+
+
 class MagentaAndMask(grf.Sprite):
     def __init__(self, sprite, mask, name=None):
         self.sprite = sprite
@@ -854,15 +1248,7 @@ class MagentaAndMask(grf.Sprite):
         if np.any(anim_mask != pal_mask):
             context.warning('animated-missing-magenta', self, f'Not all pixels of animation sprite {self.mask.name} have a magenta in {self.sprite.name}')
 
-        masked = ni[pal_mask]
-        colours = set(map(tuple, masked))
-        new_masked = np.zeros(masked.shape[0], dtype=np.uint8)
-
-        for c in colours:
-            m = grf.PALETTE_IDX.get(c)
-            if m is None:
-                raise ValueError(f'Color {c} is not in the palette in sprite {self.mask.name}')
-            new_masked[(masked == c).all(axis=1)] = m
+        new_masked = match_palette(ni, pal_mask, self.mask)
 
         mask = np.zeros((h, w), dtype=np.uint8) if mask is None else grf.np_make_writable(mask)
         mask[pal_mask] = new_masked
@@ -907,15 +1293,7 @@ class AlphaAndMask(grf.Sprite):
 
         mask = (na > 0)
 
-        masked = ni[mask]
-        colours = set(map(tuple, masked))
-        new_masked = np.zeros(masked.shape[0], dtype=np.uint8)
-
-        for c in colours:
-            m = grf.PALETTE_IDX.get(c)
-            if m is None:
-                raise ValueError(f'Color {c} is not in the palette in sprite {self.mask.name}')
-            new_masked[(masked == c).all(axis=1)] = m
+        new_masked = match_palette(ni, mask, self.mask)
 
         if npmask is None:
             npmask = np.zeros((h, w), dtype=np.uint8)
@@ -943,8 +1321,7 @@ class AlphaAndMask(grf.Sprite):
 # TODO switch anchor tile from bottom to top
 class CutGround(grf.Sprite):
     def __init__(self, sprite, position, name=None, above=0):
-        assert sprite.zoom == ZOOM_2X
-        z = 2
+        z = zoom_to_factor(sprite.zoom)
         self.sprite = sprite
         self.position = position
         if isinstance(above, (tuple, list)):
@@ -960,7 +1337,7 @@ class CutGround(grf.Sprite):
 
     def get_data_layers(self, context):
         gx, gy = self.position
-        z = 2  # NOTE untested for other z
+        z = zoom_to_factor(self.zoom)
         tile_ws = 32 * z
         tile_hs = 16 * z
         x = -self.sprite.xofs - 31 * z + (gy - gx) * tile_ws
@@ -968,17 +1345,7 @@ class CutGround(grf.Sprite):
 
 
         w, h, rgb, alpha, mask = self.sprite.get_data_layers(context)
-        ground_mask = np.full((self.h, self.w), True)
-
-        def get_n (i, above):
-            i -= self.above_h - above
-            n = i if i < tile_hs + above else 31 * z - i + above
-            return max(0, min((n + 1) * 2, tile_ws))
-
-        for i in range(self.h):
-            nl = get_n(i, self.above_l * z)
-            nr = get_n(i, self.above_r * z)
-            ground_mask[i, tile_ws - nl: tile_ws + nr] = False
+        ground_mask = get_ground_mask(z, self.above_l * z, self.above_r * z)
 
         if x < 0 or y < 0 or y + self.h > h or x + self.w > w:
             raise ValueError(f'Ground sprite region({x}..{x + self.w}, {y}..{y + self.h}) is outside sprite boundaries (0..{w}, 0..{h}) for sprite {self.sprite.name}/{self.name}')
@@ -1009,11 +1376,386 @@ class CutGround(grf.Sprite):
         }
 
 
+# Lua script for aseprite that exports multiple frame/layer variants of a file in one run.
+# Parameters: `input` - aseprite file, `jobs` - text file with one variant per line:
+# frame<TAB>output file<TAB>include|exclude|all[<TAB>layer filter]...
+# Layer filters follow aseprite --layer/--ignore-layer semantics ('GROUP/*' wildcards,
+# included layers are shown even if they're hidden in the file).
+ASE_EXPORT_SCRIPT = '''
+local spr = app.open(app.params.input)
+if spr == nil then
+  error("Unable to open " .. app.params.input)
+end
+if spr.colorMode ~= ColorMode.RGB then
+  app.command.ChangePixelFormat{ format="rgb" }
+end
+
+local function collect_layers(layers, prefix, res)
+  for _, layer in ipairs(layers) do
+    local path = prefix .. layer.name
+    table.insert(res, { layer=layer, path=path, visible=layer.isVisible })
+    if layer.isGroup then
+      collect_layers(layer.layers, path .. "/", res)
+    end
+  end
+  return res
+end
+
+local function split_path(path)
+  local res = {}
+  for part in string.gmatch(path, "[^/]+") do
+    table.insert(res, part)
+  end
+  return res
+end
+
+local function match_path(filter, path, exclude)
+  if filter == path then
+    return true
+  end
+  local a, b = split_path(filter), split_path(path)
+  for i = 1, math.min(#a, #b) do
+    if a[i] ~= b[i] and a[i] ~= "*" then
+      return false
+    end
+  end
+  -- Ignoring a layer hides its children, including it also shows its parents
+  if exclude then
+    return #a <= #b
+  end
+  return true
+end
+
+local all_layers = collect_layers(spr.layers, "", {})
+
+for line in io.lines(app.params.jobs) do
+  local fields = {}
+  for field in string.gmatch(line, "[^\\t]+") do
+    table.insert(fields, field)
+  end
+  if #fields >= 3 then
+    local frame, output, mode = tonumber(fields[1]), fields[2], fields[3]
+    for _, l in ipairs(all_layers) do
+      local matched = false
+      for i = 4, #fields do
+        if match_path(fields[i], l.path, mode == "exclude") then
+          matched = true
+          break
+        end
+      end
+      if mode == "include" then
+        l.layer.isVisible = matched
+      elseif mode == "exclude" then
+        l.layer.isVisible = l.visible and not matched
+      else
+        l.layer.isVisible = l.visible
+      end
+    end
+    local img = Image(spr.spec)
+    img:drawSprite(spr, frame)
+    -- Raw RGBA pixels after the size, saves compressing and decompressing a png
+    local f = io.open(output, "wb")
+    f:write(string.pack("<I4I4", img.width, img.height), img.bytes)
+    f:close()
+  end
+end
+'''
+
+
+# Reads the raw image written by ASE_EXPORT_SCRIPT
+def _load_ase_frame(fname):
+    with open(fname, 'rb') as f:
+        w, h = struct.unpack('<II', f.read(8))
+        data = np.fromfile(f, dtype=np.uint8)
+    if data.size != w * h * 4:
+        raise RuntimeError(f'Aseprite output file {fname} has {data.size} bytes of data, expected {w}x{h} RGBA image')
+    return data.reshape((h, w, 4))
+
+
+def _export_ase_file_cli(path, keys):
+    # Export all requested variants in a single aseprite run, see ASE_EXPORT_SCRIPT
+    aseprite_executible = os.environ.get('ASEPRITE_EXECUTABLE', 'aseprite')
+    get_aseprite_version()  # checks that the script is supported
+    images = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmpdir = pathlib.Path(tmpdir)
+        script = tmpdir / 'export.lua'
+        script.write_text(ASE_EXPORT_SCRIPT)
+        outputs = {}
+        jobs = []
+        for i, kw in enumerate(sorted(keys)):
+            frame, layers, ignore_layers = kw
+            outputs[kw] = tmpdir / f'{i}.rgba'
+            if layers:
+                mode, filters = 'include', layers
+            elif ignore_layers:
+                mode, filters = 'exclude', ignore_layers
+            else:
+                mode, filters = 'all', ()
+            jobs.append('\t'.join((str(frame), str(outputs[kw]), mode) + filters))
+        jobs_file = tmpdir / 'jobs.txt'
+        jobs_file.write_text('\n'.join(jobs) + '\n')
+
+        args = [
+            aseprite_executible, '-b',
+            '--script-param', f'input={path}',
+            '--script-param', f'jobs={jobs_file}',
+            '--script', str(script),
+        ]
+        res = subprocess.run(args)
+        args_str = ' '.join(res.args)
+        if res.returncode != 0:
+            raise RuntimeError(f'Aseprite returned non-zero code {res.returncode}, command line: {args_str}')
+        for kw, fname in outputs.items():
+            if not fname.exists():
+                raise RuntimeError(f'Aseprite didn''t create an output file {fname} for {kw}, command line: {args_str}')
+            try:
+                images[kw] = (_load_ase_frame(fname), grf.BPP_32)
+            except OSError:
+                raise RuntimeError(f'Error loading aseprite output file {fname}, command line: {args_str}')
+    return images
+
+
+def _export_ase_file_native(path, keys):
+    # Decodes the file once, all the variants are composited from the same cel buffers
+    ase = aseprite.AseFile(path)
+    images = {}
+    for kw, rgba in ase.render_many(keys).items():
+        images[kw] = (rgba, grf.BPP_32)
+    return images
+
+
+# Which decoder to use for aseprite files: 'cli' runs aseprite executable, 'native' uses aseprite.py reader
+ASE_DECODER = os.environ.get('ASEPRITE_DECODER', 'cli')
+
+
+# NOTE: runs in a worker process when exporting with export_ase_files
+# Images are written to the store directory (keys maps export parameters to store keys) so that
+# main process maps them instead of receiving a pickled copy. Returns exported export parameters.
+def _export_ase_file(path, keys, decoder, store_path):
+    if decoder == 'native':
+        images = _export_ase_file_native(path, frozenset(keys))
+    elif decoder == 'cli':
+        images = _export_ase_file_cli(path, frozenset(keys))
+    else:
+        raise ValueError(f'Unknown aseprite decoder {decoder}, expected cli or native')
+
+    for kw, (data, bpp) in images.items():
+        AseExportCache.write(store_path, keys[kw], data)
+    return list(images.keys())
+
+
+# ASE_EXPORT_SCRIPT reads pixels with Image.bytes which needs aseprite 1.3
+ASEPRITE_MIN_VERSION = (1, 3)
+
+
+@functools.lru_cache(maxsize=None)
+def get_aseprite_version():
+    aseprite_executible = os.environ.get('ASEPRITE_EXECUTABLE', 'aseprite')
+    res = subprocess.run([aseprite_executible, '--version'], capture_output=True, text=True)
+    if res.returncode != 0:
+        raise RuntimeError(f'Unable to get aseprite version, {aseprite_executible} --version returned {res.returncode}')
+    version = res.stdout.strip()
+    m = re.search(r'(\d+)\.(\d+)', version)
+    if m is None:
+        raise RuntimeError(f'Unable to parse aseprite version {version!r}')
+    if tuple(map(int, m.groups())) < ASEPRITE_MIN_VERSION:
+        min_version = '.'.join(map(str, ASEPRITE_MIN_VERSION))
+        raise RuntimeError(f'{version} is too old, aseprite {min_version} or newer is required (or use --ase-decoder native)')
+    return version
+
+
+# On-disk cache of exported aseprite images, stores each image as a .npy file named
+# by the hash of the source file contents, aseprite version and export parameters.
+# Images are memory-mapped on load so all the processes share the same copy.
+# Least recently used images are removed when total size goes over the max_size.
+class AseExportCache:
+    def __init__(self, path, max_size):
+        self.path = pathlib.Path(path)
+        self.index_path = self.path / 'index.json'
+        self.max_size = max_size
+        self._index = None  # key -> (size, last use time)
+        self._used = set()  # keys used by this build, they're never removed
+
+    def _load_index(self):
+        if self._index is not None:
+            return
+        self._index = {}
+        if not self.index_path.exists():
+            return
+        try:
+            self._index = json.loads(self.index_path.read_text())
+        except (OSError, ValueError) as e:
+            print(f'WARNING: Error loading aseprite cache index: {e}')
+
+    def make_key(self, file_hash, kw, colour_mode='rgb'):
+        frame, layers, ignore_layers = kw
+        version = f'native-{aseprite.VERSION}' if ASE_DECODER == 'native' else get_aseprite_version()
+        data = [file_hash, version, frame, layers, ignore_layers, colour_mode]
+        return hashlib.sha256(json.dumps(data).encode()).hexdigest()
+
+    def contains(self, key):
+        self._load_index()
+        if key not in self._index:
+            return False
+        try:
+            size = os.path.getsize(self.path / f'{key}.npy')
+        except OSError:
+            size = None
+        if size != self._index[key][0]:
+            # Removed or truncated file, the image is exported again
+            del self._index[key]
+            return False
+        self._used.add(key)
+        return True
+
+    def get(self, key):
+        self._load_index()
+        if key not in self._index:
+            return None
+        try:
+            data = np.load(self.path / f'{key}.npy', mmap_mode='r')
+        except (OSError, ValueError):
+            del self._index[key]
+            return None
+        self._index[key] = (self._index[key][0], time.time())
+        self._used.add(key)
+        return data
+
+    # Can be called from any process, written file needs to be registered with add afterwards
+    @staticmethod
+    def write(path, key, data):
+        path = pathlib.Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        tmp_path = path / f'{key}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, data)
+        os.replace(tmp_path, path / f'{key}.npy')
+
+    def add(self, key):
+        self._load_index()
+        self._index[key] = (os.path.getsize(self.path / f'{key}.npy'), time.time())
+        self._used.add(key)
+
+    def save(self):
+        if self._index is None:
+            return
+        total_size = sum(size for size, _ in self._index.values())
+        for key, (size, _) in sorted(self._index.items(), key=lambda x: x[1][1]):
+            if total_size <= self.max_size:
+                break
+            if key in self._used:
+                continue  # Images are mapped only when used so they need to stay until the end of the build
+            try:
+                os.unlink(self.path / f'{key}.npy')
+            except FileNotFoundError:
+                pass
+            del self._index[key]
+            total_size -= size
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.index_path.write_text(json.dumps(self._index))
+
+
+# Set to None to always run aseprite (--no-ase-cache)
+ASE_CACHE = AseExportCache('.cache/ase', max_size=2 << 30)
+
+_ASE_TMP_DIR = None
+
+
+# Returns where the exported images are stored, a temporary directory if cache is disabled
+def get_ase_store():
+    global _ASE_TMP_DIR
+    if ASE_CACHE is not None:
+        return ASE_CACHE
+    if _ASE_TMP_DIR is None:
+        tmpdir = tempfile.TemporaryDirectory(prefix='bonkygfx-ase-')
+        _ASE_TMP_DIR = (tmpdir, AseExportCache(tmpdir.name, max_size=None))
+    return _ASE_TMP_DIR[1]
+
+# Number of parallel processes for export_ase_files, None means number of CPUs
+ASE_JOBS = None
+
+
+# Exports all requested variants of aseprite files in parallel processes into the store.
+# Called automatically on the first AseImageFile.load as by then all the sprites did prepare_files.
+# Images are only mapped when some sprite reads them, see AseImageFile.
+def export_ase_files(files=None, jobs=None):
+    if files is None:
+        files = ASE_IDX.values()
+    if jobs is None:
+        jobs = ASE_JOBS or os.cpu_count() or 1
+    # generate.py registers the sprites at the module level so workers started any other way than fork
+    # would import it and start a build of their own
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        jobs = 1
+    files = [f for f in files if not f._exported and f._kw_requested]
+    if not files:
+        return
+
+    t0 = time.time()
+    store = get_ase_store()
+    exports = {}
+    num_cached = 0
+    for f in files:
+        missing = f._find_missing(store)
+        num_cached += len(f._kw_requested) - len(missing)
+        if missing:
+            exports[f] = missing
+
+    if jobs <= 1 or len(exports) <= 1:
+        for f, keys in exports.items():
+            f._store_exported(store, _export_ase_file(f.path, keys, ASE_DECODER, store.path))
+    else:
+        mp_context = multiprocessing.get_context('fork')
+        with concurrent.futures.ProcessPoolExecutor(max_workers=min(jobs, len(exports)), mp_context=mp_context) as executor:
+            futures = {f: executor.submit(_export_ase_file, f.path, keys, ASE_DECODER, store.path) for f, keys in exports.items()}
+            for f, future in futures.items():
+                f._store_exported(store, future.result())
+
+    for f in files:
+        f._exported = True
+
+    if ASE_CACHE is not None:
+        ASE_CACHE.save()
+
+    nkeys = sum(len(keys) for keys in exports.values())
+    print(f'Exported {nkeys} images from {len(exports)} aseprite files in {time.time() - t0:.02f} sec using {jobs} jobs, {num_cached} images loaded from cache')
+
+
+# Exports images with both aseprite executable and the native decoder and prints the differences
+def compare_ase_decoders(files):
+    total = mismatched = 0
+    for f in files:
+        keys = frozenset(f._kw_requested)
+        cli_images = _export_ase_file_cli(f.path, keys)
+        native_images = _export_ase_file_native(f.path, keys)
+        for kw in sorted(keys):
+            total += 1
+            expected = cli_images[kw][0]
+            actual = native_images[kw][0]
+            if expected.shape != actual.shape:
+                print(f'{f.path} {kw}: size mismatch, aseprite {expected.shape} native {actual.shape}')
+                mismatched += 1
+                continue
+            # Colour of fully transparent pixels doesn't matter
+            diff = (expected[:, :, 3] != actual[:, :, 3]) | (
+                (expected[:, :, 3] > 0) & (expected[:, :, :3] != actual[:, :, :3]).any(axis=2))
+            if diff.any():
+                y, x = np.argwhere(diff)[0]
+                print(f'{f.path} {kw}: {diff.sum()} pixels differ, first at ({x}, {y}): aseprite {tuple(expected[y, x].tolist())} native {tuple(actual[y, x].tolist())}')
+                mismatched += 1
+    print(f'Checked {total} images, {mismatched} mismatched')
+    return mismatched == 0
+
+
 class AseImageFile(grf.ImageFile):
     def __init__(self, *args, **kw):
         super().__init__(*args, **kw)
-        self._images = None
+        self._images = None  # kw -> (data, bpp) of the images mapped while file is loaded
         self._kw_requested = set()
+        self._kw_refs = Counter()  # kw -> number of prepared sprites that didn't read the image yet
+        self._cache_keys = {}  # kw -> key in the store
+        self._exported = False
 
     @staticmethod
     def _make_kw_key(frame=1, layers=None, ignore_layers=None):
@@ -1025,55 +1767,164 @@ class AseImageFile(grf.ImageFile):
         return (frame, tuple(layers or ()), tuple(ignore_layers or ()))
 
     def prepare(self, **kw):
-        self._kw_requested.add(self._make_kw_key(**kw))
-
-    def _load_frame(self, fname):
-        img = Image.open(fname)
-        if img.mode == 'P':
-            return (img, grf.BPP_8)
-        elif img.mode == 'RGB':
-            return (img, grf.BPP_24)
-        if img.mode != 'RGBA':
-            img = img.convert('RGBA')
-        return (img, grf.BPP_32)
+        key = self._make_kw_key(**kw)
+        if key not in self._kw_requested:
+            self._kw_requested.add(key)
+            self._exported = False
+        self._kw_refs[key] += 1
+
+    # Returns {kw: store key} of the requested images that aren't in the store
+    def _find_missing(self, store):
+        file_hash = get_file_hash(self.path)
+        missing = {}
+        for kw in self._kw_requested:
+            key = self._cache_keys[kw] = store.make_key(file_hash, kw)
+            if not store.contains(key):
+                missing[kw] = key
+        return missing
+
+    def _store_exported(self, store, exported):
+        for kw in exported:
+            store.add(self._cache_keys[kw])
 
     def load(self):
         # print('ASE LOAD', self.path, self._kw_requested)
         if self._images is not None:
             return
 
-        aseprite_executible = os.environ.get('ASEPRITE_EXECUTABLE', 'aseprite')
+        # Export all the files at once, it's much faster to do it in parallel
+        export_ase_files()
+        if not self._exported:
+            export_ase_files([self], jobs=1)
         self._images = {}
-        for kw in self._kw_requested:
-            frame, layers, ignore_layers = kw
-            with tempfile.NamedTemporaryFile(suffix='.png', delete=True) as f:
-                args = [aseprite_executible, '-b', str(self.path), '--color-mode', 'rgb']
-                for l in layers:
-                    args.extend(('--layer', l))
-                for l in ignore_layers:
-                    args.extend(('--ignore-layer', l))
-                args.extend(('--frame-range', f'{frame - 1},{frame - 1}'))
-                args.extend(['--save-as', f.name])
-                res = subprocess.run(args)
-                args_str = ' '.join(res.args)
-                if res.returncode != 0:
-                    raise RuntimeError(f'Aseprite returned non-zero code {res.returncode}, command line: {args_str}')
-                if not os.path.exists(f.name):
-                    raise RuntimeError(f'Aseprite didn''t create an output file {f.name}, command line: {args_str}')
-                try:
-                    self._images[kw] = self._load_frame(f.name)
-                except OSError as e:
-                    raise RuntimeError(f'Error loading aseprite output file {f.name}, command line: {args_str}')
 
     def unload(self):
-        for im in self._images.values():
-            im[0].close()
         self._images = None
 
-    def get_image(self, **kw):
+    # Called by sprites after reading the image, it's freed once all the sprites that prepared it are done
+    # and not when the whole file is unloaded (views returned by get_array still keep the data alive).
+    # Images read without prepare (debug commands) have no references and are freed right away.
+    def release(self, **kw):
+        key = self._make_kw_key(**kw)
+        refs = self._kw_refs.get(key, 0)
+        if refs > 1:
+            self._kw_refs[key] = refs - 1
+            return
+        self._kw_refs.pop(key, None)
+        if self._images is not None:
+            self._images.pop(key, None)
+
+    def _get(self, **kw):
         self.load()
         key = self._make_kw_key(**kw)
-        return self._images[key]
+        res = self._images.get(key)
+        if res is not None:
+            return res
+
+        store = get_ase_store()
+        data = None
+        if key in self._cache_keys and store.contains(self._cache_keys[key]):
+            data = store.get(self._cache_keys[key])
+        if data is None:
+            # Wasn't prepared before loading, was released already or the stored file is damaged
+            # (get drops the entry then so it's exported again)
+            self._kw_requested.add(key)
+            self._exported = False
+            export_ase_files([self], jobs=1)
+            data = store.get(self._cache_keys[key])
+        if data is None:
+            raise RuntimeError(f'Unable to load exported image {key} of {self.path} from {store.path}')
+        res = (data, grf.BPP_32 if data.shape[2] == 4 else grf.BPP_24)
+        self._images[key] = res
+        return res
+
+    def get_image(self, **kw):
+        data, bpp = self._get(**kw)
+        return Image.fromarray(data), bpp
+
+    # Returns the whole image as a read-only array, sprites take views of it instead of copying
+    def get_array(self, **kw):
+        data, bpp = self._get(**kw)
+        data.flags.writeable = False
+        return data, bpp
+
+
+# Memo of composed CompositeSprite layers for composites of the same layer sprites that are used several
+# times in one build. Sprites count their uses in prepare_files so the result is kept only while it's
+# still needed, least recently used results are dropped when total size goes over the max_size.
+# Keys are object ids, they are only valid during one build so NewGRF.write clears the memo.
+# Layer sprites are prepared once per key and composing takes that preparation, so images of the layers
+# are released as soon as they're composed even if the rest of the composites get the memoized result.
+class CompositeCache:
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.clear()
+
+    def clear(self):
+        self._uses = Counter()
+        self._prepared = set()  # keys with layer sprites prepared and not composed yet
+        self._layers = OrderedDict()  # key -> (w, h, rgb, alpha, mask)
+        self._size = 0
+        self.hits = 0
+
+    def make_key(self, sprite):
+        offset = None if sprite.offset is None else tuple(sprite.offset)
+        return (tuple(id(s) for s in sprite.sprites), sprite.exact_size, offset)
+
+    # Returns whether the layer sprites need to be prepared for this use
+    def add_use(self, key):
+        self._uses[key] += 1
+        if key in self._prepared:
+            return False
+        self._prepared.add(key)
+        return True
+
+    # Returns whether the layer sprites were prepared for composing (only one composite gets True)
+    def take_prepared(self, key):
+        if key not in self._prepared:
+            return False
+        self._prepared.remove(key)
+        return True
+
+    def _remove(self, key):
+        layers = self._layers.pop(key)
+        self._size -= self._get_size(layers)
+
+    @staticmethod
+    def _get_size(layers):
+        return sum(x.nbytes for x in layers[2:] if x is not None)
+
+    # Returned arrays are shared by all the users and read-only, copy them before modifying in-place
+    def get(self, key):
+        self._uses[key] -= 1
+        layers = self._layers.get(key)
+        if layers is None:
+            return None
+        self.hits += 1
+        if self._uses[key] <= 0:
+            self._remove(key)
+        else:
+            self._layers.move_to_end(key)
+        return layers
+
+    def set(self, key, layers):
+        if self._uses[key] <= 0:
+            return  # Not needed again
+        size = self._get_size(layers)
+        if size > self.max_size:
+            return
+        # Same arrays are returned to every user so nobody can modify them in-place
+        for x in layers[2:]:
+            if x is not None:
+                x.flags.writeable = False
+        self._layers[key] = layers
+        self._size += size
+        while self._size > self.max_size:
+            self._remove(next(iter(self._layers)))
+
+
+# Set to None to disable memoisation of composed sprites
+COMPOSITE_CACHE = CompositeCache(max_size=256 << 20)
 
 
 class CompositeSprite(grf.Sprite):
@@ -1086,13 +1937,37 @@ class CompositeSprite(grf.Sprite):
         self.sprites = sprites
         self.exact_size = exact_size
         self.offset = offset
+        self._cache_key = None
         super().__init__(sprites[0].w, sprites[0].h, xofs=sprites[0].xofs, yofs=sprites[0].yofs, zoom=sprites[0].zoom, **kw)
 
-    def prepare_files(self):
+    def _prepare_layers(self):
         for s in self.sprites:
             s.prepare_files()
 
+    def prepare_files(self):
+        if COMPOSITE_CACHE is None:
+            self._prepare_layers()
+            return
+        self._cache_key = COMPOSITE_CACHE.make_key(self)
+        if COMPOSITE_CACHE.add_use(self._cache_key):
+            self._prepare_layers()
+
     def get_data_layers(self, context):
+        cache = COMPOSITE_CACHE if self._cache_key is not None else None
+        if cache is not None:
+            layers = cache.get(self._cache_key)
+            if layers is not None:
+                return layers
+            # Only the first composite of the key prepares the layers, later ones compose only when the result
+            # was dropped from the memo (or is too big for it) and have to prepare them now
+            if not cache.take_prepared(self._cache_key):
+                self._prepare_layers()
+        layers = self._compose_layers(context)
+        if cache is not None:
+            cache.set(self._cache_key, layers)
+        return layers
+
+    def _compose_layers(self, context):
         npimg = None
         npalpha = None
         npmask = None
@@ -1131,36 +2006,37 @@ class CompositeSprite(grf.Sprite):
                     else:
                         npalpha = None
                 else:
+                    dst_rgb = npimg[dst]
                     full_mask = (cur_alpha == 255)
-                    partial_mask = (cur_alpha > 0) & ~full_mask
+                    np.copyto(dst_rgb, cur_rgb, where=full_mask[..., np.newaxis])
 
-                    npimg[dst][full_mask] = cur_rgb[full_mask]
+                    # Semi-transparent pixels only show where the image below isn't opaque so with no alpha there is nothing to do
                     if npalpha is not None:
-                        npalpha[dst][full_mask] = 255
-
-                    if npalpha is None:
-                        npalpha_norm_mask = np.full(partial_mask.sum(), 1.0)
-                    else:
-                        npalpha_norm_mask = npalpha[dst][partial_mask] / 255.0
-
-                    na_norm_mask = cur_alpha[partial_mask] / 255.0
-                    resa = npalpha_norm_mask + na_norm_mask * (1 - npalpha_norm_mask)
-
-                    # TODO compose in oklab ?
-                    npimg[dst][partial_mask] = (
-                        npimg[dst][partial_mask] * npalpha_norm_mask[..., np.newaxis] +
-                        cur_rgb[partial_mask] * (na_norm_mask * (1.0 - npalpha_norm_mask))[..., np.newaxis]
-                    ) / resa[..., np.newaxis]
-                    if npalpha is not None:
-                        npalpha[dst][partial_mask] = (resa * 255).astype(np.uint8)
+                        dst_alpha = npalpha[dst]
+                        np.copyto(dst_alpha, 255, where=full_mask)
+
+                        # Usually there are none or few of them so process only those
+                        if np.count_nonzero(cur_alpha) != np.count_nonzero(full_mask):
+                            ys, xs = np.nonzero(cur_alpha ^ full_mask * np.uint8(255))
+                            # TODO compose in oklab ?
+                            # Fixed-point version of alpha compositing: result alpha is (wd + ws) / 255 and colour
+                            # is weighted by wd and ws, everything fits uint32.
+                            da = dst_alpha[ys, xs].astype(np.uint32)
+                            wd = da * 255
+                            ws = cur_alpha[ys, xs] * (255 - da)
+                            resa = wd + ws
+                            dst_rgb[ys, xs] = (
+                                dst_rgb[ys, xs] * wd[:, np.newaxis] +
+                                cur_rgb[ys, xs] * ws[:, np.newaxis]
+                            ) // resa[:, np.newaxis]
+                            dst_alpha[ys, xs] = resa // 255
 
             if cur_mask is not None:
                 if npmask is None:
                     assert w == nw and h == nh  # TODO
                     npmask = cur_mask.copy()
                 else:
-                    mask = (cur_mask != 0)
-                    npmask[dst][mask] = cur_mask[mask]
+                    np.copyto(npmask[dst], cur_mask, where=(cur_mask != 0))
 
             timer.count_custom('Layering')
         return nw, nh, npimg, npalpha, npmask
@@ -1179,95 +2055,124 @@ class CompositeSprite(grf.Sprite):
         }
 
 
+# Same as OpenTTD's AdjustBrightness but for arrays, c is (..., 3) colours and brightness
+# has the remaining dimensions. Returns uint8 array of the adjusted colours.
 def adjust_brightness(c, brightness):
-    if brightness == 128:
-        return c
-
-    r, g, b = c
-    combined = (r << 32) | (g << 16) | b
-    combined *= brightness
+    c = np.asarray(c, dtype=np.int32)
+    brightness = np.asarray(brightness, dtype=np.int32)
+    rgb = (c * brightness[..., np.newaxis]) >> 7
 
-    r = (combined >> 39) & 0x1ff
-    g = (combined >> 23) & 0x1ff
-    b = (combined >> 7) & 0x1ff
+    # Sum overbright and reduce its strength
+    ob = np.maximum(rgb - 255, 0).sum(axis=-1, keepdims=True) // 2
+    res = np.where(rgb >= 255, 255, np.minimum(rgb + ob * (255 - rgb) // 256, 255))
+    return res.astype(np.uint8)
 
-    if (combined & 0x800080008000) == 0:
-        return (r, g, b)
 
-    ob = 0
-    # Sum overbright
-    if r > 255: ob += r - 255
-    if g > 255: ob += g - 255
-    if b > 255: ob += b - 255
+DEBUG_PADDING = 10
 
-    # Reduce overbright strength
-    ob //= 2
-    return (
-        255 if r >= 255 else min(r + ob * (255 - r) // 256, 255),
-        255 if g >= 255 else min(g + ob * (255 - g) // 256, 255),
-        255 if b >= 255 else min(b + ob * (255 - b) // 256, 255),
-    )
-
-
-def debug_recolour(sprites, recolours, horizontal=False):
-    PADDING = 10
 
+def _get_debug_layers(sprites):
     context = grf.WriteContext()
     slayers = []
     for i, s in enumerate(sprites):
         s.prepare_files()
     for i, s in enumerate(sprites):
-        slayers.append(s.get_data_layers(context))
+        layers = s.get_data_layers(context)
+        if layers[4] is None:
+            raise ValueError(f'Sprite {s.name} has no mask!')
+        slayers.append(layers)
+    return slayers
 
+
+# Positions of the sprites for each of the count recolours and total size of the image
+def _layout_debug_tiles(slayers, count, horizontal):
     pos = []
     if horizontal:
         maxw = max(x[0] for x in slayers)
-        x = PADDING
-        for i in range(len(recolours)):
-            y = PADDING
+        x = DEBUG_PADDING
+        for i in range(count):
+            y = DEBUG_PADDING
             row = []
             for s in slayers:
                 row.append(((x, y)))
-                y += s[1] + PADDING
+                y += s[1] + DEBUG_PADDING
             pos.append(row)
-            x += maxw + PADDING
+            x += maxw + DEBUG_PADDING
     else:
         # s = (sumh + (len(slayers) + 1) * PADDING, maxw + 2 * PADDING)
-        y = PADDING
+        y = DEBUG_PADDING
         maxh = max(x[1] for x in slayers)
-        for i in range(len(recolours)):
-            x = PADDING
+        for i in range(count):
+            x = DEBUG_PADDING
             row = []
             for s in slayers:
                 row.append(((x, y)))
-                x += s[0] + PADDING
+                x += s[0] + DEBUG_PADDING
             pos.append(row)
-            y += maxh + PADDING
+            y += maxh + DEBUG_PADDING
+    return pos, x, y
 
-    npres = np.zeros((y, x, 4), dtype=np.uint8)
-    for jj, s, (w, h, rgb, alpha, mask) in zip(range(len(sprites)), sprites, slayers):
-        if mask is None:
-            raise ValueError(f'Sprite {s.name} has no mask!')
 
-        for ii, recolour in enumerate(recolours):
-            x, y = pos[ii][jj]
-            for i in range(h):
-                for j in range(w):
-                    mrgb = recolour.get(mask[i, j])
-                    if mrgb is None:
-                        npres[y + i, x + j, :3] = rgb[i, j, :]
-                    else:
-                        b = max(rgb[i, j])
-                        npres[y + i, x + j, :3] = adjust_brightness(mrgb, b)
-                    if alpha is not None:
-                        npres[y + i, x + j, 3] = alpha[i, j]
-                    else:
-                        npres[y + i, x + j, 3] = 255
+# Recolour as lookup tables by mask value
+def _make_recolour_table(recolour):
+    colours = np.zeros((256, 3), dtype=np.int32)
+    used = np.zeros(256, dtype=bool)
+    for k, v in recolour.items():
+        colours[k] = v
+        used[k] = True
+    return colours, used
+
+
+def _draw_recoloured(npres, x, y, layers, table):
+    w, h, rgb, alpha, mask = layers
+    colours, used = table
+    tile = npres[y:y + h, x:x + w]
+    tile[:, :, :3] = rgb
+    recoloured = used[mask]
+    tile[recoloured, :3] = adjust_brightness(colours[mask[recoloured]], rgb[recoloured].max(axis=1))
+    tile[:, :, 3] = 255 if alpha is None else alpha
+
+
+def debug_recolour(sprites, recolours, horizontal=False):
+    slayers = _get_debug_layers(sprites)
+    pos, w, h = _layout_debug_tiles(slayers, len(recolours), horizontal)
+
+    npres = np.zeros((h, w, 4), dtype=np.uint8)
+    for ii, recolour in enumerate(recolours):
+        table = _make_recolour_table(recolour)
+        for (x, y), layers in zip(pos[ii], slayers):
+            _draw_recoloured(npres, x, y, layers, table)
 
     im = Image.fromarray(npres, mode='RGBA')
     im.show()
 
 
+# Same as debug_recolour but each recolour goes into a separate frame of animation
+def render_recolour_frames(sprites, recolours, horizontal=False):
+    slayers = _get_debug_layers(sprites)
+    pos, w, h = _layout_debug_tiles(slayers, 1, horizontal)
+
+    frames = []
+    for recolour in recolours:
+        table = _make_recolour_table(recolour)
+        npres = np.zeros((h, w, 4), dtype=np.uint8)
+        for (x, y), layers in zip(pos[0], slayers):
+            _draw_recoloured(npres, x, y, layers, table)
+        frames.append(Image.fromarray(npres, mode='RGBA'))
+    return frames
+
+
+# Saves frames as animated gif or png (apng) depending on the file extension
+def save_animation(frames, path, fps):
+    path = pathlib.Path(path)
+    fmt = {'.gif': 'GIF', '.png': 'PNG', '.apng': 'PNG'}.get(path.suffix.lower())
+    if fmt is None:
+        raise ValueError(f'Unsupported animation format "{path.suffix}", use .gif, .png or .apng')
+    kw = {'disposal': 2} if fmt == 'GIF' else {}  # Clear transparent parts between the frames
+    frames[0].save(path, format=fmt, save_all=True, append_images=frames[1:], duration=round(1000 / fps), loop=0, **kw)
+    print(f'Saved {len(frames)} frames at {fps} fps to {path}')
+
+
 def debug_cc_recolour(sprites, horizontal=False):
     recolours = []
     for cl in grf.CC_COLOURS:
@@ -1288,7 +2193,7 @@ def debug_struct_recolour(sprites, horizontal=False):
     debug_recolour(sprites, recolours, horizontal=horizontal)
 
 
-def debug_light_cycle(sprites, horizontal=False):
+def debug_light_cycle(sprites, output, fps=4, horizontal=False):
     ON = (240, 208, 0)
     OFF = (0, 0, 0)
     recolours = [
@@ -1297,4 +2202,64 @@ def debug_light_cycle(sprites, horizontal=False):
         {0xf1: OFF, 0xf2: ON, 0xf3: OFF, 0xf4: OFF},
         {0xf1: ON, 0xf2: OFF, 0xf3: OFF, 0xf4: OFF},
     ]
-    debug_recolour(sprites, recolours, horizontal=horizontal)
+    save_animation(render_recolour_frames(sprites, recolours, horizontal=horizontal), output, fps)
+
+
+# Number of ticks after which all the palette animation cycles repeat
+PALETTE_ANIMATION_TICKS = 128
+
+
+# Palette animation cycles of OpenTTD (same tables as in grf-py Sprite.save_gif)
+PALETTE_CYCLES = {
+    'dark_water': ((32, 68, 112), (36, 72, 116), (40, 76, 120), (44, 80, 124), (48, 84, 128)),
+    'dark_water_toyland': ((28, 108, 124), (32, 112, 128), (36, 116, 132), (40, 120, 136), (44, 124, 140)),
+    'lighthouse': ((240, 208, 0), (0, 0, 0), (0, 0, 0), (0, 0, 0)),
+    'oil_refinery': ((252, 60, 0), (252, 84, 0), (252, 108, 0), (252, 124, 0), (252, 148, 0), (252, 172, 0), (252, 196, 0)),
+    'fizzy_drink': ((76, 24, 8), (108, 44, 24), (144, 72, 52), (176, 108, 84), (212, 148, 128)),
+    'glittery_water': (
+        (216, 244, 252), (172, 208, 224), (132, 172, 196), (100, 132, 168),
+        (72, 100, 144), (72, 100, 144), (72, 100, 144), (72, 100, 144),
+        (72, 100, 144), (72, 100, 144), (72, 100, 144), (72, 100, 144),
+        (100, 132, 168), (132, 172, 196), (172, 208, 224)),
+    'glittery_water_toyland': (
+        (216, 244, 252), (180, 220, 232), (148, 200, 216), (116, 180, 196),
+        (92, 164, 184), (92, 164, 184), (92, 164, 184), (92, 164, 184),
+        (92, 164, 184), (92, 164, 184), (92, 164, 184), (92, 164, 184),
+        (116, 180, 196), (148, 200, 216), (180, 220, 232)),
+}
+
+
+# Colours of the animated part of the palette (0xE3-0xFE) for OpenTTD's palette animation counter
+# (incremented by 8 every tick), same as DoPaletteAnimations in OpenTTD.
+def get_animated_palette(counter, toyland=False):
+    extr = lambda p, q: ((counter * p) & 0xffff) * q >> 16
+    extr2 = lambda p, q: ((~counter * p) & 0xffff) * q >> 16
+
+    res = {}
+
+    # Palette colours first..first + count - 1 take every step-th colour of the cycle starting from j
+    def cycle(first, count, colours, j, step=1):
+        for i in range(count):
+            res[first + i] = colours[(j + i * step) % len(colours)]
+
+    cycle(0xe3, 5, PALETTE_CYCLES['fizzy_drink'], extr2(512, 5))
+    cycle(0xe8, 7, PALETTE_CYCLES['oil_refinery'], extr2(512, 7))
+
+    # Radio tower blinking
+    i = (counter >> 1) & 0x7f
+    for m in (0xef, 0xf0):
+        v = 255 if i < 0x3f else 128 if i < 0x4a or i >= 0x75 else 20
+        res[m] = (v, 0, 0)
+        i ^= 0x40
+
+    suffix = '_toyland' if toyland else ''
+    cycle(0xf1, 4, PALETTE_CYCLES['lighthouse'], extr(256, 4))
+    cycle(0xf5, 5, PALETTE_CYCLES['dark_water' + suffix], extr(320, 5))
+    cycle(0xfa, 5, PALETTE_CYCLES['glittery_water' + suffix], extr(128, 15), step=3)
+    return res
+
+
+def debug_palette_animation(sprites, output, fps=30, horizontal=False, toyland=False):
+    static = {m: grf.PALETTE[m] for m in range(1, 0xe3)}
+    recolours = [{**static, **get_animated_palette(t * 8, toyland=toyland)} for t in range(PALETTE_ANIMATION_TICKS)]
+    save_animation(render_recolour_frames(sprites, recolours, horizontal=horizontal), output, fps)
@@ -0,0 +1,5 @@
+import pathlib
+import sys
+
+# generate.py and lib.py are run from the repository root, make them importable the same way in tests
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
@@ -0,0 +1,121 @@
+import os
+import pathlib
+import shutil
+import struct
+
+import numpy as np
+import pytest
+
+import aseprite
+import lib
+
+
+# Writes a one-frame 32bpp aseprite file, layers are (name, child_level, is_group, blend_mode, opacity)
+# from the bottom one and cels are {layer index: (x, y, RGBA pixels)}
+def write_ase(path, width, height, layers, cels, flags=aseprite.HEADER_LAYER_OPACITY_VALID, cel_type=aseprite.CEL_RAW):
+    chunks = []
+    for name, child_level, is_group, blend_mode, opacity in layers:
+        name = name.encode()
+        layer_type = aseprite.LAYER_TYPE_GROUP if is_group else aseprite.LAYER_TYPE_IMAGE
+        data = struct.pack('<HHHHHHB3xH', aseprite.LAYER_VISIBLE, layer_type, child_level, 0, 0, blend_mode, opacity, len(name)) + name
+        chunks.append((aseprite.CHUNK_LAYER, data))
+    for index, (x, y, pixels) in cels.items():
+        h, w = pixels.shape[:2]
+        data = struct.pack('<HhhBHh5xHH', index, x, y, 255, cel_type, 0, w, h) + pixels.astype(np.uint8).tobytes()
+        chunks.append((aseprite.CHUNK_CEL, data))
+
+    frame = b''.join(struct.pack('<IH', len(data) + 6, chunk_type) + data for chunk_type, data in chunks)
+    frame = struct.pack('<IHHH2xI', len(frame) + 16, aseprite.FRAME_MAGIC, len(chunks), 100, len(chunks)) + frame
+    header = struct.pack('<IHHHHHIH', 128 + len(frame), aseprite.HEADER_MAGIC, 1, width, height, 32, flags, 100).ljust(128, b'\0')
+    path.write_bytes(header + frame)
+
+
+def solid(w, h, colour):
+    return np.broadcast_to(np.array(colour, dtype=np.uint8), (h, w, 4))
+
+
+BACKGROUND = ('background', 0, False, aseprite.BLEND_NORMAL, 255)
+
+
+def test_render_layers(tmp_path):
+    path = tmp_path / 'layers.ase'
+    write_ase(path, 3, 2, [
+        BACKGROUND,
+        ('half', 0, False, aseprite.BLEND_NORMAL, 128),
+        ('hidden_cel', 0, False, aseprite.BLEND_NORMAL, 255),
+    ], {
+        0: (0, 0, solid(3, 2, (0, 0, 255, 255))),
+        1: (1, 0, solid(1, 1, (255, 0, 0, 255))),
+        2: (5, 5, solid(1, 1, (0, 255, 0, 255))),  # outside of the canvas
+    })
+    img = aseprite.AseFile(path).render()
+    assert img[0, 0].tolist() == [0, 0, 255, 255]
+    assert img[0, 1].tolist() == [128, 0, 127, 255]
+    assert img[1, 2].tolist() == [0, 0, 255, 255]
+
+
+GROUP_LAYERS = [
+    BACKGROUND,
+    ('group', 0, True, aseprite.BLEND_NORMAL, 128),
+    ('red', 1, False, aseprite.BLEND_NORMAL, 255),
+    ('mul', 0, True, aseprite.BLEND_MULTIPLY, 255),
+    ('grey', 1, False, aseprite.BLEND_NORMAL, 255),
+]
+GROUP_CELS = {
+    0: (0, 0, solid(2, 1, (200, 100, 50, 255))),
+    2: (0, 0, solid(1, 1, (255, 0, 0, 255))),
+    4: (1, 0, solid(1, 1, (128, 128, 128, 255))),
+}
+
+
+def test_render_legacy_groups(tmp_path):
+    # Group opacity and blend mode aren't valid without the header flag, layers are drawn directly
+    path = tmp_path / 'legacy.ase'
+    layers = [l[:3] + (0, 0) if l[2] else l for l in GROUP_LAYERS]
+    write_ase(path, 2, 1, layers, GROUP_CELS)
+    img = aseprite.AseFile(path).render()
+    assert img.tolist() == [[[255, 0, 0, 255], [128, 128, 128, 255]]]
+
+
+def test_render_composed_groups(tmp_path):
+    path = tmp_path / 'groups.ase'
+    write_ase(path, 2, 1, GROUP_LAYERS, GROUP_CELS,
+              flags=aseprite.HEADER_LAYER_OPACITY_VALID | aseprite.HEADER_GROUP_OPACITY_VALID)
+    ase = aseprite.AseFile(path)
+    img = ase.render()
+    # Red at 50% group opacity over the background, grey multiplied with it
+    assert img.tolist() == [[[227, 50, 25, 255], [100, 50, 25, 255]]]
+
+    requests = [(1, (), ()), (1, ('background', 'group/red'), ()), (1, (), ('mul', ))]
+    res = ase.render_many(requests)
+    for r in requests:
+        assert np.array_equal(res[r], ase.render(*r))
+    assert res[requests[2]][0, 1].tolist() == [200, 100, 50, 255]
+
+
+def test_tilemap_cels_are_rejected(tmp_path):
+    path = tmp_path / 'tilemap.ase'
+    write_ase(path, 1, 1, [BACKGROUND], {0: (0, 0, solid(1, 1, (0, 0, 0, 255)))}, cel_type=aseprite.CEL_COMPRESSED_TILEMAP)
+    with pytest.raises(ValueError, match='Tilemap cels are not supported'):
+        aseprite.AseFile(path)
+
+
+SPRITES_DIR = pathlib.Path(__file__).resolve().parent.parent / 'sprites'
+
+
+# Every frame of every sprite file in the repository is rendered the same way aseprite does it
+@pytest.mark.skipif(shutil.which(os.environ.get('ASEPRITE_EXECUTABLE', 'aseprite')) is None,
+                    reason='aseprite executable not found')
+@pytest.mark.parametrize('path', sorted(SPRITES_DIR.glob('**/*.ase*')), ids=lambda p: str(p.relative_to(SPRITES_DIR)))
+def test_render_matches_aseprite(path):
+    ase = aseprite.AseFile(path)
+    keys = frozenset((frame, (), ()) for frame in range(1, len(ase.frames) + 1))
+    expected = lib._export_ase_file_cli(path, keys)
+    actual = ase.render_many(keys)
+    for kw in sorted(keys):
+        e, a = expected[kw][0], actual[kw]
+        assert e.shape == a.shape, kw
+        assert np.array_equal(e[:, :, 3], a[:, :, 3]), kw
+        # Colour of fully transparent pixels doesn't matter
+        visible = e[:, :, 3] > 0
+        assert np.array_equal(e[visible, :3], a[visible, :3]), kw
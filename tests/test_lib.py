@@ -0,0 +1,942 @@
+import json
+import os
+import pathlib
+import shutil
+import subprocess
+
+import numpy as np
+import pytest
+
+import grf
+
+import lib
+
+
+# Sprite with fixed data layers
+class ArraySprite(grf.Sprite):
+    def __init__(self, rgb, alpha=None, mask=None, name='array'):
+        h, w = rgb.shape[:2]
+        super().__init__(w=w, h=h, xofs=0, yofs=0, zoom=grf.ZOOM_NORMAL, bpp=32, name=name)
+        self.rgb = rgb
+        self.alpha = alpha
+        self.mask = mask
+
+    def get_data_layers(self, context):
+        return self.w, self.h, self.rgb, self.alpha, self.mask
+
+
+MAGENTA = (255, 0, 255)
+# Light order colours in the order they are painted, from the darkest to the brightest
+ORDER_COLOURS = [(10, 10, 10), (60, 0, 60), (200, 20, 20), (250, 250, 250)]
+
+
+def make_light_sprites(uncovered=False):
+    rgb = np.zeros((2, 4, 3), dtype=np.uint8)
+    rgb[0, :] = MAGENTA
+    rgb[1, :] = (0, 128, 0)
+    order_rgb = np.zeros((2, 4, 3), dtype=np.uint8)
+    order_alpha = np.zeros((2, 4), dtype=np.uint8)
+    order_rgb[0, :] = ORDER_COLOURS
+    order_alpha[0, :] = 255
+    # Non-magenta pixels covered by the order layer still get no light
+    order_rgb[1, 0] = ORDER_COLOURS[0]
+    order_alpha[1, 0] = 255
+    if uncovered:
+        order_alpha[0, 2] = 0
+    return ArraySprite(rgb, name='light'), ArraySprite(order_rgb, order_alpha, name='order')
+
+
+def test_magenta_to_light_maps_brightest_to_darkest():
+    sprite, order = make_light_sprites()
+    w, h, rgb, alpha, mask = lib.MagentaToLight(sprite, order).get_data_layers(grf.DummyWriteContext())
+    assert (w, h) == (4, 2)
+    assert mask.tolist() == [
+        [0xf4, 0xf3, 0xf2, 0xf1],
+        [0, 0, 0, 0],
+    ]
+
+
+def test_magenta_to_light_uncovered_magenta():
+    sprite, order = make_light_sprites(uncovered=True)
+    # Order layer has only 3 colours left, make it 4 again with a pixel outside of the magenta area
+    order.rgb[1, 1] = ORDER_COLOURS[2]
+    order.alpha[1, 1] = 255
+    with pytest.raises(ValueError, match=r'Not all magenta pixels of sprite light have a defined order in order: \(2, 0\)$'):
+        lib.MagentaToLight(sprite, order).get_data_layers(grf.DummyWriteContext())
+
+
+
+# Per-pixel version of the recolouring RecolourTable replaced, value_map is {magenta value: (rgb, mask index)}
+def recolour_per_pixel(rgb, mask, value_map):
+    rgb = rgb.copy()
+    mask = np.zeros(rgb.shape[:2], dtype=np.uint8) if mask is None else mask.copy()
+    for y, x in np.ndindex(*rgb.shape[:2]):
+        r, g, b = map(int, rgb[y, x])
+        is_magenta = r == b and ((r == 255 and g != 255) or (g == 0 and r != 0))
+        if is_magenta and mask[y, x] == 0:
+            rgb[y, x], mask[y, x] = value_map[r + g]
+    return rgb, mask
+
+
+def random_magenta_image(rng, w, h):
+    rgb = rng.integers(0, 256, (h, w, 3), dtype=np.uint8)
+    # Plenty of red == blue pixels, some are magenta and some aren't (black, white, greys)
+    rgb[:, ::2, 2] = rgb[:, ::2, 0]
+    rgb[::2, ::2, 0] = rgb[::2, ::2, 2] = 255
+    rgb[1::4, ::4, 1] = 0
+    rgb[0, :4] = ((0, 0, 0), (255, 255, 255), (255, 254, 255), (1, 0, 1))
+    return rgb
+
+
+@pytest.mark.parametrize('seed', range(4))
+def test_recolour_table_matches_per_pixel(seed):
+    rng = np.random.default_rng(seed)
+    vtb = rng.integers(0, 256, 511)
+    vti = rng.integers(0, 8, 511)
+    table = lib.RecolourTable(9, 0x40, vtb, vti)
+    value_map = {v: ((vtb[v], 0, 0), vti[v] + 0x40) for v in range(511)}
+    w, h = 32, 24
+    rgb = random_magenta_image(rng, w, h)
+    # Pixels that already have a mask keep it and their colour
+    mask = rng.choice(np.array([0, 0, 0, 0x50, 0xC6], dtype=np.uint8), (h, w))
+    for m in (None, mask):
+        expected = recolour_per_pixel(rgb, m, value_map)
+        res_rgb, res_mask = table.apply(w, h, rgb.copy(), None if m is None else m.copy())
+        assert np.array_equal(res_rgb, expected[0]) and np.array_equal(res_mask, expected[1])
+
+
+def test_magenta_to_cc_matches_per_pixel():
+    value_map = {v: ((b, 0, 0), i + 0xC6) for v, (b, i) in enumerate(zip(lib.CC_VALUE_TO_BRIGHTNESS, lib.CC_VALUE_TO_INDEX))}
+    # Every colour with red == blue
+    rgb = np.zeros((256, 256, 3), dtype=np.uint8)
+    rgb[:, :, 0] = rgb[:, :, 2] = np.arange(256)[:, np.newaxis]
+    rgb[:, :, 1] = np.arange(256)[np.newaxis, :]
+    expected = recolour_per_pixel(rgb, None, value_map)
+    res_rgb, res_mask = lib.MAGENTA_TO_CC.apply(256, 256, rgb.copy(), None)
+    assert np.array_equal(res_rgb, expected[0]) and np.array_equal(res_mask, expected[1])
+
+
+# Per-value colour ramp MagentaToColour calculated before get_colour_ramp
+def colour_ramp_per_value(colour):
+    oklab_colour = grf.srgb_to_oklab(colour)
+    BLACK = grf.srgb_to_oklab((0, 0, 0))
+    WHITE = grf.srgb_to_oklab((255, 255, 255))
+    value_map = np.zeros((255 * 2, 3), dtype=np.uint8)
+    for v in range(1, 255 * 2):
+        if v < 255:
+            value_map[v] = grf.oklab_to_srgb(grf.oklab_blend(BLACK, oklab_colour, v / 255.))
+        elif v > 255:
+            value_map[v] = grf.oklab_to_srgb(grf.oklab_blend(oklab_colour, WHITE, (v - 255) / 255.))
+        else:
+            value_map[v] = colour
+    return value_map
+
+
+# Face colours and the base colour of every company colour ramp
+@pytest.mark.parametrize('colour', [(255, 176, 112), (128, 88, 56), (105, 64, 37)] + [
+    tuple(grf.PALETTE[ramp[0]]) for ramp in grf.CC_COLOURS])
+def test_colour_ramp_matches_per_value(colour):
+    ramp = lib.get_colour_ramp(colour)
+    assert np.array_equal(ramp, colour_ramp_per_value(colour))
+    assert not ramp.flags.writeable and lib.get_colour_ramp(colour) is ramp
+
+
+# Row by row ground mask CutGround and MaskGround built before get_ground_mask, only ever used with z == 2
+def ground_mask_per_row(z, above_l, above_r):
+    tile_ws = 32 * z
+    tile_hs = 16 * z
+    above_h = max(above_l, above_r)
+    h = 32 * z - 1 + above_h
+    ground_mask = np.full((h, 64 * z), True)
+
+    def get_n(i, above):
+        i -= above_h - above
+        n = i if i < tile_hs + above else 31 * z - i + above
+        return max(0, min((n + 1) * 2, tile_ws))
+
+    for i in range(h):
+        nl = get_n(i, above_l)
+        nr = get_n(i, above_r)
+        ground_mask[i, tile_ws - nl: tile_ws + nr] = False
+    return ground_mask
+
+
+# Templates use the plain tile (MaskGround and CutGround) and tiles extended by 10 pixels on either side at 2x zoom
+@pytest.mark.parametrize('above_l, above_r', [(0, 0), (0, 20), (20, 0), (20, 20), (6, 0), (0, 13), (40, 40)])
+def test_ground_mask_matches_per_row(above_l, above_r):
+    ground_mask = lib.get_ground_mask(2, above_l, above_r)
+    assert np.array_equal(ground_mask, ground_mask_per_row(2, above_l, above_r))
+    assert not ground_mask.flags.writeable
+
+
+def test_match_palette_exact_colours():
+    colours = list(grf.PALETTE_IDX.items())
+    rgb = np.array([[c for c, _ in colours]], dtype=np.uint8)
+    res = lib.match_palette(rgb, np.ones(rgb.shape[:2], dtype=bool), ArraySprite(rgb))
+    assert res.tolist() == [i for _, i in colours]
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_match_palette_matches_dict_lookup(seed):
+    rng = np.random.default_rng(seed)
+    palette = np.array(list(grf.PALETTE_IDX.keys()), dtype=np.uint8)
+    rgb = palette[rng.integers(len(palette), size=(24, 32))]
+    pixel_mask = rng.random((24, 32)) < 0.7
+    # Colours outside of the mask don't need to be in the palette
+    rgb[~pixel_mask & (rng.random((24, 32)) < 0.5)] = (1, 2, 3)
+    res = lib.match_palette(rgb, pixel_mask, ArraySprite(rgb))
+    assert res.dtype == np.uint8
+    assert res.tolist() == [grf.PALETTE_IDX[tuple(c)] for c in rgb[pixel_mask].tolist()]
+
+
+def test_match_palette_missing_colours():
+    rgb = np.zeros((3, 8, 3), dtype=np.uint8)
+    rgb[:] = next(iter(grf.PALETTE_IDX))
+    rgb[0, 1] = rgb[2, 0] = (1, 2, 3)
+    rgb[1, :7] = (0, 0, 1)  # below the smallest packed palette colour
+    sprite = grf.FileSprite(grf.ImageFile('unused.png'), 10, 20, 8, 3, name='pal')
+    with pytest.raises(ValueError) as e:
+        lib.match_palette(rgb, np.ones((3, 8), dtype=bool), sprite)
+    # Positions are in the image file
+    assert str(e.value) == (
+        'Colors not in the palette in sprite pal: '
+        '(0, 0, 1) at (10, 21), (11, 21), (12, 21), (13, 21), (14, 21) and 2 more; '
+        '(1, 2, 3) at (11, 20), (10, 22)')
+
+# Float alpha compositing CompositeSprite used before the fixed-point version, for same-size layers
+def compose_float(layers):
+    npimg = layers[0][0].copy()
+    npalpha = None if layers[0][1] is None else layers[0][1].copy()
+    for cur_rgb, cur_alpha in layers[1:]:
+        full_mask = (cur_alpha == 255)
+        partial_mask = (cur_alpha > 0) & ~full_mask
+        npimg[full_mask] = cur_rgb[full_mask]
+        if npalpha is not None:
+            npalpha[full_mask] = 255
+        if npalpha is None:
+            npalpha_norm_mask = np.full(partial_mask.sum(), 1.0)
+        else:
+            npalpha_norm_mask = npalpha[partial_mask] / 255.0
+        na_norm_mask = cur_alpha[partial_mask] / 255.0
+        resa = npalpha_norm_mask + na_norm_mask * (1 - npalpha_norm_mask)
+        npimg[partial_mask] = (
+            npimg[partial_mask] * npalpha_norm_mask[..., np.newaxis] +
+            cur_rgb[partial_mask] * (na_norm_mask * (1.0 - npalpha_norm_mask))[..., np.newaxis]
+        ) / resa[..., np.newaxis]
+        if npalpha is not None:
+            npalpha[partial_mask] = (resa * 255).astype(np.uint8)
+    return npimg, npalpha
+
+
+def random_layer(rng, w, h, with_alpha=True):
+    rgb = rng.integers(0, 256, (h, w, 3), dtype=np.uint8)
+    if not with_alpha:
+        return rgb, None
+    # Mostly fully transparent or opaque pixels like in real sprites, but plenty of partial ones
+    alpha = rng.choice(np.array([0, 255, 1, 254, 128], dtype=np.uint8), (h, w))
+    partial = rng.random((h, w)) < 0.5
+    alpha[partial] = rng.integers(0, 256, partial.sum(), dtype=np.uint8)
+    return rgb, alpha
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_composite_matches_float_compositing(seed):
+    rng = np.random.default_rng(seed)
+    w, h = 64, 31
+    layers = [random_layer(rng, w, h) for _ in range(rng.integers(2, 5))]
+    sprite = lib.CompositeSprite([ArraySprite(rgb, alpha) for rgb, alpha in layers])
+    _, _, rgb, alpha, mask = sprite.get_data_layers(grf.DummyWriteContext())
+    expected_rgb, expected_alpha = compose_float(layers)
+    assert mask is None
+    assert np.abs(rgb.astype(np.int16) - expected_rgb).max() <= 1
+    assert np.abs(alpha.astype(np.int16) - expected_alpha).max() <= 1
+
+
+def test_composite_partial_alpha_on_opaque_destination():
+    # Without destination alpha the destination is opaque so only fully opaque source pixels change it
+    rng = np.random.default_rng(0)
+    w, h = 16, 8
+    dst = random_layer(rng, w, h, with_alpha=False)
+    src = random_layer(rng, w, h)
+    sprite = lib.CompositeSprite([ArraySprite(*dst), ArraySprite(*src)])
+    _, _, rgb, alpha, _ = sprite.get_data_layers(grf.DummyWriteContext())
+    expected_rgb, expected_alpha = compose_float([dst, src])
+    assert alpha is None and expected_alpha is None
+    assert np.array_equal(rgb, expected_rgb)
+    assert np.array_equal(rgb[src[1] == 255], src[0][src[1] == 255])
+    assert np.array_equal(rgb[src[1] != 255], dst[0][src[1] != 255])
+
+
+
+def test_composite_all_alpha_pairs():
+    # Every destination alpha (rows) with every source alpha (columns) for a few colours
+    rng = np.random.default_rng(0)
+    alphas = np.arange(256, dtype=np.uint8)
+    for _ in range(4):
+        dst = (np.broadcast_to(rng.integers(0, 256, 3, dtype=np.uint8), (256, 256, 3)).copy(),
+               np.repeat(alphas[:, np.newaxis], 256, axis=1))
+        src = (np.broadcast_to(rng.integers(0, 256, 3, dtype=np.uint8), (256, 256, 3)).copy(),
+               np.repeat(alphas[np.newaxis, :], 256, axis=0))
+        _, _, rgb, alpha, _ = lib.CompositeSprite([ArraySprite(*dst), ArraySprite(*src)]).get_data_layers(grf.DummyWriteContext())
+        expected_rgb, expected_alpha = compose_float([dst, src])
+        assert np.abs(rgb.astype(np.int16) - expected_rgb).max() <= 1
+        assert np.abs(alpha.astype(np.int16) - expected_alpha).max() <= 1
+
+
+def test_composite_binary_alpha_is_exact():
+    # Layers with only transparent and opaque pixels skip blending, the top opaque pixel wins
+    rng = np.random.default_rng(1)
+    layers = [random_layer(rng, 16, 8) for _ in range(3)]
+    for _, alpha in layers:
+        alpha[:] = np.where(alpha >= 128, 255, 0)
+    _, _, rgb, alpha, _ = lib.CompositeSprite([ArraySprite(rgb, alpha) for rgb, alpha in layers]).get_data_layers(grf.DummyWriteContext())
+    expected_rgb, expected_alpha = compose_float(layers)
+    assert np.array_equal(rgb, expected_rgb) and np.array_equal(alpha, expected_alpha)
+
+
+def test_composite_offset_layer_with_mask():
+    # Source layer is offset and partly outside of the destination, only the overlap is composed
+    rng = np.random.default_rng(2)
+    dst_rgb, dst_alpha = random_layer(rng, 8, 6)
+    src_rgb, src_alpha = random_layer(rng, 4, 4)
+    dst_mask = rng.integers(0, 3, (6, 8), dtype=np.uint8)
+    src_mask = rng.integers(0, 3, (4, 4), dtype=np.uint8)
+    sprite = lib.CompositeSprite([
+        ArraySprite(dst_rgb, dst_alpha, dst_mask),
+        ArraySprite(src_rgb, src_alpha, src_mask),
+    ], exact_size=False, offset=(6, -1))
+    w, h, rgb, alpha, mask = sprite.get_data_layers(grf.DummyWriteContext())
+    assert (w, h) == (8, 6)
+
+    area, src_area = np.s_[0:3, 6:8], np.s_[1:4, 0:2]
+    expected_rgb, expected_alpha = dst_rgb.copy(), dst_alpha.copy()
+    expected_rgb[area], expected_alpha[area] = compose_float([
+        (dst_rgb[area], dst_alpha[area]),
+        (src_rgb[src_area], src_alpha[src_area]),
+    ])
+    assert np.abs(rgb.astype(np.int16) - expected_rgb).max() <= 1
+    assert np.abs(alpha.astype(np.int16) - expected_alpha).max() <= 1
+    outside = np.ones((6, 8), dtype=bool)
+    outside[area] = False
+    assert np.array_equal(rgb[outside], dst_rgb[outside]) and np.array_equal(alpha[outside], dst_alpha[outside])
+
+    expected_mask = dst_mask.copy()
+    expected_mask[area] = np.where(src_mask[src_area] != 0, src_mask[src_area], dst_mask[area])
+    assert np.array_equal(mask, expected_mask)
+    # Input layers aren't modified
+    assert not np.shares_memory(rgb, dst_rgb) and not np.shares_memory(mask, dst_mask)
+
+# Scalar version of OpenTTD brightness adjustment adjust_brightness replaced
+def adjust_brightness_scalar(c, brightness):
+    if brightness == 128:
+        return c
+
+    r, g, b = c
+    combined = (r << 32) | (g << 16) | b
+    combined *= brightness
+
+    r = (combined >> 39) & 0x1ff
+    g = (combined >> 23) & 0x1ff
+    b = (combined >> 7) & 0x1ff
+
+    if (combined & 0x800080008000) == 0:
+        return (r, g, b)
+
+    ob = 0
+    # Sum overbright
+    if r > 255: ob += r - 255
+    if g > 255: ob += g - 255
+    if b > 255: ob += b - 255
+
+    # Reduce overbright strength
+    ob //= 2
+    return (
+        255 if r >= 255 else min(r + ob * (255 - r) // 256, 255),
+        255 if g >= 255 else min(g + ob * (255 - g) // 256, 255),
+        255 if b >= 255 else min(b + ob * (255 - b) // 256, 255),
+    )
+
+
+def test_adjust_brightness_matches_scalar():
+    colours = np.array(grf.PALETTE, dtype=np.uint8)
+    brightness = np.arange(256)
+    res = lib.adjust_brightness(colours[:, np.newaxis], brightness[np.newaxis, :])
+    assert res.shape == (256, 256, 3)
+    expected = [[adjust_brightness_scalar(c, b) for b in range(256)] for c in grf.PALETTE]
+    assert res.tolist() == [[list(x) for x in row] for row in expected]
+
+
+@pytest.mark.parametrize('colour, brightness, expected', [
+    ((12, 34, 250), 128, (12, 34, 250)),  # unchanged
+    ((0, 0, 0), 255, (0, 0, 0)),
+    ((255, 255, 255), 255, (255, 255, 255)),
+    ((255, 0, 0), 255, (255, 125, 125)),  # overbright red spills into green and blue
+    ((200, 100, 50), 255, (255, 214, 142)),
+    ((200, 100, 50), 0, (0, 0, 0)),
+])
+def test_adjust_brightness_edge_cases(colour, brightness, expected):
+    assert tuple(lib.adjust_brightness(colour, brightness).tolist()) == expected
+    assert tuple(adjust_brightness_scalar(colour, brightness)) == expected
+
+
+# Water part of OpenTTD DoPaletteAnimations
+def openttd_water_palette(counter, toyland):
+    extr = lambda p, q: ((counter * p) & 0xffff) * q >> 16
+    suffix = '_toyland' if toyland else ''
+    res = []
+    s = lib.PALETTE_CYCLES['dark_water' + suffix]
+    j = extr(320, 5)
+    for i in range(5):
+        res.append(s[j])
+        j += 1
+        if j == 5:
+            j = 0
+    s = lib.PALETTE_CYCLES['glittery_water' + suffix]
+    j = extr(128, 15)
+    for i in range(5):
+        res.append(s[j])
+        j += 3
+        if j >= 15:
+            j -= 15
+    return res
+
+
+@pytest.mark.parametrize('toyland', (False, True))
+def test_animated_palette_water(toyland):
+    for tick in range(lib.PALETTE_ANIMATION_TICKS):
+        pal = lib.get_animated_palette(tick * 8, toyland=toyland)
+        assert [pal[m] for m in range(0xf5, 0xff)] == openttd_water_palette(tick * 8, toyland)
+        assert set(pal) == set(range(0xe3, 0xff))
+
+
+@pytest.mark.parametrize('grid', [
+    lambda: lib.RectGrid(func=None, width=64, height=31),
+    lambda: lib.FlexGrid(func=None),
+    lambda: lib.HouseGrid(func=None, height=64),
+    lambda: lib.BuildingSlicesGrid(func=None, height=64),
+    lambda: lib.BuildingSlicesGrid(func=None, height=64).ground,
+])
+def test_grids_have_no_instance_dict(grid):
+    assert not hasattr(grid(), '__dict__')
+
+
+
+# Sprite areas the grids produced before they had __slots__
+def test_grid_sprite_areas():
+    calls = []
+
+    def func(name, x, y, w, h, **kw):
+        calls.append((name, x, y, w, h, kw))
+        return grf.FileSprite(grf.ImageFile('unused.png'), x, y, w, h, name=name, zoom=grf.ZOOM_2X, **kw)
+
+    g = lib.RectGrid(func=func, width=64, height=31, padding=1, add_xofs=3).set_default(yofs=2)
+    g('rect', (2, 1))
+    g('rect_kw', (0, 3), xofs=5)
+    g = lib.FlexGrid(func=func, padding=2, start=(1, 1), add_width=1)
+    g('flex1', width=10, height=5)
+    g('flex_keep', width=7, height=5, keep_state=True)
+    g('flex2', width=7, height=5)
+    g = lib.HouseGrid(func=func, height=40, offset=(3, 4))
+    g('house', (1, 0))
+    g('house_bb', (1, 1), bb=(1, 2))
+    g('house_rel', (0, 1), rel=(3, 4))
+    g.ground('house_ground', (2, 0))
+    g = lib.BuildingSlicesGrid(func=func, height=64, z=2, tile_size=(2, 2), offset=(5, 6))
+    g('slice', (1, 0))
+    g('slice_below', (0, 1), below=3)
+    assert g.ground is g.ground
+    assert isinstance(g.ground('slice_ground', (1, 1)), lib.MaskGround)
+
+    assert calls == [
+        ('rect', 131, 33, 64, 31, {'xofs': 3, 'yofs': 2}),
+        ('rect_kw', 1, 97, 64, 31, {'xofs': 8, 'yofs': 2}),
+        ('flex1', 3, 3, 11, 5, {'xofs': 0, 'yofs': 0}),
+        ('flex_keep', 16, 3, 8, 5, {'xofs': 0, 'yofs': 0}),
+        ('flex2', 16, 3, 8, 5, {'xofs': 0, 'yofs': 0}),
+        ('house', 135, 6, 128, 81, {'xofs': -62, 'yofs': -19}),
+        ('house_bb', 135, 89, 128, 81, {'xofs': -66, 'yofs': -25}),
+        ('house_rel', 5, 89, 128, 81, {'xofs': -6, 'yofs': -7}),
+        ('house_ground', 265, 24, 128, 63, {'xofs': -62, 'yofs': -1}),
+        ('slice', 7, 8, 64, 97, {'xofs': -62, 'yofs': -35}),
+        ('slice_below', 199, 8, 64, 100, {'xofs': 2, 'yofs': -35}),
+        ('slice_ground', 71, 74, 128, 63, {'xofs': -62, 'yofs': -1}),
+    ]
+    # Defaults are per grid
+    assert lib.RectGrid(func=func, width=64, height=31).get_default('yofs') is None
+
+def test_composite_cache_reuses_same_layers():
+    rng = np.random.default_rng(1)
+    ground, building = ArraySprite(*random_layer(rng, 8, 4)), ArraySprite(*random_layer(rng, 8, 4))
+    other = ArraySprite(*random_layer(rng, 8, 4))
+    lib.COMPOSITE_CACHE.clear()
+    sprites = [lib.CompositeSprite([ground, building]), lib.CompositeSprite([ground, building]), lib.CompositeSprite([other, building])]
+    for s in sprites:
+        s.prepare_files()
+    context = grf.DummyWriteContext()
+    first, second, third = (s.get_data_layers(context) for s in sprites)
+    assert lib.COMPOSITE_CACHE.hits == 1
+    assert second[2] is first[2]
+    assert not first[2].flags.writeable
+    assert third[2] is not first[2]
+    lib.COMPOSITE_CACHE.clear()
+
+
+def test_sprite_collection_views():
+    sprites = [ArraySprite(np.zeros((1, 1, 3), dtype=np.uint8), name=f's{i}') for i in range(6)]
+    c = lib.SpriteCollection('c').add_sprites(sprites, climate=grf.TEMPERATE)
+    view = (c[1:5].pick(3, 0, -1) * 2)[1:]
+    entry = view.sprites[0][2]
+    assert isinstance(entry, lib.SpriteListView)
+    # Chained views index the original list directly
+    assert entry.sprites is sprites
+    assert len(view) == len(entry) == 5
+    assert [s.name for s in entry] == ['s1', 's4', 's4', 's1', 's4']
+    assert entry[0] is sprites[1] and entry[-1] is sprites[4]
+    with pytest.raises(IndexError):
+        c.pick(6)
+
+    # Views can be added to another collection like lists
+    d = lib.SpriteCollection('d').add_sprites(entry, climate=grf.ARCTIC)
+    assert [s.name for s in d.get_exact_sprites((('climate', grf.ARCTIC), ))] == ['s1', 's4', 's4', 's1', 's4']
+    assert view.get_exact_sprites((('climate', grf.TEMPERATE), )) == [sprites[i] for i in (1, 4, 4, 1, 4)]
+
+
+def test_validate_file_sprites(tmp_path):
+    from PIL import Image
+    path = tmp_path / 'sheet.png'
+    Image.new('RGBA', (64, 32)).save(path)
+    f = grf.ImageFile(path)
+    good = lib.FileSprite(f, 0, 0, 64, 31, name='good')
+    lib.validate_file_sprites([good, lib.CompositeSprite([good, good])])
+
+    bad = lib.FileSprite(f, 10, 2, 64, 31, name='bad')
+    with pytest.raises(RuntimeError, match=r'1 sprites are outside of their image borders:\n  bad: frame 1 area \(10\.\.74, 2\.\.33\)'):
+        lib.validate_file_sprites([good, lib.MagentaToCC(bad)])
+
+
+def test_ase_image_release_counts_prepared_sprites():
+    f = lib.AseImageFile('unused.ase')
+    f._images = {}
+    image = f._make_kw_key(frame=2)
+
+    # Reading without prepare doesn't leave a negative count behind
+    f._images[image] = 'data'
+    f.release(frame=2)
+    assert image not in f._images and image not in f._kw_refs
+
+    f.prepare(frame=2)
+    f.prepare(frame=2)
+    f._images[image] = 'data'
+    f.release(frame=2)
+    assert f._images[image] == 'data' and f._kw_refs[image] == 1
+    f.release(frame=2)
+    assert image not in f._images and image not in f._kw_refs
+
+
+@pytest.mark.parametrize('max_size', (1 << 20, 0))
+def test_composite_cache_releases_layer_images(monkeypatch, max_size):
+    # Layer images have to be released even when the composites get the memoized result
+    rng = np.random.default_rng(2)
+    layers = [random_layer(rng, 8, 4) for _ in range(2)]
+    f = lib.AseImageFile('unused.ase')
+    f._images = {}
+
+    def get_layers(self, context):
+        rgb, alpha = layers[self.kw['frame'] - 1]
+        return 8, 4, rgb, alpha, None
+
+    monkeypatch.setattr(lib.FileSprite, '_get_ase_data_layers', get_layers)
+    monkeypatch.setattr(lib, 'COMPOSITE_CACHE', lib.CompositeCache(max_size=max_size))
+    ground, building = (lib.FileSprite(f, 0, 0, 8, 4, frame=i) for i in (1, 2))
+    sprites = [lib.CompositeSprite([ground, building]) for _ in range(3)]
+    for s in sprites:
+        s.prepare_files()
+    context = grf.DummyWriteContext()
+    results = [s.get_data_layers(context) for s in sprites]
+    assert lib.COMPOSITE_CACHE.hits == (2 if max_size else 0)
+    assert all(np.array_equal(r[2], results[0][2]) for r in results)
+    assert not f._kw_refs
+
+
+def make_ase_file_sprite(image, x, y, w, h):
+    f = lib.AseImageFile('unused.ase')
+    f.get_array = lambda **kw: (image, grf.BPP_32)
+    return lib.FileSprite(f, x, y, w, h, name='cropped')
+
+
+def test_file_sprite_crops_ase_image():
+    image = np.arange(6 * 5 * 4, dtype=np.uint8).reshape(5, 6, 4)
+    context = grf.DummyWriteContext()
+    w, h, rgb, alpha, mask = make_ase_file_sprite(image, 2, 1, 3, 2).get_data_layers(context)
+    assert (w, h) == (3, 2)
+    assert np.array_equal(rgb, image[1:3, 2:5, :3]) and np.array_equal(alpha, image[1:3, 2:5, 3])
+    # Cropped layers are views of the image, not copies
+    assert np.shares_memory(rgb, image) and mask is None
+
+    s = make_ase_file_sprite(image, 0, 0, None, 3)
+    w, h, rgb, alpha, _ = s.get_data_layers(context)
+    assert (w, h) == (6, 5) and np.array_equal(rgb, image[:, :, :3])
+
+    for x, y, w, h in ((2, 1, None, 3), (0, 1, 3, None)):
+        with pytest.raises(RuntimeError, match='needs both width and height'):
+            make_ase_file_sprite(image, x, y, w, h).get_data_layers(context)
+    with pytest.raises(RuntimeError, match='outside image borders'):
+        make_ase_file_sprite(image, 4, 1, 3, 2).get_data_layers(context)
+
+
+SPRITES_DIR = pathlib.Path(__file__).resolve().parent.parent / 'sprites'
+
+# Tests that compare against real aseprite output, skipped where it isn't installed
+requires_aseprite = pytest.mark.skipif(
+    shutil.which(os.environ.get('ASEPRITE_EXECUTABLE', 'aseprite')) is None,
+    reason='aseprite executable not found')
+
+
+@pytest.fixture
+def fake_aseprite_version(monkeypatch):
+    def set_version(stdout, returncode=0):
+        monkeypatch.setattr(subprocess, 'run', lambda args, **kw: subprocess.CompletedProcess(args, returncode, stdout, ''))
+    lib.get_aseprite_version.cache_clear()
+    yield set_version
+    lib.get_aseprite_version.cache_clear()
+
+
+@pytest.mark.parametrize('stdout', ['Aseprite 1.3\n', 'Aseprite 1.3.2-x64\n', 'Aseprite 1.4-beta1\n', 'Aseprite 2.0'])
+def test_aseprite_version_supported(fake_aseprite_version, stdout):
+    fake_aseprite_version(stdout)
+    assert lib.get_aseprite_version() == stdout.strip()
+
+
+@pytest.mark.parametrize('stdout, error', [
+    ('Aseprite 1.2.40\n', 'too old'),
+    ('Aseprite 0.9\n', 'too old'),
+    ('Aseprite\n', 'Unable to parse'),
+])
+def test_aseprite_version_unsupported(fake_aseprite_version, stdout, error):
+    fake_aseprite_version(stdout)
+    with pytest.raises(RuntimeError, match=error):
+        lib.get_aseprite_version()
+
+
+def assert_same_visible_pixels(expected, actual):
+    assert expected.shape == actual.shape
+    assert np.array_equal(expected[:, :, 3], actual[:, :, 3])
+    # Colour of fully transparent pixels doesn't matter
+    visible = expected[:, :, 3] > 0
+    assert np.array_equal(expected[visible, :3], actual[visible, :3])
+
+
+@requires_aseprite
+def test_ase_export_script_matches_native_decoder():
+    path = SPRITES_DIR / 'trees' / 'cotton_candy_tree.ase'
+    keys = frozenset(
+        lib.AseImageFile._make_kw_key(**kw)
+        for frame in (1, 4, 7)
+        for kw in ({'frame': frame}, {'frame': frame, 'layers': 'TREE'}, {'frame': frame, 'ignore_layers': ('Spriteborder', 'REF Origin')})
+    )
+    cli_images = lib._export_ase_file_cli(path, keys)
+    native_images = lib._export_ase_file_native(path, keys)
+    assert cli_images.keys() == native_images.keys() == keys
+    for kw in keys:
+        assert_same_visible_pixels(cli_images[kw][0], native_images[kw][0])
+
+
+@requires_aseprite
+def test_compare_ase_decoders(capsys):
+    files = []
+    for name in ('effects/bubble_particle.ase', 'icons/cursor.ase', 'trees/arctic_tree.ase'):
+        f = lib.AseImageFile(SPRITES_DIR / name)
+        f.prepare(frame=1)
+        f.prepare(frame=2, ignore_layers='Spriteborder')
+        files.append(f)
+    assert lib.compare_ase_decoders(files)
+    assert 'Checked 6 images, 0 mismatched' in capsys.readouterr().out
+
+
+def test_compare_ase_decoders_reports_mismatches(monkeypatch, capsys):
+    # Stands in the native output for aseprite with one visible pixel changed
+    def export_cli(path, keys):
+        images = lib._export_ase_file_native(path, keys)
+        data = images[(1, (), ())][0].copy()
+        y, x = np.argwhere(data[:, :, 3] > 0)[0]
+        data[y, x, 0] ^= 1
+        images[(1, (), ())] = (data, grf.BPP_32)
+        return images
+
+    monkeypatch.setattr(lib, '_export_ase_file_cli', export_cli)
+    f = lib.AseImageFile(SPRITES_DIR / 'effects' / 'bubble_particle.ase')
+    f.prepare(frame=1)
+    f.prepare(frame=2)
+    assert not lib.compare_ase_decoders([f])
+    out = capsys.readouterr().out
+    assert '(1, (), ()): 1 pixels differ' in out
+    assert 'Checked 2 images, 1 mismatched' in out
+
+
+# Brute-force versions of SpriteCollection lookups that scan every entry like it was done before indexing
+def find_sprites_scan(collection, keys, exact):
+    kw = dict(keys)
+    d = {}
+    for zoom, params, sprites in collection.sprites:
+        if any(k not in kw or kw[k] != v for k, v in params.items()):
+            continue
+        if zoom not in d or d[zoom][0] < len(params):
+            d[zoom] = (len(params), sprites)
+    if exact and all(v[0] != len(kw) for v in d.values()):
+        return None, None
+    return d.get(grf.ZOOM_NORMAL, (0, None))[1], d.get(grf.ZOOM_2X, (0, None))[1]
+
+
+# unspecify strips the keys from every entry of a kept group
+def reduce_scan(collection, unspecify, **keys):
+    matches = {}
+    for zoom, kw, sprites in collection.sprites:
+        m = frozenset(k for k, v in kw.items() if k in keys and v == keys[k])
+        if m in matches:
+            matches[m].append((zoom, kw, sprites))
+            continue
+        if any(m.issubset(mi) for mi in matches):
+            continue
+        for mi in list(matches):
+            if mi.issubset(m):
+                del matches[mi]
+        matches[m] = [(zoom, kw, sprites)]
+    res = []
+    for entries in matches.values():
+        for zoom, kw, sprites in entries:
+            if unspecify:
+                kw = {k: v for k, v in kw.items() if k not in keys}
+            res.append((zoom, kw, [s.name for s in sprites]))
+    return res
+
+
+def names(sprites):
+    return None if sprites is None else [s.name for s in sprites]
+
+
+COLLECTION_KEYWORDS = {'climate': (grf.TEMPERATE, grf.ARCTIC), 'thin': (False, True), 'snow': (0, 1)}
+
+
+def random_collection(rng, n):
+    c = lib.SpriteCollection('c')
+    for i in range(n):
+        kw = {k: values[rng.integers(2)] for k, values in COLLECTION_KEYWORDS.items() if rng.integers(2)}
+        zoom = (grf.ZOOM_NORMAL, grf.ZOOM_2X)[rng.integers(2)]
+        sprites = [ArraySprite(np.zeros((1, 1, 3), dtype=np.uint8), name=f'e{i}_{j}') for j in range(2)]
+        for s in sprites:
+            s.zoom = zoom
+        c.add_sprites(sprites, **kw)
+    return c
+
+
+def all_lookup_keys():
+    res = [()]
+    for k, values in COLLECTION_KEYWORDS.items():
+        res += [keys + ((k, v),) for keys in res for v in values]
+    # Keywords that no entry has
+    res += [keys + (('unknown', 1),) for keys in res]
+    return res
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_sprite_collection_lookup_matches_scan(seed):
+    rng = np.random.default_rng(seed)
+    c = random_collection(rng, 12)
+    # Second round checks that entries added after a lookup rebuild the index
+    for _ in range(2):
+        for keys in all_lookup_keys():
+            for exact in (False, True):
+                expected = find_sprites_scan(c, keys, exact)
+                assert tuple(map(names, c._find_sprites(keys, exact))) == tuple(map(names, expected)), (keys, exact)
+        keys1x = {lib.dict_to_key(kw) for zoom, kw, _ in c.sprites if zoom == grf.ZOOM_NORMAL}
+        keys2x = {lib.dict_to_key(kw) for zoom, kw, _ in c.sprites if zoom == grf.ZOOM_2X}
+        assert c.get_keys() == (keys2x if len(keys2x) > len(keys1x) else keys1x)
+        c = c.add_sprites(random_collection(rng, 1).sprites[0][2], snow=1)
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_sprite_collection_reduce_matches_scan(seed):
+    rng = np.random.default_rng(seed)
+    c = random_collection(rng, 12)
+    for keys in all_lookup_keys()[1:]:
+        keys = dict(keys)
+        reduced = [(zoom, kw, [s.name for s in sprites]) for zoom, kw, sprites in c.reduce(**keys).sprites]
+        assert reduced == reduce_scan(c, False, **keys), keys
+        unspecified = [(zoom, kw, [s.name for s in sprites]) for zoom, kw, sprites in c.unspecify(**keys).sprites]
+        assert unspecified == reduce_scan(c, True, **keys), keys
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_sprite_collection_views_match_lists(seed):
+    rng = np.random.default_rng(seed)
+    sprites = {zoom: [ArraySprite(np.zeros((1, 1, 3), dtype=np.uint8), name=f's{zoom}_{i}') for i in range(8)]
+               for zoom in (grf.ZOOM_NORMAL, grf.ZOOM_2X)}
+    for zoom, l in sprites.items():
+        for s in l:
+            s.zoom = zoom
+    c = lib.SpriteCollection('c')
+    for zoom, l in sprites.items():
+        c.add_sprites(l, climate=grf.TEMPERATE)
+    expected = {zoom: list(l) for zoom, l in sprites.items()}
+
+    # Same chain of operations on the collection and on plain lists
+    for _ in range(4):
+        op, n = rng.integers(4), len(c)
+        if op == 0 and n > 0:
+            start, stop = sorted(rng.integers(-n, n + 1, size=2).tolist())
+            sl = slice(start, stop, (1, 2, -1)[rng.integers(3)])
+            c, expected = c[sl], {zoom: l[sl] for zoom, l in expected.items()}
+        elif op == 1 and n > 0:
+            i = int(rng.integers(n))
+            c, expected = c[i], {zoom: l[i: i + 1] for zoom, l in expected.items()}
+        elif op == 2 and n > 0:
+            indexes = rng.integers(-n, n, size=rng.integers(1, 6)).tolist()
+            c, expected = c.pick(*indexes), {zoom: [l[i] for i in indexes] for zoom, l in expected.items()}
+        else:
+            amount = int(rng.integers(3))
+            c, expected = c * amount, {zoom: l * amount for zoom, l in expected.items()}
+        for zoom, kw, view in c.sprites:
+            assert list(view) == expected[zoom]
+            assert [view[i] for i in range(-len(view), len(view))] == expected[zoom] * 2
+
+    # Views pass through reduce and are resolved to lists by lookups, once per key set
+    keys = (('climate', grf.TEMPERATE), )
+    assert all(isinstance(s, lib.SpriteListView) for _, _, s in c.reduce(climate=grf.TEMPERATE).sprites)
+    sprites1x, sprites2x = c.get_sprites(keys)
+    assert type(sprites1x) is list and sprites1x == expected[grf.ZOOM_NORMAL]
+    assert type(sprites2x) is list and sprites2x == expected[grf.ZOOM_2X]
+    assert c.get_sprites(keys)[0] is sprites1x
+    exact = c.get_exact_sprites(keys)
+    assert [(s.sprites[0], s.sprites[1]) for s in exact] == list(zip(*expected.values()))
+
+
+def make_sharing_grf(tmp_path, cls):
+    from PIL import Image
+    rng = np.random.default_rng(0)
+    Image.fromarray(rng.integers(0, 256, (32, 64, 4), dtype=np.uint8)).save(tmp_path / 'sheet.png')
+    f = grf.ImageFile(tmp_path / 'sheet.png')
+
+    def sprite(name, **kw):
+        return grf.FileSprite(f, 0, 0, 64, 31, name=name, **{'xofs': 0, 'yofs': 0, 'zoom': grf.ZOOM_NORMAL, **kw})
+
+    g = cls(grfid=b'TEST', name='test', description='test', sprite_cache_path=tmp_path / 'cache')
+    # Same image area in the 1x slots, names don't matter. Offsets or zoom make it a different sprite
+    g.add(grf.ReplaceOldSprites([(0, 4)]), sprite('a'), sprite('b'), sprite('xofs', xofs=1), sprite('yofs', yofs=-1))
+    g.add(grf.ReplaceOldSprites([(10, 1)]), grf.AlternativeSprites(sprite('2x', zoom=grf.ZOOM_2X), sprite('c')))
+    return g
+
+
+def test_share_sprites(tmp_path, capsys, monkeypatch):
+    g = make_sharing_grf(tmp_path, lib.NewGRF)
+    actions = [a for a in g.generate_sprites() if isinstance(a, (grf.SingleResourceAction, grf.AlternativeSprites))]
+    sprites = [a.resource if isinstance(a, grf.SingleResourceAction) else a.sprites for a in actions]
+    a, b, xofs, yofs, (zoom2x, c) = sprites
+    assert isinstance(a, lib.SharedSprite) and isinstance(b, lib.SharedSprite) and isinstance(c, lib.SharedSprite)
+    assert a.shared is b.shared is c.shared and a.shared.uses == 3
+    assert [s.name for s in (xofs, yofs, zoom2x)] == ['xofs', 'yofs', '2x']
+    assert not any(isinstance(s, lib.SharedSprite) for s in (xofs, yofs, zoom2x))
+    assert g._shared == [a.shared]
+
+    sizes = []
+    get_real_data = lib.SharedSprite.get_real_data
+
+    def get_shared_data(self, context):
+        data = get_real_data(self, context)
+        sizes.append(len(data))
+        return data
+
+    built = []
+    get_file_data = grf.FileSprite.get_real_data
+
+    def get_built_data(self, context):
+        built.append(self.name)
+        return get_file_data(self, context)
+
+    monkeypatch.setattr(lib.SharedSprite, 'get_real_data', get_shared_data)
+    monkeypatch.setattr(grf.FileSprite, 'get_real_data', get_built_data)
+    g.write(tmp_path / 'shared.grf')
+    # Encoded once and reused by the other two slots
+    assert sorted(built) == ['2x', 'a', 'xofs', 'yofs']
+    assert len(set(sizes)) == 1, sizes
+    saved = grf.byte_size_format(sizes[0] * 2)
+    assert f'Built 1 sprites once for 3 slots, saved {saved} of encoding' in capsys.readouterr().out
+
+    make_sharing_grf(tmp_path, grf.NewGRF).write(tmp_path / 'plain.grf')
+    assert (tmp_path / 'shared.grf').read_bytes() == (tmp_path / 'plain.grf').read_bytes()
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    # Cache entries are ordered by use time, make every use a second later
+    now = iter(range(1000, 2000))
+    monkeypatch.setattr(lib.time, 'time', lambda: next(now))
+
+
+def add_cache_entries(cache, keys, shape=(4, 4, 4)):
+    for i, key in enumerate(keys):
+        lib.AseExportCache.write(cache.path, key, np.full(shape, i, dtype=np.uint8))
+        cache.add(key)
+
+
+def test_ase_export_cache_evicts_least_recently_used(tmp_path, clock):
+    cache = lib.AseExportCache(tmp_path, max_size=1 << 20)
+    add_cache_entries(cache, ['a', 'b', 'c'])
+    cache.save()
+    entry_size = (tmp_path / 'a.npy').stat().st_size
+
+    # Next build uses 'a' and has room for two entries, least recently used one goes
+    cache = lib.AseExportCache(tmp_path, max_size=2 * entry_size)
+    assert cache.get('a')[0, 0, 0] == 0
+    cache.save()
+    assert sorted(p.stem for p in tmp_path.glob('*.npy')) == ['a', 'c']
+
+    # Entries used by the current build stay even if they don't fit
+    cache = lib.AseExportCache(tmp_path, max_size=0)
+    assert cache.contains('c')
+    cache.save()
+    assert sorted(p.stem for p in tmp_path.glob('*.npy')) == ['c']
+
+    cache = lib.AseExportCache(tmp_path, max_size=entry_size)
+    add_cache_entries(cache, ['d'])
+    cache.save()
+    assert sorted(p.stem for p in tmp_path.glob('*.npy')) == ['d']
+    assert list(json.loads((tmp_path / 'index.json').read_text())) == ['d']
+
+
+def test_ase_export_cache_damaged_entries(tmp_path, clock):
+    cache = lib.AseExportCache(tmp_path, max_size=1 << 20)
+    add_cache_entries(cache, ['truncated', 'garbage', 'good'], shape=(8, 8, 4))
+    cache.save()
+    data = (tmp_path / 'truncated.npy').read_bytes()
+    (tmp_path / 'truncated.npy').write_bytes(data[:len(data) // 2])
+    (tmp_path / 'garbage.npy').write_bytes(b'\0' * len(data))
+
+    cache = lib.AseExportCache(tmp_path, max_size=1 << 20)
+    assert not cache.contains('truncated')
+    # Same size so it can only be found out by loading it
+    assert cache.contains('garbage')
+    assert cache.get('garbage') is None and not cache.contains('garbage')
+    assert cache.contains('good') and cache.get('good').shape == (8, 8, 4)
+
+
+
+@pytest.mark.parametrize('damage', ['truncate', 'garbage'])
+def test_ase_image_reexports_damaged_cache_entry(tmp_path, monkeypatch, damage):
+    monkeypatch.setattr(lib, 'ASE_DECODER', 'native')
+    monkeypatch.setattr(lib, 'ASE_CACHE', lib.AseExportCache(tmp_path, max_size=1 << 30))
+    path = SPRITES_DIR / 'effects' / 'bubble_particle.ase'
+    f = lib.AseImageFile(path)
+    f.prepare(frame=2)
+    expected = np.array(f.get_array(frame=2)[0])
+    f.release(frame=2)
+
+    npy, = tmp_path.glob('*.npy')
+    data = npy.read_bytes()
+    npy.write_bytes(data[:len(data) // 2] if damage == 'truncate' else b'\0' * len(data))
+
+    # Next build finds the damaged file and exports the image again
+    monkeypatch.setattr(lib, 'ASE_CACHE', lib.AseExportCache(tmp_path, max_size=1 << 30))
+    f = lib.AseImageFile(path)
+    f.prepare(frame=2)
+    assert np.array_equal(f.get_array(frame=2)[0], expected)
+    assert npy.read_bytes() == data